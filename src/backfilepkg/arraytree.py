@@ -0,0 +1,733 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Array backed file tree for very big catalogs.  Instead of one object per
+file, the tree is a set of numpy columns with one row per file or
+directory (parent row, name offset into a shared string pool, size, mtime,
+flags and a digest matrix).  ArrayNode is a small view onto one row with
+the same interface as the nodes in filetree, so ComparisonTree and the
+watcher can use either kind of tree.
+"""
+
+import os, time
+import binascii
+from collections import Mapping
+from itertools import imap
+import numpy as np
+
+from filetree import Node, RootTree, files_equal, get_file_hash, NS_PER_SEC
+from dirscan import scan_dir, stat_entry
+from hashing import HashStage, DEFAULT_ALGORITHM, get_hash_function, get_digest_size, \
+    digest_to_bytes, digest_to_array, dir_item, file_item, dir_digest
+from catalog import Column, FileType, HAS_HASH as CATALOG_HAS_HASH, HAS_DIGEST as CATALOG_HAS_DIGEST
+
+#bits in the flags column
+IS_DIR = 1
+IS_LINK = 2
+HAS_HASH = 4
+#directories keep their Merkle digest in the digest matrix
+HAS_DIGEST = 8
+
+#mtime for rows that don't have one (links)
+NO_TIME = np.iinfo('int64').min
+
+class ArrayChildren(Mapping):
+    '''
+    Read-only name -> ArrayNode mapping for the items in a directory
+    '''
+
+    __slots__ = ('tree', 'row')
+
+    def __init__(self, tree, row):
+        self.tree = tree
+        self.row = row
+
+    def __len__(self):
+        return len(self.tree.child_rows(self.row))
+
+    def __iter__(self):
+        for r in self.tree.child_rows(self.row):
+            yield self.tree.get_name(r)
+
+    def __getitem__(self, name):
+        r = self.tree.find_child(self.row, name)
+        if r is None:
+            raise KeyError(name)
+        return ArrayNode(self.tree, r)
+
+    def __contains__(self, name):
+        return self.tree.find_child(self.row, name) is not None
+
+    def iteritems(self):
+        for r in self.tree.child_rows(self.row):
+            yield (self.tree.get_name(r), ArrayNode(self.tree, r))
+
+    def itervalues(self):
+        for r in self.tree.child_rows(self.row):
+            yield ArrayNode(self.tree, r)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+class ArrayNode(Node):
+    '''
+    View of one row of an ArrayTree.  Views are made as needed, so two
+    views of the same row are equal but not identical.
+    '''
+
+    __slots__ = ('tree', 'row')
+
+    def __init__(self, tree, row):
+        self.tree = tree
+        self.row = row
+
+    def __eq__(self, other):
+        if self.isfile:
+            if isinstance(other, Node) and other.isfile:
+                return files_equal(self, other)
+            return False
+        return isinstance(other, ArrayNode) and other.tree is self.tree and other.row == self.row
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.row))
+
+    @property
+    def name(self):
+        return self.tree.get_name(self.row)
+
+    @property
+    def parent(self):
+        parentrow = self.tree.columns['Parent'][self.row]
+        if parentrow < 0:
+            return None
+        return ArrayNode(self.tree, parentrow)
+
+    @property
+    def root(self):
+        return self.tree
+
+    @property
+    def children(self):
+        if self.isfile:
+            return None
+        return ArrayChildren(self.tree, self.row)
+
+    @property
+    def isdir(self):
+        return bool(self.tree.columns['Flags'][self.row] & IS_DIR)
+
+    @property
+    def isfile(self):
+        return not self.tree.columns['Flags'][self.row] & IS_DIR
+
+    @property
+    def islink(self):
+        return bool(self.tree.columns['Flags'][self.row] & IS_LINK)
+
+    @property
+    def linktarget(self):
+        return None
+
+    @property
+    def thumbnail(self):
+        return None
+
+    @property
+    def size(self):
+        return int(self.tree.columns['Size'][self.row])
+
+    @property
+    def mtime(self):
+        mtime = self.tree.columns['MTime'][self.row]
+        if mtime == NO_TIME:
+            return None
+        return int(mtime)
+
+    @property
+    def modified(self):
+        mtime = self.mtime
+        if mtime is None:
+            return None
+        return time.localtime(mtime // NS_PER_SEC)
+
+    @property
+    def hashval(self):
+        if not self.tree.columns['Flags'][self.row] & HAS_HASH:
+            return None
+        return self.tree.columns['Digests'][self.row].tostring()
+
+    @hashval.setter
+    def hashval(self, value):
+        self.tree.set_hash(self.row, value)
+
+    @property
+    def samplehash(self):
+        return self.tree.samples.get(self.row)
+
+    @samplehash.setter
+    def samplehash(self, value):
+        if value is None:
+            self.tree.samples.pop(self.row, None)
+        else:
+            self.tree.samples[self.row] = digest_to_bytes(value)
+
+    @property
+    def hashstage(self):
+        stage = self.tree.columns['HashStage'][self.row]
+        if stage < 0:
+            return None
+        return int(stage)
+
+    @hashstage.setter
+    def hashstage(self, value):
+        self.tree.columns['HashStage'][self.row] = -1 if value is None else value
+
+    def content_digest(self):
+        '''Merkle digest of a directory (see hashing.dir_digest)'''
+        if self.isfile:
+            return None
+        return self.tree.get_digest(self.row)
+
+    def hexdigest(self):
+        hashval = self.hashval
+        if hashval is not None:
+            return binascii.hexlify(hashval).upper()
+        else:
+            return 'None'
+
+    def abspath(self):
+        return os.path.join(self.tree.name, self.relpath()) if self.row > 0 else self.tree.name
+
+    def relpath(self):
+        return self.tree.get_relpath(self.row)
+
+    def depth(self):
+        return int(self.tree.columns['Depth'][self.row])
+
+    def update(self, other):
+        '''Copies the file info from another file, from any kind of tree'''
+        assert(self.isfile and other.isfile)
+        tree = self.tree
+        row = self.row
+        tree.columns['Size'][row] = other.size
+        tree.columns['MTime'][row] = NO_TIME if other.mtime is None else other.mtime
+        if other.islink:
+            tree.columns['Flags'][row] |= IS_LINK
+        else:
+            tree.columns['Flags'][row] &= ~IS_LINK
+        self.hashval = other.hashval
+        self.hashstage = other.hashstage
+        self.samplehash = other.samplehash
+
+    def add_copy(self, node):
+        '''Adds (or replaces) a copy of node, which can be from any kind of tree'''
+        row = self.tree.find_child(self.row, node.name)
+        if row is not None:
+            self.tree.remove_row(row)
+        self.tree.add_subtree(node, self.row)
+
+    def remove_child(self, name):
+        row = self.tree.find_child(self.row, name)
+        if row is None:
+            raise KeyError(name)
+        self.tree.remove_row(row)
+
+    def move_child(self, name, newparent, newname=None):
+        '''Moves and/or renames an item in this directory'''
+        row = self.tree.find_child(self.row, name)
+        if row is None:
+            raise KeyError(name)
+        assert(newparent.tree is self.tree)
+        self.tree.move_row(row, newparent.row, newname)
+
+    def __getitem__(self, relpath):
+        if (len(relpath) > 0) and relpath[0] == '/':
+            #actually an abspath
+            (_, common, relpath) = relpath.partition(self.abspath() + '/')
+            if not common:
+                raise KeyError
+        row = self.tree.lookup(relpath, start=self.row)
+        if row is None:
+            raise KeyError
+        return ArrayNode(self.tree, row)
+
+    def __contains__(self, relpath):
+        try:
+            self[relpath]
+        except KeyError:
+            return False
+        return True
+
+    def iternodes(self):
+        '''
+        Walk through the hierarchy and return names and nodes.
+        '''
+        tree = self.tree
+        rows = [self.row]
+        while rows:
+            row = rows.pop()
+            yield (tree.get_name(row), ArrayNode(tree, row))
+            if tree.columns['Flags'][row] & IS_DIR:
+                rows += tree.child_rows(row).tolist()
+
+    def __str__(self):
+        if self.isfile:
+            return '{0}: hash = {1}'.format(self.abspath(), self.hexdigest())
+        return self.abspath()
+
+class ArrayTree(ArrayNode):
+    '''
+    File tree stored as numpy columns, for catalogs with tens of millions
+    of files.  Row 0 is the root.  Each row has the row of its parent, which
+    comes before it unless it was moved.  Removed rows get a parent of -1,
+    which also cuts off anything below them.  Rows are never renumbered, so
+    ArrayNode views stay valid as the tree changes.
+
+    The children of a directory are a contiguous range of childorder,
+    sorted by a hash of their names so they can be found by bisection.  The
+    index is rebuilt the first time it's needed after rows are added or
+    removed.
+
+    Directory digests are computed when they're asked for, and dropped for
+    the directories above anything that changes.
+    '''
+
+    def __init__(self, name=None, ident=None, algorithm=None, blocksize=None):
+        self.name = name
+        self.id = ident
+        if algorithm is None:
+            algorithm = DEFAULT_ALGORITHM
+        get_hash_function(algorithm)
+        self.hashalgorithm = algorithm
+        self.hashblocksize = blocksize
+        self.init_columns({})
+
+    #the root's name is its path, so it's kept outside the string pool
+    name = None
+    tree = property(lambda self: self)
+    row = 0
+
+    def init_columns(self, data):
+        ds = get_digest_size(self.hashalgorithm)
+        self.columns = {'Parent': Column('int64', data=data.get('Parent'), fill=-1),
+                        'Depth': Column('int16', data=data.get('Depth')),
+                        'Flags': Column('uint8', data=data.get('Flags')),
+                        'Size': Column('int64', data=data.get('Size')),
+                        'MTime': Column('int64', data=data.get('MTime'), fill=NO_TIME),
+                        'HashStage': Column('int8', data=data.get('HashStage'), fill=-1),
+                        'Digests': Column('uint8', (ds,), data=data.get('Digests')),
+                        'NameHash': Column('int64', data=data.get('NameHash')),
+                        'NameOffset': Column('int64', data=data.get('NameOffset')),
+                        'NameLength': Column('int32', data=data.get('NameLength'))}
+        self.namepool = bytearray(data.get('NamePool', ''))
+        #sample hashes are only there for a few files, after staged hashing
+        self.samples = {}
+        self.nrows = len(self.columns['Parent'])
+        if self.nrows == 0:
+            self.add_row('', -1, IS_DIR)
+        self.dirty = True
+
+    def get_name(self, row):
+        if row == 0:
+            return self.name
+        off = self.columns['NameOffset'][row]
+        return str(self.namepool[off:off + self.columns['NameLength'][row]])
+
+    def add_row(self, name, parent, flags, size=0, mtime=None):
+        for col in self.columns.itervalues():
+            col.append()
+        row = self.nrows
+        self.nrows += 1
+        self.columns['Parent'][row] = parent
+        self.columns['Depth'][row] = self.columns['Depth'][parent] + 1 if parent >= 0 else 0
+        self.columns['Flags'][row] = flags
+        self.columns['Size'][row] = size
+        if mtime is not None:
+            self.columns['MTime'][row] = mtime
+        self.set_name(row, name)
+        self.invalidate(parent)
+        return row
+
+    def set_name(self, row, name):
+        #old names are left in the pool
+        self.columns['NameHash'][row] = hash(name)
+        self.columns['NameOffset'][row] = len(self.namepool)
+        self.columns['NameLength'][row] = len(name)
+        self.namepool += name
+        self.dirty = True
+
+    def remove_row(self, row):
+        '''Cuts a row (and everything below it) out of the tree'''
+        assert(row > 0)
+        self.invalidate(self.columns['Parent'][row])
+        self.columns['Parent'][row] = -1
+        self.dirty = True
+
+    def move_row(self, row, parent, name=None):
+        '''
+        Moves a row (and everything below it) to the directory at parent,
+        replacing anything there with the same name, and renames it if name
+        is given
+        '''
+        if name is None:
+            name = self.get_name(row)
+        existing = self.find_child(parent, name)
+        if existing is not None and existing != row:
+            self.remove_row(existing)
+        self.invalidate(self.columns['Parent'][row])
+        self.columns['Parent'][row] = parent
+        if name != self.get_name(row):
+            self.set_name(row, name)
+        self.dirty = True
+        self.invalidate(parent)
+
+        depth = self.columns['Depth']
+        shift = depth[parent] + 1 - depth[row]
+        if shift:
+            rows = [row]
+            while rows:
+                r = rows.pop()
+                depth[r] += shift
+                if self.columns['Flags'][r] & IS_DIR:
+                    rows += self.child_rows(r).tolist()
+
+    def set_hash(self, row, hashval):
+        if hashval is None:
+            self.columns['Flags'][row] &= ~HAS_HASH
+        else:
+            self.columns['Digests'][row] = digest_to_array(hashval)
+            self.columns['Flags'][row] |= HAS_HASH
+        self.invalidate(self.columns['Parent'][row])
+
+    def invalidate(self, row):
+        '''
+        Drops the digests of a directory and the ones above it.  A digest is
+        only there if the ones below it are, so we can stop at the first
+        directory without one.
+        '''
+        flags = self.columns['Flags']
+        parent = self.columns['Parent']
+        while row >= 0 and flags[row] & HAS_DIGEST:
+            flags[row] &= ~HAS_DIGEST
+            row = parent[row]
+
+    def get_digest(self, row):
+        '''Merkle digest of the directory at row, computed if we don't have it'''
+        flags = self.columns['Flags']
+        digests = self.columns['Digests']
+        if not flags[row] & HAS_DIGEST:
+            hashfcn = get_hash_function(self.hashalgorithm)
+            items = []
+            for r in self.child_rows(row):
+                name = self.get_name(r)
+                if flags[r] & IS_DIR:
+                    items.append(dir_item(name, 'D', self.get_digest(r)))
+                else:
+                    node = ArrayNode(self, r)
+                    mtime = node.mtime
+                    items.append(file_item(name, node.hashval, node.size,
+                                           None if mtime is None else mtime // NS_PER_SEC,
+                                           islink=node.islink))
+            digests[row] = np.frombuffer(dir_digest(items, hashfcn), dtype='uint8')
+            flags[row] |= HAS_DIGEST
+        return digests[row].tostring()
+
+    def reindex(self):
+        '''Rebuilds the child ranges'''
+        parent = self.columns['Parent'].values()
+        rows = np.flatnonzero(parent >= 0)
+        order = np.lexsort((self.columns['NameHash'].values()[rows], parent[rows]))
+        self.childorder = rows[order]
+        counts = np.bincount(parent[rows], minlength=self.nrows)
+        self.childstart = np.cumsum(counts) - counts
+        self.childcount = counts
+        self.dirty = False
+
+    def child_rows(self, row):
+        if self.dirty:
+            self.reindex()
+        start = self.childstart[row]
+        return self.childorder[start:start + self.childcount[row]]
+
+    def find_child(self, row, name):
+        '''Row of the item called name in the directory at row, or None'''
+        rows = self.child_rows(row)
+        h = hash(name)
+        hashes = self.columns['NameHash'].values()[rows]
+        lo = np.searchsorted(hashes, h, side='left')
+        hi = np.searchsorted(hashes, h, side='right')
+        for r in rows[lo:hi]:
+            if self.get_name(r) == name:
+                return r
+        return None
+
+    def lookup(self, relpath, start=0):
+        '''Row for a path relative to the row start, or None'''
+        row = start
+        if relpath in ('', '.'):
+            return row
+        for name in relpath.split('/'):
+            if not self.columns['Flags'][row] & IS_DIR:
+                return None
+            row = self.find_child(row, name)
+            if row is None:
+                return None
+        return row
+
+    def get_relpath(self, row):
+        parts = []
+        while row > 0:
+            parts.append(self.get_name(row))
+            row = self.columns['Parent'][row]
+        parts.reverse()
+        return '/'.join(parts)
+
+    def nbytes(self):
+        '''Memory used by the columns, the string pool and the index'''
+        n = sum(col.data.nbytes for col in self.columns.itervalues()) + len(self.namepool)
+        if not self.dirty:
+            n += self.childorder.nbytes + self.childstart.nbytes + self.childcount.nbytes
+        return n
+
+    def node(self, row):
+        return ArrayNode(self, row)
+
+    def levels(self):
+        '''
+        Rows that are in the tree, grouped by depth, from the root down
+        '''
+        parent = self.columns['Parent'].values()
+        depth = self.columns['Depth'].values()
+        rows = np.flatnonzero(parent >= 0)
+        rows = rows[np.argsort(depth[rows], kind='mergesort')]
+        bounds = np.searchsorted(depth[rows], np.arange(depth.max() + 2))
+        return [rows[a:b] for (a, b) in zip(bounds[:-1], bounds[1:])]
+
+    def reachable(self):
+        '''Boolean mask of the rows that are still connected to the root'''
+        parent = self.columns['Parent'].values()
+        mask = np.zeros(self.nrows, dtype=bool)
+        mask[0] = True
+        for rows in self.levels():
+            mask[rows] = mask[parent[rows]]
+        return mask
+
+    def subtree_sum(self, values):
+        '''
+        Sums values (one per row) over each subtree, one level at a time
+        from the bottom up.  Returns a new array, indexed by row.
+        '''
+        parent = self.columns['Parent'].values()
+        total = np.array(values, copy=True)
+        for rows in reversed(self.levels()):
+            if len(rows) == 0:
+                continue
+            par = parent[rows]
+            order = np.argsort(par, kind='mergesort')
+            par = par[order]
+            starts = np.flatnonzero(np.r_[True, par[1:] != par[:-1]])
+            total[par[starts]] += np.add.reduceat(total[rows[order]], starts)
+        return total
+
+    def isfile_mask(self):
+        return (self.columns['Flags'].values() & IS_DIR) == 0
+
+    def total_sizes(self):
+        '''Bytes in the files under each row (or the file's own size)'''
+        return self.subtree_sum(np.where(self.isfile_mask(), self.columns['Size'].values(), 0))
+
+    def file_counts(self):
+        '''Number of files under each row'''
+        return self.subtree_sum(self.isfile_mask().astype('int64'))
+
+    def get_needs_hash(self):
+        flags = self.columns['Flags'].values()
+        rows = np.flatnonzero(((flags & (IS_DIR | IS_LINK | HAS_HASH)) == 0) & self.reachable())
+        return [ArrayNode(self, r) for r in rows]
+
+    @staticmethod
+    def from_tree(tree):
+        '''Copies a filetree.RootTree (or another ArrayTree)'''
+        atree = ArrayTree(name=tree.name, ident=tree.id, algorithm=tree.hashalgorithm,
+                          blocksize=tree.hashblocksize)
+        for node in tree.children.values():
+            atree.add_subtree(node, 0)
+        return atree
+
+    def duplicate(self, parent=None):
+        return ArrayTree.from_tree(self)
+
+    def add_subtree(self, node, parent):
+        '''Copies node and everything below it into the directory at parent'''
+        top = self.add_node(node, parent)
+        nodes = [(top, sub) for sub in node.children.values()] if node.isdir else []
+        while nodes:
+            (parent, node) = nodes.pop()
+            row = self.add_node(node, parent)
+            if node.isdir:
+                nodes += [(row, sub) for sub in node.children.values()]
+        return top
+
+    def add_node(self, node, parent):
+        if node.isdir:
+            return self.add_row(node.name, parent, IS_DIR)
+        flags = IS_LINK if node.islink else 0
+        row = self.add_row(node.name, parent, flags, size=node.size, mtime=node.mtime)
+        self.set_hash(row, node.hashval)
+        if node.hashstage is not None:
+            self.columns['HashStage'][row] = node.hashstage
+        if node.samplehash is not None:
+            self.samples[row] = node.samplehash
+        return row
+
+    @staticmethod
+    def from_catalog(catalog):
+        '''
+        Builds the tree straight from the columns of a ColumnCatalog, without
+        making any nodes.  Deleted files in the catalog are kept, but they
+        have no parent.
+        '''
+        atree = ArrayTree(name=catalog.rootpath, algorithm=catalog.algorithm,
+                          blocksize=catalog.hashblocksize)
+        cols = catalog.columns
+        names = catalog.names
+        n = catalog.nrows
+
+        parent = cols['Parent'].values().copy()
+        parent[0] = -1
+        #parents come before their children, so one pass per level is enough
+        depth = np.zeros(n, dtype='int16')
+        haspar = np.flatnonzero(parent >= 0)
+        while True:
+            newdepth = depth.copy()
+            newdepth[haspar] = depth[parent[haspar]] + 1
+            if np.array_equal(newdepth, depth):
+                break
+            depth = newdepth
+
+        ftype = cols['Type'].values()
+        catflags = cols['Flags'].values()
+        stage = cols['HashStage'].values()
+        isdir = ftype == FileType.Dir
+        flags = np.zeros(n, dtype='uint8')
+        flags[isdir] |= IS_DIR
+        flags[ftype == FileType.Link] |= IS_LINK
+        #like ColumnCatalog.read, only full hashes count
+        fullhash = ((catflags & CATALOG_HAS_HASH) != 0) & ((stage == -1) | (stage == HashStage.Full))
+        flags[fullhash & ~isdir] |= HAS_HASH
+        flags[((catflags & CATALOG_HAS_DIGEST) != 0) & isdir] |= HAS_DIGEST
+
+        modified = cols['Modified'].values()
+        mtime = np.full(n, NO_TIME, dtype='int64')
+        ok = np.isfinite(modified)
+        mtime[ok] = modified[ok].astype('int64') * NS_PER_SEC
+
+        namelen = np.fromiter(imap(len, names), dtype='int32', count=n)
+        nameoff = np.cumsum(namelen) - namelen
+
+        atree.init_columns({'Parent': parent,
+                            'Depth': depth,
+                            'Flags': flags,
+                            'Size': cols['Size'].values(),
+                            'MTime': mtime,
+                            'HashStage': cols['HashStage'].values(),
+                            'Digests': cols['Hash'].values(),
+                            'NameHash': np.fromiter(imap(hash, names), dtype='int64', count=n),
+                            'NameOffset': nameoff,
+                            'NameLength': namelen,
+                            'NamePool': ''.join(names)})
+        return atree
+
+    @staticmethod
+    def from_hdf5(h5file, ident=None):
+        '''
+        Loads the tree from a columnar catalog if the file has one, or else
+        through a RootTree
+        '''
+        from catalog import ColumnCatalog
+        if ColumnCatalog.exists(h5file):
+            return ArrayTree.from_catalog(ColumnCatalog.open(h5file))
+        tree = RootTree(ident=ident)
+        tree.from_hdf5(h5file)
+        return ArrayTree.from_tree(tree)
+
+    def from_path(self, path, dohash=False, exclude=['.annex']):
+        '''
+        Builds the tree from an existing path
+        '''
+        if not self.name:
+            self.name = os.path.abspath(path)
+        self.add_path(0, path, dohash, exclude)
+
+    def add_path(self, parent, path, dohash=False, exclude=['.annex']):
+        stack = [(parent, path)]
+        while stack:
+            (parent, path) = stack.pop()
+            for entry in scan_dir(path, exclude):
+                row = self.add_entry(parent, entry, dohash)
+                if entry.isdir and not entry.islink:
+                    stack.append((row, entry.path))
+
+    def add_entry(self, parent, entry, dohash=False):
+        if entry.isdir and not entry.islink:
+            return self.add_row(entry.name, parent, IS_DIR)
+        elif entry.islink:
+            return self.add_row(entry.name, parent, IS_LINK)
+        row = self.add_row(entry.name, parent, 0, size=entry.size, mtime=entry.mtime_ns)
+        if dohash:
+            self.hash_row(row, entry.path)
+        return row
+
+    def hash_row(self, row, path):
+        h = get_file_hash(path, algorithm=self.hashalgorithm, blocksize=self.hashblocksize)
+        self.set_hash(row, h.digest())
+        self.columns['HashStage'][row] = HashStage.Full
+
+    def update_item(self, fullpath, isdir=False, dohash=False):
+        '''
+        Updates an item somewhere in the tree.
+        Returns nodes that need hashes.
+        '''
+        pathname = os.path.relpath(fullpath, self.name)
+        (parentname, upname) = os.path.split(pathname)
+
+        parent = self.lookup(parentname)
+        assert(parent is not None)
+
+        row = self.find_child(parent, upname)
+        if row is None:
+            row = self.add_entry(parent, stat_entry(fullpath), dohash)
+            if isdir:
+                self.add_path(row, fullpath, dohash)
+                needshash = [node for (_, node) in ArrayNode(self, row).iternodes() if node.isfile]
+            else:
+                needshash = [ArrayNode(self, row)]
+        elif not isdir:
+            entry = stat_entry(fullpath)
+            self.columns['Size'][row] = entry.size
+            self.columns['MTime'][row] = entry.mtime_ns
+            self.set_hash(row, None)
+            self.columns['HashStage'][row] = -1
+            self.samples.pop(row, None)
+            if dohash:
+                self.hash_row(row, fullpath)
+            needshash = [ArrayNode(self, row)]
+        else:
+            #modified directory is sort of meaningless
+            needshash = []
+        return needshash
+
+    def delete_item(self, fullpath):
+        '''
+        Deletes an item somewhere in the tree.
+        '''
+        row = self.lookup(os.path.relpath(fullpath, self.name))
+        assert(row is not None)
+        self.remove_row(row)
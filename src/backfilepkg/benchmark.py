@@ -0,0 +1,629 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Benchmarks for the scanning and hashing code.  Run as
+    python benchmark.py <test> <path>
+"""
+
+import os, sys, time
+import struct
+import random
+import gc
+import resource
+import shutil
+import tempfile
+import multiprocessing as mp
+from collections import defaultdict
+import numpy as np
+import h5py
+
+import dirscan
+from hashing import HASH_FUNCTION, BLOCK_SIZE, HashEngine, HashStage
+
+class SyscallCounter(object):
+    '''
+    Counts the stat-type calls made from Python while it's active.
+    Wraps os.stat, os.lstat, os.listdir and dirscan.scandir, and counts
+    the stat calls made on the entries that scandir returns.
+    '''
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def __enter__(self):
+        self.saved = (os.stat, os.lstat, os.listdir, dirscan.scandir)
+        counts = self.counts
+
+        def wrap(name, fcn):
+            def counted(*args, **kw):
+                counts[name] += 1
+                return fcn(*args, **kw)
+            return counted
+
+        os.stat = wrap('stat', os.stat)
+        os.lstat = wrap('lstat', os.lstat)
+        os.listdir = wrap('listdir', os.listdir)
+        if dirscan.scandir is not None:
+            scandir = dirscan.scandir
+            def counted_scandir(path):
+                counts['scandir'] += 1
+                for entry in scandir(path):
+                    yield _CountedEntry(entry, counts)
+            dirscan.scandir = counted_scandir
+        return self
+
+    def __exit__(self, type, value, traceback):
+        (os.stat, os.lstat, os.listdir, dirscan.scandir) = self.saved
+
+    def total(self):
+        return sum(self.counts.values())
+
+class _CountedEntry(object):
+    '''Proxy for a scandir entry that counts the calls that hit the disk'''
+
+    def __init__(self, entry, counts):
+        self.entry = entry
+        self.name = entry.name
+        self.path = entry.path
+        self.counts = counts
+
+    def is_symlink(self):
+        return self.entry.is_symlink()
+
+    def is_dir(self, follow_symlinks=True):
+        if follow_symlinks and self.entry.is_symlink():
+            self.counts['stat'] += 1
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            self.counts['stat'] += 1
+        else:
+            self.counts['lstat'] += 1
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+def scan_listdir(top):
+    '''
+    The old way of scanning: listdir plus isdir/islink/getsize/getmtime
+    for each item.  Returns the number of entries.
+    '''
+    n = 0
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        for name in os.listdir(path):
+            pathname = os.path.join(path, name)
+            n += 1
+            if os.path.isdir(pathname):
+                if not os.path.islink(pathname):
+                    stack.append(pathname)
+            elif os.path.islink(pathname):
+                pass
+            else:
+                os.path.getsize(pathname)
+                os.path.getmtime(pathname)
+    return n
+
+def scan_dirscan(top):
+    '''Same scan using dirscan.walk.  Returns the number of entries.'''
+    n = 0
+    for (_, dirs, files) in dirscan.walk(top):
+        n += len(dirs)
+        for entry in files:
+            n += 1
+            if not entry.islink:
+                entry.size
+                entry.mtime
+    return n
+
+def build_scan_tree(path, ndirs=20, nfiles=200):
+    '''Makes a tree of empty files for the scanning benchmark'''
+    for i in xrange(ndirs):
+        dirname = os.path.join(path, 'dir{0:03d}'.format(i))
+        os.makedirs(os.path.join(dirname, 'sub'))
+        for j in xrange(nfiles):
+            open(os.path.join(dirname, 'file{0:04d}'.format(j)), 'wb').close()
+            open(os.path.join(dirname, 'sub', 'file{0:04d}'.format(j)), 'wb').close()
+
+def bench_scan(path, repeat=3):
+    '''
+    Compares the number of stat calls and entries/sec of the old listdir scan
+    and the dirscan scan
+    '''
+    results = []
+    for (name, fcn) in [('listdir', scan_listdir), ('dirscan', scan_dirscan)]:
+        with SyscallCounter() as counter:
+            n = fcn(path)
+
+        best = None
+        for i in xrange(repeat):
+            t0 = time.time()
+            fcn(path)
+            dt = time.time() - t0
+            if best is None or dt < best:
+                best = dt
+
+        counts = ', '.join('{0}={1}'.format(k, v) for (k, v) in sorted(counter.counts.items()))
+        print '{0:>8}: {1} entries, {2:.2f} calls/entry ({3}), {4:.0f} entries/sec'.format(
+            name, n, float(counter.total()) / max(n, 1), counts, n / max(best, 1e-9))
+        results.append((name, n, counter.total(), best))
+    return results
+
+def get_file_hash_blocks(filename):
+    '''
+    The old way of hashing, for comparison: one read (and one new string)
+    for each block
+    '''
+    h = HASH_FUNCTION()
+    with open(filename, 'rb') as fid:
+        def readblock():
+            return fid.read(BLOCK_SIZE)
+        
+        for b in iter(readblock,''):
+            h.update(b)
+    return filename, np.frombuffer(h.digest(), dtype=np.uint8, count=h.digest_size)
+
+def build_hash_files(path, nfiles=16, filesize=32*1024*1024):
+    '''Makes random files for the hashing benchmarks'''
+    chunk = 1024*1024
+    for i in xrange(nfiles):
+        with open(os.path.join(path, 'hash{0:03d}.bin'.format(i)), 'wb') as fid:
+            for j in xrange(filesize // chunk):
+                fid.write(os.urandom(chunk))
+
+def list_files(path):
+    return [entry.path for (_, _, files) in dirscan.walk(path) for entry in files
+            if not entry.islink]
+
+def bench_hash(path, poolsize=4):
+    '''
+    Compares the old process pool hashing with the HashEngine threads.
+    Files are read once first, so both run from the page cache.
+    '''
+    filenames = list_files(path)
+    totalsize = sum([os.path.getsize(fn) for fn in filenames])
+    for fn in filenames:
+        get_file_hash_blocks(fn)
+
+    t0 = time.time()
+    pool = mp.Pool(poolsize)
+    procmap = dict(pool.imap_unordered(get_file_hash_blocks, filenames, 10))
+    pool.close()
+    pool.join()
+    tproc = time.time() - t0
+
+    engine = HashEngine()
+    t0 = time.time()
+    threadmap = engine.hash_files(filenames)
+    tthread = time.time() - t0
+
+    assert(all([np.all(procmap[fn] == threadmap[fn]) for fn in filenames]))
+
+    mb = totalsize / 1e6
+    print '{0} files, {1:.1f} MB'.format(len(filenames), mb)
+    print 'process pool ({0} procs): {1:.2f} sec, {2:.1f} MB/sec'.format(poolsize, tproc, mb / max(tproc, 1e-9))
+    print 'HashEngine threads: {0:.2f} sec, {1:.1f} MB/sec'.format(tthread, mb / max(tthread, 1e-9))
+    print engine.report()
+    return (tproc, tthread)
+
+def bench_mmap(path):
+    '''
+    Compares hashing the files by reading them into a buffer with hashing
+    them from a memory map, in one thread
+    '''
+    filenames = list_files(path)
+    totalsize = sum([os.path.getsize(fn) for fn in filenames])
+    mb = totalsize / 1e6
+    for fn in filenames:
+        get_file_hash_blocks(fn)
+
+    results = {}
+    for (name, usemmap) in [('read', False), ('mmap', True)]:
+        engine = HashEngine(nthreads=1, usemmap=usemmap)
+        t0 = time.time()
+        c0 = time.clock()
+        results[name] = dict([engine.hash_file(fn) for fn in filenames])
+        dt = time.time() - t0
+        dc = time.clock() - c0
+        print '{0}: {1:.2f} sec ({2:.2f} CPU sec), {3:.1f} MB/sec'.format(name, dt, dc, mb / max(dt, 1e-9))
+
+    assert(all([np.all(results['read'][fn] == results['mmap'][fn]) for fn in filenames]))
+
+def bench_catalog(path, nfiles=20000, filesperdir=100):
+    '''
+    Compares writing and reopening a catalog of nfiles made up files in the
+    old layout (one HDF5 group per file) and the columnar layout
+    '''
+    import filedata
+    from catalog import ColumnCatalog
+
+    modified = time.localtime()
+    for layout in ['groups', 'columns']:
+        outfile = os.path.join(path, layout + '.h5')
+        writer = filedata.FileDataWriter(outfile, path, layout=layout)
+
+        t0 = time.time()
+        writer.init_file(outfile, path)
+        for i in xrange(nfiles):
+            dirname = os.path.join(path, 'dir{0:04d}'.format(i // filesperdir))
+            if i % filesperdir == 0:
+                writer.write_data(filedata.FileData(dirname, ftype=filedata.FileType.Dir))
+            fullpath = os.path.join(dirname, 'file{0:06d}'.format(i))
+            hashval = np.frombuffer(HASH_FUNCTION(fullpath).digest(), dtype=np.uint8)
+            fd = filedata.FileData(fullpath, ftype=filedata.FileType.File, size=i, modified=modified,
+                                   mimetype='application/octet-stream', hashval=hashval,
+                                   hashstage=HashStage.Full)
+            writer.write_data(fd)
+        writer.close()
+        twrite = time.time() - t0
+
+        t0 = time.time()
+        with h5py.File(outfile, 'r') as h5file:
+            if layout == 'columns':
+                catalog = ColumnCatalog.open(h5file)
+                n = len([catalog.read(row) for row in xrange(catalog.nrows)])
+            else:
+                items = []
+                def read(name, obj):
+                    if isinstance(obj, h5py.Group):
+                        fd = filedata.FileData(name)
+                        fd.from_hdf5(obj)
+                        items.append(fd)
+                h5file['ROOT'].visititems(read)
+                n = len(items)
+        topen = time.time() - t0
+
+        print '{0:>8}: write {1:.2f} sec, reopen and read {2} items {3:.2f} sec, {4:.1f} MB'.format(
+            layout, twrite, n, topen, os.path.getsize(outfile) / 1e6)
+
+def get_rss():
+    '''Resident memory of this process in bytes'''
+    try:
+        with open('/proc/self/statm') as fid:
+            return int(fid.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        #peak, not current, but it only grows here
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class LegacyFileNode(object):
+    '''
+    A file node the way they were before __slots__, for comparison: a
+    __dict__, a uint8 array digest and a struct_time
+    '''
+
+    def __init__(self, name, parent, size, hashval):
+        self.name = name
+        self.parent = parent
+        self.root = parent.root
+        self.size = size
+        self.modified = time.localtime()
+        self.islink = False
+        self.linktarget = None
+        self.hashval = np.frombuffer(hashval, dtype=np.uint8, count=len(hashval))
+        self.samplehash = None
+        self.hashstage = None
+        self.thumbnail = None
+        self.children = None
+
+class LegacyDirTree(object):
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.id = None
+        self.children = dict()
+
+def build_array_tree(nfiles, filesperdir=100):
+    '''Same as build_node_tree, as an ArrayTree'''
+    from arraytree import ArrayTree, IS_DIR
+
+    tree = ArrayTree(name='/')
+    mtime = int(time.time()) * 10**9
+    for i in xrange(nfiles):
+        if i % filesperdir == 0:
+            d = tree.add_row('dir{0:06d}'.format(i // filesperdir), 0, IS_DIR)
+        name = 'file{0:08d}'.format(i)
+        row = tree.add_row(name, d, 0, size=i, mtime=mtime)
+        tree.set_hash(row, HASH_FUNCTION(name).digest())
+    tree.reindex()
+    return tree
+
+def build_node_tree(nfiles, legacy=False, filesperdir=100):
+    '''Tree of made up files with digests, filesperdir files per directory'''
+    from filetree import RootTree, DirTree, FileNode
+
+    if legacy:
+        root = LegacyDirTree(None, None)
+    else:
+        root = RootTree(name='/')
+    mtime = int(time.time()) * 10**9
+    for i in xrange(nfiles):
+        if i % filesperdir == 0:
+            name = 'dir{0:06d}'.format(i // filesperdir)
+            if legacy:
+                d = LegacyDirTree(name, root)
+                root.children[name] = d
+            else:
+                d = DirTree(name=name, parent=root)
+                root.add_child(d)
+        name = 'file{0:08d}'.format(i)
+        hashval = HASH_FUNCTION(name).digest()
+        if legacy:
+            d.children[name] = LegacyFileNode(name, d, i, hashval)
+        else:
+            node = FileNode(name, d, size=i)
+            node.mtime = mtime
+            node.hashval = hashval
+            d.add_child(node)
+    return root
+
+def bench_nodes(nfiles=200000):
+    '''
+    Memory per node for a tree of nfiles files, with the old style nodes,
+    the __slots__ nodes and an ArrayTree
+    '''
+    for name in ['legacy', 'slots', 'array']:
+        #each one in its own process, so memory freed by the last one
+        #doesn't get counted
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            continue
+        gc.collect()
+        rss0 = get_rss()
+        t0 = time.time()
+        if name == 'array':
+            tree = build_array_tree(nfiles)
+        else:
+            tree = build_node_tree(nfiles, legacy=(name == 'legacy'))
+        dt = time.time() - t0
+        gc.collect()
+        rss1 = get_rss()
+        print '{0:>8}: {1} files, {2:.0f} bytes/node, built in {3:.2f} sec'.format(
+            name, nfiles, float(rss1 - rss0) / nfiles, dt)
+        if name == 'array':
+            t0 = time.time()
+            tree.total_sizes()
+            print '          total bytes per directory in {0:.3f} sec'.format(time.time() - t0)
+            print '          {0:.0f} bytes/node in the arrays'.format(float(tree.nbytes()) / nfiles)
+        sys.stdout.flush()
+        os._exit(0)
+
+def build_deep_tree(depth=60, nchains=20, filesperdir=20):
+    '''
+    Made up tree with nchains chains of directories depth levels deep,
+    and filesperdir files in each directory
+    '''
+    from filetree import RootTree, DirTree, FileNode
+
+    root = RootTree(name='/deep')
+    for c in xrange(nchains):
+        d = root
+        for level in xrange(depth):
+            sub = DirTree(name='dir{0:02d}_{1:03d}'.format(c, level), parent=d)
+            d.add_child(sub)
+            d = sub
+            for i in xrange(filesperdir):
+                d.add_child(FileNode('file{0:03d}.dat'.format(i), d, size=i))
+    return root
+
+def walk_lookup(tree, relpath):
+    '''Finds a node one path component at a time, the way Node.__getitem__ does'''
+    node = tree
+    for name in relpath.split('/'):
+        node = node.children[name]
+    return node
+
+def bench_paths(depth=60, nchains=20, filesperdir=20, nlookups=50000):
+    '''
+    Path lookups and abspaths in a deep tree, walking the tree and with
+    the path index and cached relpaths
+    '''
+    from filetree import Node
+
+    tree = build_deep_tree(depth, nchains, filesperdir)
+    files = [node for (_, node) in tree.iternodes() if node.isfile]
+    relpaths = [Node.relpath(node) for node in files]
+    rng = random.Random(0)
+    lookups = [rng.choice(relpaths) for i in xrange(nlookups)]
+    nodes = [rng.choice(files) for i in xrange(nlookups)]
+    print '{0} nodes, {1} levels deep'.format(len(files) + nchains*depth, depth)
+
+    def timeit(name, fcn, items):
+        t0 = time.time()
+        for item in items:
+            fcn(item)
+        dt = time.time() - t0
+        print '{0:>20}: {1:.3f} sec ({2:.1f} us each)'.format(name, dt, 1e6 * dt / len(items))
+
+    timeit('walk lookup', lambda p: walk_lookup(tree, p), lookups)
+    timeit('walk abspath', Node.abspath, nodes)
+
+    t0 = time.time()
+    tree.get_paths()
+    print '{0:>20}: {1:.3f} sec'.format('build index', time.time() - t0)
+    timeit('index lookup', tree.__getitem__, lookups)
+    timeit('cached abspath', lambda node: node.abspath(), nodes)
+
+def bench_diff(nfiles=200000):
+    '''
+    Compares two trees that differ in one file, with and without the
+    directory digests
+    '''
+    from comparisontree import ComparisonTree
+
+    base = build_node_tree(nfiles)
+    cur = build_node_tree(nfiles)
+    node = cur['dir000123/file00012345']
+    node.hashval = HASH_FUNCTION('changed').digest()
+
+    for usedigests in [False, True]:
+        t0 = time.time()
+        comp = ComparisonTree(base, cur, usedigests=usedigests)
+        dt = time.time() - t0
+        status = comp.get_status()
+        print '{0:>12}: {1:.3f} sec, modified: {2}'.format('digests' if usedigests else 'no digests',
+                                                         dt, [p for (p, _) in status['modified']])
+        if not usedigests:
+            #the first comparison with digests computes all of them
+            t0 = time.time()
+            base.content_digest()
+            cur.content_digest()
+            print '{0:>12}: {1:.3f} sec'.format('digest trees', time.time() - t0)
+
+def random_digest_table(n, name, ds=32):
+    from coverage import DigestTable
+
+    digests = np.frombuffer(os.urandom(n*ds), dtype='uint8').reshape((n, ds))
+    sizes = np.random.randint(1, 1024*1024, size=n)
+    return DigestTable(name, 'sha256', digests, sizes, np.arange(n))
+
+def bench_coverage(ndigests=5000000, nbackups=2):
+    '''
+    Coverage of a source catalog by backups that each have most of its
+    content, plus some of their own
+    '''
+    from coverage import DigestTable, Coverage
+
+    t0 = time.time()
+    source = random_digest_table(ndigests, 'source')
+    print '{0:>12}: {1:.3f} sec'.format('sort source', time.time() - t0)
+
+    backups = []
+    for i in xrange(nbackups):
+        extra = random_digest_table(ndigests // 10, 'extra')
+        keep = np.random.rand(ndigests) < 0.9
+        digests = np.concatenate([source.digests[keep], extra.digests]).view('uint8').reshape((-1, 32))
+        backups.append(DigestTable('backup{0}'.format(i), 'sha256', digests,
+                                   np.ones(len(digests)), np.arange(len(digests))))
+
+    t0 = time.time()
+    cov = Coverage(source, backups)
+    dt = time.time() - t0
+    print '{0:>12}: {1:.3f} sec for {2} digests against {3} backups'.format('coverage', dt, ndigests,
+                                                                          nbackups)
+    for line in cov.summary():
+        print line
+
+def add_exif_thumbnail(data, thumbdata, orientation=1):
+    '''
+    Inserts an EXIF segment with an orientation and an embedded thumbnail
+    just after the start of a JPEG
+    '''
+    #IFD0 has the orientation and points to IFD1, which points to the thumbnail
+    ifd0 = struct.pack('<H', 1) + struct.pack('<HHII', 0x0112, 3, 1, orientation) + struct.pack('<I', 26)
+    ifd1 = (struct.pack('<H', 2) + struct.pack('<HHII', 0x0201, 4, 1, 56) +
+            struct.pack('<HHII', 0x0202, 4, 1, len(thumbdata)) + struct.pack('<I', 0))
+    tiff = 'II*\x00' + struct.pack('<I', 8) + ifd0 + ifd1 + thumbdata
+    app1 = '\xff\xe1' + struct.pack('>H', len(tiff) + 8) + 'Exif\x00\x00' + tiff
+    return data[:2] + app1 + data[2:]
+
+def build_jpeg_files(path, nfiles=8, shape=(3000, 4000)):
+    '''
+    Makes photo sized JPEGs, half of them with an EXIF thumbnail big enough
+    to use
+    '''
+    import cv2
+
+    (rows, cols) = shape
+    (y, x) = np.mgrid[0:rows, 0:cols]
+    for i in xrange(nfiles):
+        im = np.dstack([(x * (i+1) // 16) % 256, (y // 8) % 256, ((x + y) // 32) % 256]).astype('uint8')
+        im += np.random.randint(0, 32, size=im.shape).astype('uint8')
+        data = cv2.imencode('.jpg', im)[1].tostring()
+        if i % 2 == 1:
+            small = cv2.resize(im, (320, 240), interpolation=cv2.INTER_AREA)
+            data = add_exif_thumbnail(data, cv2.imencode('.jpg', small)[1].tostring())
+        with open(os.path.join(path, 'photo{0:03d}.jpg'.format(i)), 'wb') as fid:
+            fid.write(data)
+
+def bench_thumbs(path):
+    '''
+    Compares making thumbnails from a full decode with the EXIF thumbnail
+    and reduced size decode fast paths
+    '''
+    import cv2
+    from thumbnail import Thumbnail_Image
+
+    filenames = sorted([fn for fn in list_files(path) if fn.lower().endswith(('.jpg', '.jpeg'))])
+    for fn in filenames:
+        with open(fn, 'rb') as fid:
+            fid.read()
+
+    def full(fn):
+        thumb = Thumbnail_Image(fn)
+        thumb.from_image(cv2.imread(fn))
+        thumb.method = 'full'
+        return thumb
+
+    def fast(fn):
+        thumb = Thumbnail_Image(fn)
+        thumb.from_file()
+        return thumb
+
+    for (name, fcn) in [('full decode', full), ('fast path', fast)]:
+        t0 = time.time()
+        thumbs = [fcn(fn) for fn in filenames]
+        dt = time.time() - t0
+        methods = defaultdict(int)
+        for thumb in thumbs:
+            methods[thumb.method] += 1
+        print '{0:>12}: {1:.2f} sec, {2:.1f} images/sec ({3})'.format(
+            name, dt, len(filenames) / max(dt, 1e-9),
+            ', '.join(['{0} {1}'.format(m, n) for (m, n) in sorted(methods.items())]))
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if not argv:
+        print 'Usage: benchmark.py <test> [path]'
+        print 'Tests: scan, hash, mmap, catalog, nodes, paths, diff, coverage, thumbs'
+        return 1
+
+    test = argv[0]
+    if len(argv) > 1:
+        path = argv[1]
+        tmpdir = None
+    else:
+        tmpdir = tempfile.mkdtemp()
+        path = tmpdir
+
+    try:
+        if test == 'scan':
+            if tmpdir:
+                build_scan_tree(path)
+            bench_scan(path)
+        elif test == 'hash':
+            if tmpdir:
+                build_hash_files(path)
+            bench_hash(path)
+        elif test == 'mmap':
+            if tmpdir:
+                build_hash_files(path, nfiles=4, filesize=128*1024*1024)
+            bench_mmap(path)
+        elif test == 'catalog':
+            bench_catalog(path)
+        elif test == 'nodes':
+            bench_nodes()
+        elif test == 'paths':
+            bench_paths()
+        elif test == 'diff':
+            bench_diff()
+        elif test == 'coverage':
+            bench_coverage()
+        elif test == 'thumbs':
+            if tmpdir:
+                build_jpeg_files(path)
+            bench_thumbs(path)
+        else:
+            print 'Unknown test: {0}'.format(test)
+            return 1
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1116 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Columnar catalog layout.  Instead of one HDF5 group per file, the catalog
+is a set of chunked, compressed datasets with one row per file or
+directory, which is much faster to write and to reopen for big trees.
+The files that a scan quarantined can be listed and cleared with
+    python catalog.py <catalog.h5> [--clear [path ...]]
+"""
+
+import sys, os, time
+import argparse
+import logging
+from collections import defaultdict
+import h5py
+import numpy as np
+
+from hashing import HashStage, DEFAULT_ALGORITHM, get_hash_function, get_digest_size, digests_equal, \
+    dir_item, file_item, dir_digest, digest_to_array, digest_keys, digest_voids, sort_digests
+from thumbnail import get_thumbnail_type
+
+#group that holds a columnar catalog.  It's a soft link to one of two
+#copies, and flush() writes the other one and then points the link at it.
+CATALOG_GROUP = 'CATALOG'
+CATALOG_COPIES = ('CATALOG.0', 'CATALOG.1')
+LAYOUT_VERSION = 1
+#rows in each chunk of the datasets
+CHUNK_ROWS = 4096
+COMPRESSION = 'gzip'
+#bytes in each chunk of the thumbnail store, which isn't compressed, since
+#the thumbnails are JPEGs
+THUMB_CHUNK = 64*1024
+#thumbnails closer than this in the store are read together
+THUMB_GAP = 64*1024
+#the thumbnail store is packed again when more than this fraction of it
+#isn't used by any row
+THUMB_GARBAGE = 0.5
+
+#bits in the Flags column
+HAS_HASH = 1
+HAS_SAMPLE = 2
+HAS_SECONDHASH = 4
+IS_DELETED = 8
+#directory rows keep their Merkle digest in the Hash column
+HAS_DIGEST = 16
+#the file changed after its hash was written, so its thumbnail can't be
+#shared by digest until the new hash comes in
+NEW_CONTENT = 32
+
+class FileType:
+    File, Dir, Link = range(3)
+
+    @staticmethod
+    def get_name(num):
+        name = [nm1 for (nm1,num1) in FileType.__dict__.iteritems() if num1 == num]
+        if len(name) == 1:
+            return name[0]
+        else:
+            raise TypeError
+
+    @staticmethod
+    def get_num(name):
+        return FileType.__dict__[name]
+
+def same_time(t1, t2):
+    '''Times from the catalog, where nan is a time that isn't known'''
+    return t1 == t2 or (np.isnan(t1) and np.isnan(t2))
+
+class Column(object):
+    '''
+    Growable numpy array for one column of the catalog
+    '''
+
+    def __init__(self, dtype, shape=(), data=None, fill=0):
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.fill = fill
+        if data is None:
+            data = np.zeros((0,) + self.shape, dtype=self.dtype)
+        self.data = np.asarray(data, dtype=self.dtype)
+        self.n = len(self.data)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def __setitem__(self, i, value):
+        self.data[i] = value
+
+    def append(self, value=None):
+        if self.n == len(self.data):
+            newdata = np.empty((max(1024, 2*self.n),) + self.shape, dtype=self.dtype)
+            newdata[:self.n] = self.data[:self.n]
+            self.data = newdata
+        if value is None:
+            value = self.fill
+        self.data[self.n] = value
+        self.n += 1
+        return self.n - 1
+
+    def values(self):
+        return self.data[:self.n]
+
+class CatalogItem(object):
+    '''
+    Data for one row, with the same names as filedata.FileData
+    '''
+
+    def __init__(self):
+        self.type = None
+        self.size = None
+        self.modified = None
+        self.mimetp = None
+        self.hashstage = None
+        self.sample = None
+        self.hashval = None
+        self.isthumbnail = False
+        self.dev = None
+        self.inode = None
+        self.ctime = None
+
+class ColumnCatalog(object):
+    '''
+    Reads and writes a columnar catalog.  The whole catalog is loaded into
+    memory, updated there, and written back by flush().  flush() writes
+    over the older of two copies in the file, and only switches to it once
+    it's finished, so if it's killed, the catalog from the last flush is
+    still there.
+
+    Each row is a file or directory, with its Name and the row of its Parent
+    directory.  Row 0 is the root.  Deleted files that had a hash are kept,
+    with no parent, and their whole relative path as their Name.  Each row
+    has the current digest in Hash, and the History tables have all of the
+    digests each file has had, with their dates.  Block manifests are stored
+    in a shared table, with the start and count for each row.  Thumbnails
+    are stored once for each content digest, in ThumbData, and read from
+    the file when they're needed.  Rows have the start and count of their
+    parts in ThumbParts, which has the offset and length of each one.  The
+    size of the original, and the frame count and rate of videos, are in
+    ThumbSize, ThumbFrames and ThumbFPS.
+    Directories have their Merkle digest (see hashing.dir_digest) in Hash,
+    which is brought up to date by flush().  DigestIndex has the rows of
+    the hashed files sorted by digest, so all of the copies of a file can
+    be found with a binary search.  flush() updates it for the rows whose
+    hashes changed.  Files also have the Device, Inode and CTime they had
+    on disk (Inode is 0 if it isn't known), so renamed and hard linked
+    files can be recognized without hashing them again.  Files that made a
+    hash or thumbnail worker hang or crash are quarantined, with the
+    reason, so later scans skip them until they change.
+    '''
+
+    def __init__(self, h5file):
+        self.h5file = h5file
+        self.rootpath = None
+        self.algorithm = DEFAULT_ALGORITHM
+        self.secondary = None
+        self.hashblocksize = None
+
+    @staticmethod
+    def exists(h5file):
+        return CATALOG_GROUP in h5file or ColumnCatalog.find_copy(h5file) is not None
+
+    @staticmethod
+    def find_copy(h5file):
+        '''
+        Name of the newest finished copy of the catalog, for when the link
+        to it is missing because a flush was interrupted while it was
+        moving the link
+        '''
+        copies = [(h5file[name].attrs.get('Generation', -1), name) for name in CATALOG_COPIES
+                  if name in h5file]
+        copies = [(generation, name) for (generation, name) in copies if generation >= 0]
+        if not copies:
+            return None
+        return max(copies)[1]
+
+    @staticmethod
+    def create(h5file, rootpath, algorithm=None, secondary=None, hashblocksize=None):
+        catalog = ColumnCatalog(h5file)
+        catalog.rootpath = rootpath
+        if algorithm is None:
+            algorithm = DEFAULT_ALGORITHM
+        get_hash_function(algorithm)
+        catalog.algorithm = algorithm
+        if secondary is not None:
+            get_hash_function(secondary)
+        catalog.secondary = secondary
+        catalog.hashblocksize = hashblocksize
+        catalog.init_columns({})
+
+        catalog.add_row('', -1, FileType.Dir)
+        catalog.flush()
+        return catalog
+
+    @staticmethod
+    def get_group(h5file):
+        '''The group with the current catalog'''
+        if CATALOG_GROUP in h5file:
+            return h5file[CATALOG_GROUP]
+        return h5file[ColumnCatalog.find_copy(h5file)]
+
+    @staticmethod
+    def open(h5file):
+        if CATALOG_GROUP not in h5file and h5file.mode != 'r':
+            h5file[CATALOG_GROUP] = h5py.SoftLink('/' + ColumnCatalog.find_copy(h5file))
+        catalog = ColumnCatalog(h5file)
+        catalog.load()
+        return catalog
+
+    def init_columns(self, data):
+        '''
+        Sets up the in memory columns, from the datasets in data if they're there
+        '''
+        ds = get_digest_size(self.algorithm)
+        self.names = list(data.get('Name', []))
+        n = len(self.names)
+        self.columns = {'Parent': Column('int64', data=data.get('Parent'), fill=-1),
+                        'Type': Column('int8', data=data.get('Type')),
+                        'Flags': Column('uint8', data=data.get('Flags')),
+                        'Size': Column('int64', data=data.get('Size')),
+                        'Modified': Column('float64', data=data.get('Modified'), fill=np.nan),
+                        'MimeType': Column('int16', data=data.get('MimeType'), fill=-1),
+                        'HashStage': Column('int8', data=data.get('HashStage'), fill=-1),
+                        'Hash': Column('uint8', (ds,), data=data.get('Hash')),
+                        'SampleHash': Column('uint8', (ds,), data=data.get('SampleHash')),
+                        'LeafStart': Column('int64', data=data.get('LeafStart')),
+                        'LeafCount': Column('int64', data=data.get('LeafCount')),
+                        'ThumbStart': Column('int64', data=data.get('ThumbStart')),
+                        'ThumbCount': Column('int16', data=data.get('ThumbCount')),
+                        #older catalogs don't have these
+                        'Device': Column('uint64', data=data.get('Device', np.zeros(n))),
+                        'Inode': Column('uint64', data=data.get('Inode', np.zeros(n))),
+                        'CTime': Column('float64', data=data.get('CTime', np.full(n, np.nan)), fill=np.nan),
+                        #what the thumbnail's to_info returns (see thumbnail.py), with
+                        #0, -1 and nan for the ones it doesn't have
+                        'ThumbSize': Column('int64', (2,), data=data.get('ThumbSize', np.zeros((n, 2)))),
+                        'ThumbFrames': Column('int64', data=data.get('ThumbFrames', np.full(n, -1)), fill=-1),
+                        'ThumbFPS': Column('float64', data=data.get('ThumbFPS', np.full(n, np.nan)), fill=np.nan)}
+        if self.secondary is not None:
+            ds2 = get_digest_size(self.secondary)
+            self.columns['SecondHash'] = Column('uint8', (ds2,), data=data.get('SecondHash'))
+        self.nrows = len(self.names)
+
+        self.mimetypes = list(data.get('MimeTypes', []))
+        self.mimeids = dict((m, i) for (i, m) in enumerate(self.mimetypes))
+
+        self.historyrow = Column('int64', data=data.get('HistoryRow'))
+        self.historyhash = Column('uint8', (ds,), data=data.get('HistoryHash'))
+        self.historydate = Column('int16', (9,), data=data.get('HistoryDate'))
+        #row -> index of its latest history entry
+        self.lasthistory = dict(zip(self.historyrow.values().tolist(), xrange(len(self.historyrow))))
+
+        self.leafdata = np.asarray(data.get('Leaves', np.zeros((0, ds))), dtype='uint8')
+        self.thumbparts = np.asarray(data.get('ThumbParts', np.zeros((0, 2))), dtype='int64')
+        #the dataset in the file, or None
+        self.thumbdata = data.get('ThumbData')
+        #block manifests and thumbnails that changed since the last flush
+        self.newleaves = {}
+        self.newthumbs = {}
+        self.removed = set()
+
+        self.index = defaultdict(dict)
+        parents = self.columns['Parent'].values()
+        for (row, (name, parent)) in enumerate(zip(self.names, parents)):
+            if parent >= 0:
+                self.index[parent][name] = row
+
+        #directories whose digests need to be computed again, including any
+        #from catalogs written before there were digests
+        isdir = self.columns['Type'].values() == FileType.Dir
+        nodigest = (self.columns['Flags'].values() & HAS_DIGEST) == 0
+        self.dirtydirs = set(np.flatnonzero(isdir & nodigest).tolist())
+
+        #catalogs written before there was an index get one at the next flush
+        if 'DigestIndex' in data:
+            self.digestindex = np.asarray(data['DigestIndex'], dtype='int64')
+        else:
+            self.digestindex = None
+        self.indexkeys = None
+        self.hashchanged = set()
+        self.inodeindex = None
+
+        #(relpath, stage) -> (reason, size, modified, ctime)
+        qpaths = data.get('QuarantinePath', [])
+        self.quarantine = dict(((path, stage), (reason, size, modified, ctime))
+                               for (path, stage, reason, size, modified, ctime) in
+                               zip(qpaths, data.get('QuarantineStage', []),
+                                   data.get('QuarantineReason', []), data.get('QuarantineSize', []),
+                                   data.get('QuarantineModified', []),
+                                   data.get('QuarantineCTime', np.full(len(qpaths), np.nan))))
+
+    def load(self):
+        gp = self.get_group(self.h5file)
+        assert(gp.attrs['Version'] <= LAYOUT_VERSION)
+        self.rootpath = gp.attrs['RootPath']
+        self.algorithm = gp.attrs['HashAlgorithm']
+        self.secondary = gp.attrs.get('SecondHashAlgorithm', None)
+        self.hashblocksize = gp.attrs.get('HashBlockSize', None)
+
+        #everything except the thumbnails, which are read when they're needed
+        data = dict((name, ds if name == 'ThumbData' else ds[:]) for (name, ds) in gp.iteritems())
+        self.init_columns(data)
+        logging.debug('Loaded catalog with %d rows', self.nrows)
+
+    def set_secondary(self, secondary):
+        '''Adds a second hash to a catalog that didn't have one'''
+        assert(self.secondary is None)
+        get_hash_function(secondary)
+        self.secondary = secondary
+        ds2 = get_digest_size(secondary)
+        self.columns['SecondHash'] = Column('uint8', (ds2,), data=np.zeros((self.nrows, ds2)))
+
+    def add_row(self, name, parent, ftype):
+        self.names.append(name)
+        for col in self.columns.itervalues():
+            col.append()
+        row = self.nrows
+        self.nrows += 1
+        self.columns['Parent'][row] = parent
+        self.columns['Type'][row] = ftype
+        if parent >= 0:
+            self.index[parent][name] = row
+            self.dirtydirs.add(parent)
+        if ftype == FileType.Dir:
+            self.dirtydirs.add(row)
+        return row
+
+    def children(self, row):
+        '''Dict of name -> row for the items in a directory'''
+        return self.index.get(row, {})
+
+    def relpath(self, row):
+        parts = []
+        while row > 0:
+            parts.append(self.names[row])
+            row = self.columns['Parent'][row]
+        parts.reverse()
+        return os.path.join(*parts) if parts else '.'
+
+    def lookup(self, relpath):
+        '''Row for a relative path, or None'''
+        row = 0
+        if relpath in ('', '.'):
+            return row
+        for name in relpath.split(os.sep):
+            row = self.children(row).get(name)
+            if row is None:
+                return None
+        return row
+
+    def require(self, relpath, ftype=None, parent=None):
+        '''
+        Row for a relative path, adding it and any directories above it
+        that aren't in the catalog.  If parent is given, relpath is just a
+        name in that directory.
+        '''
+        if parent is None:
+            if relpath in ('', '.'):
+                return 0
+            row = 0
+            names = relpath.split(os.sep)
+        else:
+            row = parent
+            names = [relpath]
+
+        for (i, name) in enumerate(names):
+            parent = row
+            row = self.children(parent).get(name)
+            if i < len(names)-1:
+                tp = FileType.Dir
+            else:
+                tp = ftype
+            if row is not None and tp is not None and \
+                    (tp == FileType.Dir) != (self.columns['Type'][row] == FileType.Dir):
+                #a file that's now a directory, or the other way around
+                self.delete(row)
+                row = None
+            if row is None:
+                if tp is None:
+                    tp = FileType.File
+                row = self.add_row(name, parent, tp)
+        return row
+
+    def delete(self, row):
+        '''
+        Removes an item.  Files with a hash are kept as deleted, so they can
+        be found again
+        '''
+        for child in self.children(row).values():
+            self.delete(child)
+        self.index.pop(row, None)
+
+        parent = self.columns['Parent'][row]
+        relpath = self.relpath(row)
+        if parent >= 0:
+            del self.index[parent][self.names[row]]
+            self.dirtydirs.add(parent)
+        self.dirtydirs.discard(row)
+
+        if self.columns['Type'][row] == FileType.File and self.columns['Flags'][row] & HAS_HASH:
+            self.hashchanged.add(row)
+            self.names[row] = relpath
+            self.columns['Parent'][row] = -1
+            self.columns['Flags'][row] |= IS_DELETED
+        else:
+            self.removed.add(row)
+
+    def move(self, row, parent, name):
+        '''
+        Moves a file to a new directory and name.  A file that was deleted
+        is brought back.
+        '''
+        assert(self.columns['Type'][row] == FileType.File)
+        oldparent = self.columns['Parent'][row]
+        if oldparent >= 0:
+            del self.index[oldparent][self.names[row]]
+            self.dirtydirs.add(oldparent)
+        self.names[row] = name
+        self.columns['Parent'][row] = parent
+        self.columns['Flags'][row] &= ~IS_DELETED
+        self.index[parent][name] = row
+        self.dirtydirs.add(parent)
+        self.hashchanged.add(row)
+
+    def add_deleted(self, relpath):
+        '''New row for a deleted file'''
+        row = self.add_row(relpath, -1, FileType.File)
+        self.columns['Flags'][row] = IS_DELETED
+        return row
+
+    def deleted(self):
+        '''Rows of the deleted files'''
+        return [row for row in np.flatnonzero(self.columns['Flags'].values() & IS_DELETED)
+                if row not in self.removed]
+
+    def add_quarantine(self, relpath, stage, reason):
+        '''
+        Quarantines a file for a stage of the scan ('hash', 'thumb' or
+        'hashthumb'), as long as it keeps the size, modification time and
+        ctime that it has now.  ctime changes with the permissions, too.
+        '''
+        row = self.lookup(relpath)
+        if row is None:
+            return
+        cols = self.columns
+        self.quarantine[(relpath, stage)] = (reason, cols['Size'][row], cols['Modified'][row],
+                                             cols['CTime'][row])
+
+    def is_quarantined(self, relpath, stages):
+        '''
+        True if the file is quarantined for any of the stages.  The
+        quarantine is dropped if the file changed since.
+        '''
+        row = None
+        for stage in stages:
+            entry = self.quarantine.get((relpath, stage))
+            if entry is None:
+                continue
+            if row is None:
+                row = self.lookup(relpath)
+            (reason, size, modified, ctime) = entry
+            if (row is not None and size == self.columns['Size'][row] and
+                    same_time(modified, self.columns['Modified'][row]) and
+                    same_time(ctime, self.columns['CTime'][row])):
+                return True
+            del self.quarantine[(relpath, stage)]
+        return False
+
+    def quarantined(self):
+        '''List of (relpath, stage, reason) for the quarantined files'''
+        return sorted((path, stage, entry[0]) for ((path, stage), entry) in self.quarantine.iteritems())
+
+    def clear_quarantine(self, relpath=None):
+        '''Lets a file (or all of them) be tried again.  Returns the number of entries cleared.'''
+        keys = [key for key in self.quarantine if relpath is None or key[0] == relpath]
+        for key in keys:
+            del self.quarantine[key]
+        return len(keys)
+
+    def get_mimetype_id(self, mimetp):
+        if mimetp not in self.mimeids:
+            self.mimeids[mimetp] = len(self.mimetypes)
+            self.mimetypes.append(mimetp)
+        return self.mimeids[mimetp]
+
+    def write(self, row, fd):
+        '''
+        Updates a row from a FileData.  Like FileDataWriter.write_data, only
+        the values that are set in fd are written.
+        '''
+        cols = self.columns
+        if cols['Parent'][row] >= 0:
+            self.dirtydirs.add(cols['Parent'][row])
+        if fd.type is not None:
+            cols['Type'][row] = fd.type
+        if fd.type in (FileType.Dir, FileType.Link):
+            return
+
+        changed = False
+        if fd.size is not None:
+            changed |= cols['Size'][row] != fd.size
+            cols['Size'][row] = fd.size
+        if fd.modified is not None:
+            modified = time.mktime(fd.modified)
+            changed |= cols['Modified'][row] != modified
+            cols['Modified'][row] = modified
+        if changed:
+            #the old thumbnail is of the old content
+            cols['ThumbCount'][row] = 0
+            self.newthumbs.pop(row, None)
+            if cols['Flags'][row] & HAS_HASH:
+                cols['Flags'][row] |= NEW_CONTENT
+        if fd.mimetp is not None:
+            cols['MimeType'][row] = self.get_mimetype_id(fd.mimetp)
+        if fd.inode is not None:
+            cols['Device'][row] = fd.dev
+            cols['Inode'][row] = fd.inode
+            cols['CTime'][row] = fd.ctime
+        if fd.hashstage is not None:
+            cols['HashStage'][row] = fd.hashstage
+            self.hashchanged.add(row)
+            if fd.sample is not None:
+                cols['SampleHash'][row] = fd.sample
+                cols['Flags'][row] |= HAS_SAMPLE
+            else:
+                cols['Flags'][row] &= ~HAS_SAMPLE
+            if fd.secondhash is None:
+                cols['Flags'][row] &= ~HAS_SECONDHASH
+        if fd.hashval is not None:
+            self.write_hash(row, fd.hashval)
+        if fd.leaves is not None:
+            self.newleaves[row] = fd.leaves
+        if fd.secondhash is not None:
+            cols['SecondHash'][row] = fd.secondhash
+            cols['Flags'][row] |= HAS_SECONDHASH
+        if fd.thumbnail is not None:
+            parts = fd.thumbnail.to_parts()
+            if parts is not None:
+                self.set_thumbnail_parts(row, parts, fd.thumbnail.to_info())
+
+    def write_hash(self, row, hashval, date=None):
+        '''
+        Sets the current digest, adding it to the history if it changed
+        '''
+        if date is None:
+            date = np.array(time.localtime(), dtype='int16')
+        ind = self.lasthistory.get(row)
+        if ind is None or not digests_equal(self.historyhash[ind], hashval):
+            logging.debug('Writing new hash for row %d', row)
+            ind = self.historyrow.append(row)
+            self.historyhash.append(hashval)
+            self.historydate.append(date)
+            self.lasthistory[row] = ind
+        else:
+            self.historydate[ind] = date
+        self.columns['Hash'][row] = hashval
+        self.columns['Flags'][row] |= HAS_HASH
+        self.columns['Flags'][row] &= ~NEW_CONTENT
+        self.hashchanged.add(row)
+        if self.columns['Parent'][row] >= 0:
+            self.dirtydirs.add(self.columns['Parent'][row])
+
+    def read(self, row, fd=None):
+        '''
+        Fills in a FileData (or a CatalogItem, if fd is None) from a row.
+        Like FileData.from_hdf5, hashval is only set if it's a full hash.
+        '''
+        if fd is None:
+            fd = CatalogItem()
+        cols = self.columns
+        fd.type = int(cols['Type'][row])
+        if fd.type == FileType.File:
+            flags = cols['Flags'][row]
+            fd.size = int(cols['Size'][row])
+            modified = cols['Modified'][row]
+            if not np.isnan(modified):
+                fd.modified = time.localtime(modified)
+            mimeid = cols['MimeType'][row]
+            if mimeid >= 0:
+                fd.mimetp = self.mimetypes[mimeid]
+            if cols['Inode'][row] > 0:
+                fd.dev = int(cols['Device'][row])
+                fd.inode = int(cols['Inode'][row])
+                fd.ctime = float(cols['CTime'][row])
+            stage = cols['HashStage'][row]
+            if stage >= 0:
+                fd.hashstage = int(stage)
+            if flags & HAS_SAMPLE:
+                fd.sample = cols['SampleHash'][row].copy()
+            if flags & HAS_HASH and fd.hashstage in (None, HashStage.Full):
+                fd.hashval = cols['Hash'][row].copy()
+            else:
+                fd.hashval = None
+            fd.isthumbnail = self.has_thumbnail(row)
+        return fd
+
+    def dir_item(self, row):
+        '''dir_digest item for a row'''
+        cols = self.columns
+        name = self.names[row]
+        ftype = cols['Type'][row]
+        if ftype == FileType.Dir:
+            return dir_item(name, 'D', cols['Hash'][row])
+        flags = cols['Flags'][row]
+        stage = cols['HashStage'][row]
+        if flags & HAS_HASH and stage in (-1, HashStage.Full):
+            hashval = cols['Hash'][row]
+        else:
+            hashval = None
+        modified = cols['Modified'][row]
+        return file_item(name, hashval, int(cols['Size'][row]),
+                         None if np.isnan(modified) else int(modified),
+                         islink=(ftype == FileType.Link))
+
+    def update_digests(self):
+        '''
+        Computes the digests of the directories that changed, and the ones
+        above them, from the bottom up
+        '''
+        parents = self.columns['Parent']
+        depth = {}
+        for row in self.dirtydirs:
+            while row >= 0 and row not in depth:
+                if row in self.removed:
+                    break
+                depth[row] = None
+                row = parents[row]
+
+        def get_depth(row):
+            d = 0
+            while row > 0:
+                row = parents[row]
+                d += 1
+            return d
+
+        hashfcn = get_hash_function(self.algorithm)
+        for row in sorted(depth, key=get_depth, reverse=True):
+            if self.columns['Type'][row] != FileType.Dir:
+                continue
+            items = [self.dir_item(child) for child in self.children(row).itervalues()]
+            self.columns['Hash'][row] = np.frombuffer(dir_digest(items, hashfcn), dtype='uint8')
+            self.columns['Flags'][row] |= HAS_DIGEST
+        self.dirtydirs = set()
+
+    def get_digest(self, row):
+        '''Merkle digest of a directory, as of the last flush'''
+        if self.columns['Flags'][row] & HAS_DIGEST:
+            return self.columns['Hash'][row].tostring()
+        return None
+
+    def indexable(self, rows):
+        '''The rows that belong in the digest index: files with a full hash'''
+        cols = self.columns
+        flags = cols['Flags'].values()[rows]
+        stage = cols['HashStage'].values()[rows]
+        keep = ((cols['Type'].values()[rows] == FileType.File) & ((flags & HAS_HASH) != 0) &
+                ((flags & IS_DELETED) == 0) & ((stage == -1) | (stage == HashStage.Full)) &
+                (cols['Parent'].values()[rows] >= 0))
+        if self.removed:
+            keep &= ~np.in1d(rows, list(self.removed))
+        return rows[keep]
+
+    def update_index(self):
+        '''
+        Brings the digest index up to date.  The rows whose hashes changed
+        are taken out and put back in place, unless there are so many that
+        sorting again is faster.
+        '''
+        hashes = self.columns['Hash'].values()
+        changed = np.array(sorted(self.hashchanged), dtype='int64')
+        if self.digestindex is None or len(changed) > len(self.digestindex) // 4:
+            rows = self.indexable(np.arange(self.nrows))
+            self.digestindex = rows[sort_digests(hashes[rows])]
+        elif len(changed) > 0:
+            index = self.digestindex[~np.in1d(self.digestindex, changed)]
+            new = self.indexable(changed)
+            new = new[sort_digests(hashes[new])]
+            keys = digest_keys(hashes[index])
+            newkeys = digest_keys(hashes[new])
+            pos = np.searchsorted(keys, newkeys)
+            at = np.minimum(pos, len(index) - 1)
+            if len(index) > 0 and np.any((keys[at] == newkeys) &
+                                         (digest_voids(hashes[index[at]]) != digest_voids(hashes[new]))):
+                #shares its first 8 bytes with a different digest, so it
+                #might not go at the start of the run
+                index = np.concatenate([index, new])
+                index = index[sort_digests(hashes[index])]
+            else:
+                index = np.insert(index, pos, new)
+            self.digestindex = index
+        self.indexkeys = None
+        self.hashchanged = set()
+
+    def get_digest_index(self):
+        '''Rows of the hashed files, sorted by digest'''
+        if self.digestindex is None or self.hashchanged:
+            self.update_index()
+        return self.digestindex
+
+    def find_digest(self, hashval):
+        '''Rows of all of the files whose digest is hashval'''
+        index = self.get_digest_index()
+        hashes = self.columns['Hash'].values()
+        if self.indexkeys is None:
+            self.indexkeys = digest_keys(hashes[index])
+        hashval = digest_to_array(hashval)
+        key = digest_keys(hashval.reshape((1, -1)))[0]
+        start = np.searchsorted(self.indexkeys, key, side='left')
+        stop = np.searchsorted(self.indexkeys, key, side='right')
+        return [row for row in index[start:stop] if digests_equal(hashes[row], hashval)]
+
+    def inode_rows(self, dev, inode):
+        '''
+        Rows of the files that were on device dev with this inode, as of
+        the first call since the catalog was loaded or flushed
+        '''
+        cols = self.columns
+        if self.inodeindex is None:
+            inodes = cols['Inode'].values()
+            rows = np.flatnonzero((inodes > 0) & (cols['Type'].values() == FileType.File))
+            self.inodeindex = rows[np.argsort(inodes[rows])]
+            self.inodekeys = inodes[self.inodeindex]
+        start = np.searchsorted(self.inodekeys, inode, side='left')
+        stop = np.searchsorted(self.inodekeys, inode, side='right')
+        return [row for row in self.inodeindex[start:stop] if cols['Device'][row] == dev]
+
+    def hardlinks(self):
+        '''Lists of the rows of files that are hard links to the same file'''
+        cols = self.columns
+        rows = np.flatnonzero((cols['Inode'].values() > 0) & (cols['Parent'].values() >= 0) &
+                              (cols['Type'].values() == FileType.File))
+        if self.removed:
+            rows = rows[~np.in1d(rows, list(self.removed))]
+        #only the inodes that show up more than once go in the dict
+        inodes = cols['Inode'].values()[rows]
+        order = np.argsort(inodes)
+        same = inodes[order][1:] == inodes[order][:-1]
+        repeated = np.zeros(len(rows), dtype=bool)
+        repeated[order[1:][same]] = True
+        repeated[order[:-1][same]] = True
+        groups = defaultdict(list)
+        for row in rows[repeated]:
+            groups[(cols['Device'][row], cols['Inode'][row])].append(row)
+        return [group for group in groups.itervalues() if len(group) > 1]
+
+    def get_secondhash(self, row):
+        if self.columns['Flags'][row] & HAS_SECONDHASH:
+            return self.columns['SecondHash'][row].copy()
+        return None
+
+    def get_history(self, row):
+        '''All of the digests for a row, oldest first, and their dates'''
+        ind = np.flatnonzero(self.historyrow.values() == row)
+        return self.historyhash.values()[ind], self.historydate.values()[ind]
+
+    def add_history(self, row, digests, dates):
+        '''Adds older digests (one per row of digests) and their dates'''
+        for (hashval, date) in zip(digests, dates):
+            self.write_hash(row, hashval, date)
+
+    def get_leaves(self, row):
+        '''Block manifest for a row, or None'''
+        if row in self.newleaves:
+            return self.newleaves[row]
+        n = self.columns['LeafCount'][row]
+        if n == 0:
+            return None
+        start = self.columns['LeafStart'][row]
+        return self.leafdata[start:start+n]
+
+    def has_thumbnail(self, row):
+        return row in self.newthumbs or self.columns['ThumbCount'][row] > 0
+
+    def read_thumbdata(self, ranges):
+        '''
+        Strings from the thumbnail store for a list of (offset, length).
+        Ranges that are close together are read with one read.
+        '''
+        result = [None] * len(ranges)
+        order = sorted(xrange(len(ranges)), key=lambda i: ranges[i][0])
+        i = 0
+        while i < len(order):
+            start = ranges[order[i]][0]
+            stop = start + ranges[order[i]][1]
+            j = i + 1
+            while j < len(order) and ranges[order[j]][0] <= stop + THUMB_GAP:
+                stop = max(stop, ranges[order[j]][0] + ranges[order[j]][1])
+                j += 1
+            data = self.thumbdata[start:stop]
+            for k in order[i:j]:
+                (off, length) = ranges[k]
+                result[k] = data[off-start:off-start+length].tostring()
+            i = j
+        return result
+
+    def get_thumbnail_parts(self, row):
+        return self.get_thumbnail_parts_rows([row])[0]
+
+    def get_thumbnail_parts_rows(self, rows):
+        '''Encoded thumbnail parts for each row, or None'''
+        result = [None] * len(rows)
+        ranges = []
+        owners = []
+        for (i, row) in enumerate(rows):
+            if row is None:
+                continue
+            if row in self.newthumbs:
+                result[i] = self.newthumbs[row]
+                continue
+            n = self.columns['ThumbCount'][row]
+            if n > 0:
+                start = self.columns['ThumbStart'][row]
+                ranges.extend(self.thumbparts[start:start+n].tolist())
+                owners.extend([i] * n)
+        for (i, part) in zip(owners, self.read_thumbdata(ranges)):
+            if result[i] is None:
+                result[i] = []
+            result[i].append(part)
+        return result
+
+    def set_thumbnail_parts(self, row, parts, info=None):
+        '''
+        Sets a row's thumbnail from its parts, and the info from the
+        thumbnail's to_info, if it's given
+        '''
+        self.newthumbs[row] = parts
+        if info is not None:
+            self.set_thumbnail_info(row, info)
+
+    def get_thumbnail_info(self, row):
+        '''What the row's thumbnail's to_info returned'''
+        cols = self.columns
+        info = {}
+        if cols['ThumbSize'][row].any():
+            info['Size'] = tuple(cols['ThumbSize'][row].tolist())
+        if cols['ThumbFrames'][row] >= 0:
+            info['NFrames'] = int(cols['ThumbFrames'][row])
+        if not np.isnan(cols['ThumbFPS'][row]):
+            info['FramesPerSec'] = float(cols['ThumbFPS'][row])
+        return info
+
+    def set_thumbnail_info(self, row, info):
+        cols = self.columns
+        cols['ThumbSize'][row] = info.get('Size', (0, 0))
+        cols['ThumbFrames'][row] = info.get('NFrames', -1)
+        cols['ThumbFPS'][row] = info.get('FramesPerSec', np.nan)
+
+    def get_thumbnail(self, row):
+        '''Thumbnail object for a row, or None'''
+        return self.get_thumbnails_rows([row])[0]
+
+    def get_thumbnails_rows(self, rows):
+        '''Thumbnail objects for a list of rows, with None for any that don't have one'''
+        thumbs = []
+        for (row, parts) in zip(rows, self.get_thumbnail_parts_rows(rows)):
+            thumbtype = get_thumbnail_type(self.names[row]) if parts is not None else None
+            if thumbtype is None:
+                thumbs.append(None)
+                continue
+            thumb = thumbtype()
+            thumb.from_parts(parts, self.get_thumbnail_info(row))
+            thumbs.append(thumb)
+        return thumbs
+
+    def get_thumbnails(self, relpaths):
+        '''
+        Thumbnail objects for a list of relative paths, with None for any
+        that aren't in the catalog or don't have one.  The thumbnails are
+        read together, so a whole directory takes a few reads.
+        '''
+        return self.get_thumbnails_rows([self.lookup(relpath) for relpath in relpaths])
+
+    def write_thumbdata(self, gp, data, offset):
+        '''Writes data into the thumbnail store at offset, dropping anything after it'''
+        if 'ThumbData' in gp:
+            ds = gp['ThumbData']
+        else:
+            ds = gp.create_dataset('ThumbData', shape=(0,), dtype='uint8', maxshape=(None,),
+                                   chunks=(THUMB_CHUNK,))
+        ds.resize((offset + len(data),))
+        if len(data) > 0:
+            ds[offset:] = data
+
+    def flush_thumbnails(self, gp, rows, data):
+        '''
+        Adds the new thumbnails to the store, and sets ThumbStart,
+        ThumbCount and ThumbParts in data for the rows that are kept.  Files
+        with the same content share one copy.  New thumbnails are appended,
+        and the store is only packed again when too much of it is unused.
+        '''
+        cols = self.columns
+        starts = data['ThumbStart']
+        counts = data['ThumbCount']
+        newrow = -np.ones(self.nrows, dtype='int64')
+        newrow[rows] = np.arange(len(rows))
+
+        stage = cols['HashStage'].values()[rows]
+        flags = cols['Flags'].values()[rows]
+        hashed = (((flags & (HAS_HASH | NEW_CONTENT)) == HAS_HASH) &
+                  ((stage == -1) | (stage == HashStage.Full)))
+        hashes = cols['Hash'].values()[rows]
+
+        #thumbnails already in the store, by digest
+        shared = {}
+        for i in np.flatnonzero(hashed & (counts > 0)):
+            if rows[i] in self.newthumbs:
+                continue
+            key = hashes[i].tostring()
+            if key in shared:
+                (starts[i], counts[i]) = shared[key]
+            else:
+                shared[key] = (starts[i], counts[i])
+
+        nstored = len(self.thumbdata) if self.thumbdata is not None else 0
+        ndata = nstored
+        parts = self.thumbparts.tolist()
+        newdata = []
+        for row in sorted(self.newthumbs):
+            i = newrow[row]
+            if i < 0:
+                continue
+            key = hashes[i].tostring() if hashed[i] else None
+            if key in shared:
+                (starts[i], counts[i]) = shared[key]
+                continue
+            starts[i] = len(parts)
+            counts[i] = len(self.newthumbs[row])
+            for part in self.newthumbs[row]:
+                parts.append((ndata, len(part)))
+                newdata.append(np.frombuffer(part, dtype='uint8'))
+                ndata += len(part)
+            if key is not None:
+                shared[key] = (starts[i], counts[i])
+        parts = np.array(parts, dtype='int64').reshape((-1, 2))
+
+        refs = set(zip(starts[counts > 0].tolist(), counts[counts > 0].tolist()))
+        used = sum([parts[start:start+n, 1].sum() for (start, n) in refs])
+        #the current copy of the catalog shares the store with this one,
+        #and doesn't use anything past its old end
+        if 'ThumbData' in gp:
+            del gp['ThumbData']
+        if ndata - used <= THUMB_GARBAGE * ndata:
+            if self.thumbdata is not None:
+                gp['ThumbData'] = self.thumbdata
+            if newdata:
+                self.write_thumbdata(gp, np.concatenate(newdata), nstored)
+            data['ThumbParts'] = parts
+            return
+
+        #pack the ones that are used in row order, so the thumbnails in a
+        #directory are next to each other
+        logging.debug('Packing thumbnails: %d of %d bytes used', used, ndata)
+        stored = self.thumbdata[:] if nstored > 0 else np.zeros((0,), dtype='uint8')
+        alldata = np.concatenate([stored] + newdata)
+        packed = []
+        packedparts = []
+        npacked = 0
+        moved = {}
+        for i in np.flatnonzero(counts > 0):
+            ref = (starts[i], counts[i])
+            if ref not in moved:
+                moved[ref] = (len(packedparts), counts[i])
+                for (off, length) in parts[ref[0]:ref[0]+ref[1]]:
+                    packedparts.append((npacked, length))
+                    packed.append(alldata[off:off+length])
+                    npacked += length
+            (starts[i], counts[i]) = moved[ref]
+        if packed:
+            packed = np.concatenate(packed)
+        else:
+            packed = np.zeros((0,), dtype='uint8')
+        self.write_thumbdata(gp, packed, 0)
+        data['ThumbParts'] = np.array(packedparts, dtype='int64').reshape((-1, 2))
+
+    def write_column(self, gp, name, data, dtype=None):
+        if dtype is None:
+            data = np.asarray(data)
+            dtype = data.dtype
+        shape = (len(data),) + np.shape(data)[1:]
+        if name in gp:
+            ds = gp[name]
+            ds.resize(shape)
+        else:
+            chunks = (CHUNK_ROWS,) + shape[1:]
+            ds = gp.create_dataset(name, shape=shape, dtype=dtype, maxshape=(None,) + shape[1:],
+                                   chunks=chunks, compression=COMPRESSION, shuffle=True)
+        if len(data) > 0:
+            ds[...] = data
+
+    def flush(self):
+        '''
+        Writes the catalog to the file, dropping the removed rows.  It's
+        written over the older copy, which is then made the current one.
+        '''
+        self.update_digests()
+        self.update_index()
+
+        keep = np.ones(self.nrows, dtype=bool)
+        keep[list(self.removed)] = False
+        rows = np.flatnonzero(keep)
+        newrow = -np.ones(self.nrows, dtype='int64')
+        newrow[rows] = np.arange(len(rows))
+
+        current = self.h5file.get(CATALOG_GROUP, getlink=True)
+        if isinstance(current, h5py.SoftLink):
+            copy = [name for name in CATALOG_COPIES if '/' + name != current.path][0]
+            generation = self.h5file[CATALOG_GROUP].attrs['Generation'] + 1
+        else:
+            #a new catalog, or one from before there were two copies
+            copy = CATALOG_COPIES[0]
+            generation = 1
+        gp = self.h5file.require_group(copy)
+        #it isn't finished until it has its generation
+        gp.attrs['Generation'] = -1
+        gp.attrs['Version'] = LAYOUT_VERSION
+        gp.attrs['RootPath'] = self.rootpath
+        gp.attrs['HashAlgorithm'] = self.algorithm
+        if self.secondary is not None:
+            gp.attrs['SecondHashAlgorithm'] = self.secondary
+        if self.hashblocksize:
+            gp.attrs['HashBlockSize'] = self.hashblocksize
+
+        data = dict((name, col.values()[rows]) for (name, col) in self.columns.iteritems())
+        parents = data['Parent']
+        data['Parent'] = np.where(parents >= 0, newrow[parents], -1)
+        data['DigestIndex'] = newrow[self.digestindex]
+
+        #pack the block manifests again
+        ds = get_digest_size(self.algorithm)
+        leaves = []
+        nleaves = 0
+        for (i, row) in enumerate(rows):
+            rowleaves = self.get_leaves(row)
+            if rowleaves is not None:
+                data['LeafStart'][i] = nleaves
+                data['LeafCount'][i] = len(rowleaves)
+                leaves.append(rowleaves)
+                nleaves += len(rowleaves)
+            else:
+                data['LeafStart'][i] = data['LeafCount'][i] = 0
+        if leaves:
+            data['Leaves'] = np.concatenate(leaves)
+        else:
+            data['Leaves'] = np.zeros((0, ds), dtype='uint8')
+        self.flush_thumbnails(gp, rows, data)
+
+        histrows = self.historyrow.values()
+        keephist = np.flatnonzero(keep[histrows])
+        data['HistoryRow'] = newrow[histrows[keephist]]
+        data['HistoryHash'] = self.historyhash.values()[keephist]
+        data['HistoryDate'] = self.historydate.values()[keephist]
+
+        for (name, values) in data.iteritems():
+            self.write_column(gp, name, values)
+        strtype = h5py.special_dtype(vlen=str)
+        self.write_column(gp, 'Name', np.array([self.names[row] for row in rows], dtype=object), dtype=strtype)
+        self.write_column(gp, 'MimeTypes', np.array(self.mimetypes, dtype=object), dtype=strtype)
+
+        #only for the files that are still here
+        quarantine = sorted((path, stage) + entry for ((path, stage), entry) in self.quarantine.iteritems()
+                            if self.lookup(path) is not None)
+        (qpaths, qstages, qreasons, qsizes, qmodified, qctime) = zip(*quarantine) if quarantine else ([],) * 6
+        self.write_column(gp, 'QuarantinePath', np.array(qpaths, dtype=object), dtype=strtype)
+        self.write_column(gp, 'QuarantineStage', np.array(qstages, dtype=object), dtype=strtype)
+        self.write_column(gp, 'QuarantineReason', np.array(qreasons, dtype=object), dtype=strtype)
+        self.write_column(gp, 'QuarantineSize', np.array(qsizes, dtype='int64'))
+        self.write_column(gp, 'QuarantineModified', np.array(qmodified, dtype='float64'))
+        self.write_column(gp, 'QuarantineCTime', np.array(qctime, dtype='float64'))
+
+        #this copy has to be on disk before the link is moved to it
+        self.h5file.flush()
+        gp.attrs['Generation'] = generation
+        if current is not None:
+            del self.h5file[CATALOG_GROUP]
+        self.h5file[CATALOG_GROUP] = h5py.SoftLink('/' + copy)
+        self.h5file.flush()
+
+        #start over from what's in the file, so the rows are numbered the same
+        #way as on disk
+        self.init_columns(dict(data, Name=[self.names[row] for row in rows],
+                               MimeTypes=self.mimetypes, ThumbData=gp.get('ThumbData'),
+                               QuarantinePath=qpaths, QuarantineStage=qstages, QuarantineReason=qreasons,
+                               QuarantineSize=qsizes, QuarantineModified=qmodified,
+                               QuarantineCTime=qctime))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='List the files that scans of a catalog skip, '
+                                                 'because they made a worker hang or crash')
+    parser.add_argument('catalog', help='catalog file')
+    parser.add_argument('--clear', nargs='*', metavar='PATH',
+                        help='let the next scan try these relative paths again (default all of them)')
+    args = parser.parse_args(argv)
+
+    with h5py.File(args.catalog, 'a' if args.clear is not None else 'r') as h5file:
+        if not ColumnCatalog.exists(h5file):
+            print 'No columnar catalog in {0}'.format(args.catalog)
+            return 1
+        catalog = ColumnCatalog.open(h5file)
+        if args.clear is not None:
+            ncleared = 0
+            for path in (args.clear or [None]):
+                ncleared += catalog.clear_quarantine(path)
+            catalog.flush()
+            print 'Cleared {0} entries'.format(ncleared)
+        else:
+            quarantined = catalog.quarantined()
+            for (path, stage, reason) in quarantined:
+                print '{0} ({1}): {2}'.format(path, stage, reason)
+            print '{0} quarantined'.format(len(quarantined))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
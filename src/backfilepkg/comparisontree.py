@@ -5,16 +5,20 @@ Created on May 21, 2012
 '''
 
 import sys, time
-from filetree import Node, FileNode, DirTree, TIME_FORMAT
-from collections import defaultdict
+from filetree import Node, FileNode, DirTree, TIME_FORMAT, contents_match
+from collections import defaultdict, deque
 
 class ComparisonNode(Node):
     '''
     Hierarchical structure to compare two trees.
     '''
     
+    root = None
     state = None
     nodes = None
+    #True for a directory that was found to be clean by its digest, without
+    #comparing anything below it
+    digestmatch = False
     
     def __init__(self, name=None, parent=None, state=None, nodes=None):
         self.name = name
@@ -23,10 +27,12 @@ class ComparisonNode(Node):
         self.nodes = nodes
         self.children = dict()
         
-    def compare(self, base,cur):
+    def compare(self, base, cur, usedigests=True):
         '''
         Compares trees base and cur to each other.
-        Does not look for moved files/directories
+        Does not look for moved files/directories.
+        If usedigests is True, directories with the same Merkle digest are
+        marked clean as a whole, with no children (see expand).
         '''
         if not cur:
             self.name = base.name
@@ -66,17 +72,22 @@ class ComparisonNode(Node):
                 if base.children:
                     for (name, node) in base.children.iteritems():
                         comp1 = ComparisonNode(name, parent=self, nodes=(node, None), state='removed')
+                        comp1.compare(node, None)
                         self.children[name] = comp1
                 
                 if cur.children:
                     for (name, node) in cur.children.iteritems():
                         comp1 = ComparisonNode(name, parent=self, nodes=(None, node), state='added')
+                        comp1.compare(None, node)
                         self.children[name] = comp1
+            elif usedigests and contents_match(base, cur):
+                self.state = 'clean'
+                self.digestmatch = True
             else:
                 for (name, node) in base.children.iteritems():
                     comp1 = ComparisonNode(name=name, parent=self)
                     if name in cur.children:
-                        comp1.compare(node, cur.children[name])
+                        comp1.compare(node, cur.children[name], usedigests)
                     else:
                         comp1.compare(node, None)
                     self.children[name] = comp1
@@ -87,10 +98,29 @@ class ComparisonNode(Node):
                         comp1.compare(None, node)
                         self.children[name] = comp1
 
+    def expand(self):
+        '''
+        Fills in the comparison below directories that were matched by
+        their digests
+        '''
+        for (_, node) in list(self.iternodes()):
+            if node.digestmatch:
+                node.digestmatch = False
+                node.state = None
+                node.compare(node.nodes[0], node.nodes[1], usedigests=False)
+
     def get_update_hashes(self, checkhashes, checkmoved):
-        '''Get file nodes that need to have hash values calculated'''
+        '''
+        Get file nodes that need to have hash values calculated.
+        If you only need them to check for moved files, use
+        filetree.update_hashes(nodes, staged=True), which skips files that
+        can't match anything.
+        '''
         basehash = set()
         righthash = set()
+        if checkhashes in ['all','clean']:
+            #the files in clean directories need to be checked too
+            self.expand()
         if checkmoved or checkhashes in ['all','clean']:
             for (name, node) in self.iternodes():
                 ishash = [n and n.isfile and bool(n.hashval) for n in node.nodes]
@@ -120,109 +150,80 @@ class ComparisonNode(Node):
                     self.state = 'modified'
                     
     def check_moved(self):
-        #directories are bit trickier, because we don't have a simple measure of
-        #equality
-        
-        #track down the order 1 directories
-        basedirs = []
-        curdirs = []
-        for (_, dirs, _) in self.walk():
-            basedirs += [node for node in dirs if node.isorder(1) and node.state == 'removed']
-            curdirs += [node for node in dirs if node.isorder(1) and node.state == 'added']
-
-        #first we'll compare the order 1 directories, then their parents, and so forth
-        for based in basedirs:
-            curmatch = None
-            for curd in curdirs:
-                (basepar, curpar) = (based, curd)
-                basematch = None
-                ae = None
-                while basepar is not curpar and basepar.nodes[0].checkequal(curpar.nodes[1], ae):
-                    basematch = basepar
-                    ae = basematch.nodes[0]
-                    curmatch = curpar
-                    basepar = basepar.parent
-                    curpar = curpar.parent
-                if curmatch:
-                    break
-
-            if curmatch:
-                curdirs.remove(curd)
-                
-                matchdir = MovedNode(nodes=(basematch.nodes[0], curmatch.nodes[1]), oldparent=basematch.parent, newparent=curmatch.parent)
-                matchdir.children = basematch.children
-                for ((basename, basecomp), (curname, curcomp)) in zip(basematch.iternodes(), curmatch.iternodes()):
-                    if basecomp is not basematch:
-                        basecomp.state = 'clean'
-                        basecomp.nodes = (basecomp.nodes[0], curcomp.nodes[1])
-                        
-                basepar.children[basematch.name] = matchdir
-                del(curpar.children[curmatch.name])
-                    
-        #now look for moved/renamed files/dirs
-        basehashes = defaultdict(list)
-        curhashes = defaultdict(list)
-        for (name, comp) in self.iternodes():
-            if comp.state == 'removed' and comp.isfile: 
-                basehashes[comp.nodes[0].hashval].append(comp)
-            elif comp.state == 'added' and comp.isfile:
-                curhashes[comp.nodes[1].hashval].append(comp)
-        
-        for (hashval, comp) in basehashes.iteritems():
-            if (hashval in curhashes) and (len(comp) == 1) and (len(curhashes[hashval]) == 1):
-                basenode = comp[0]
-                curnode = curhashes[hashval][0]
-                matchfile = MovedNode((basenode.nodes[0], curnode.nodes[1]), basenode.parent, curnode.parent)
-                
-                basenode.parent.children[basenode.name] = matchfile
-                del(curnode.parent.children[curnode.name])
+        '''
+        Replaces removed and added items that match with MovedNodes.  See
+        MoveDetector.
+        '''
+        MoveDetector(self).run()
     
     def update_base(self, remove=False, add=False):
+        '''
+        Applies the changes to the base tree and returns it.  Each directory
+        is changed through its own base node, so the changes below a moved
+        directory (for a partial move) are made wherever it goes, and the
+        moves are done last, once the directories they go to have been added.
+        '''
         basetree = self.nodes[0]
         if self.state == 'added':
             basetree = self.nodes[1].duplicate()
         else:
+            moves = []
             for (root, dirs, files) in self.walk():
-                par = basetree[root.relpath()]
+                par = root.nodes[0]
                 nodes = dirs + files
                 
                 for node in nodes:
                     name = node.name
                     
                     if node.state == 'moved':
-                        basenode = node.nodes[0]
-                        #could be a rename
-                        basenode.name = node.newname
-                        
-                        #or a move (or both)
-                        oldparent = par
-                        newparent = basetree[node.newparent.relpath()] 
-                        if oldparent is not newparent:
-                            del(oldparent.children[name])
-                            newparent.children[node.newname] = basenode
-                            basenode.parent = newparent
+                        #could be a rename or a move (or both)
+                        moves.append(node)
                     elif node.state == 'typechange':
-                        n = node.nodes[1].duplicate()
-                        n.parent = par
-                        par.children[name] = n
+                        par.add_copy(node.nodes[1])
                     elif add and node.state == 'added':
-                        n = node.nodes[1].duplicate()
-                        n.parent = par
-                        par.children[name] = n
-                        if node.isdir:
-                            #all of the elements below an added directory are added also
-                            #and duplicate copies them all, so we don't need to walk into the directory
-                            dirs.remove(node)
+                        par.add_copy(node.nodes[1])
                     elif remove and node.state == 'removed':
-                        del(par[name])
+                        par.remove_child(name)
                     elif node.state == 'modified':
                         basenode = node.nodes[0]
                         basenode.update(node.nodes[1])
+                    
+                    if node.isdir and (node.nodes[0] is None or node.nodes[0].isfile):
+                        #all of the elements below an added directory are added also
+                        #and add_copy copies them all, so we don't need to walk into the directory.
+                        #removed ones are still walked, for anything that moved out of them
+                        dirs.remove(node)
+            
+            for node in moves:
+                basenode = node.nodes[0]
+                newparent = self.find_base(node.newparent)
+                if newparent is None:
+                    #it went to a directory that wasn't added
+                    continue
+                basenode.parent.move_child(basenode.name, newparent, node.newname)
         return basetree
     
+    def find_base(self, comp):
+        '''
+        The base directory that comparison directory comp is now, after the
+        added directories have been copied to the base tree, or None if
+        it's in one that wasn't
+        '''
+        names = []
+        while comp.nodes[0] is None or comp.nodes[0].isfile:
+            names.append(comp.name)
+            comp = comp.parent
+        node = comp.nodes[0]
+        for name in reversed(names):
+            node = node.children.get(name)
+            if node is None or node.isfile:
+                return None
+        return node
+    
     def get_modified_detail(self, node):
-        if node.nodes[0].hashval and node.nodes[1].hashval:
-            detail1 = 'hashes not equal ({0} != {1})'.format(node.nodes[0].hashval, node.nodes[1].hashval)
+        if node.nodes[0].hashval and node.nodes[1].hashval and \
+                node.nodes[0].get_hash_scheme() == node.nodes[1].get_hash_scheme():
+            detail1 = 'hashes not equal ({0} != {1})'.format(node.nodes[0].hexdigest(), node.nodes[1].hexdigest())
         elif node.nodes[0].size != node.nodes[1].size:
             detail1 = 'sizes not equal ({0} != {1})'.format(node.nodes[0].size, node.nodes[1].size)
         else:
@@ -259,16 +260,199 @@ class ComparisonTree(ComparisonNode):
     '''
     Wrapper class to set up comparisons
     '''
-    def __init__(self, base,cur):
+    def __init__(self, base, cur, usedigests=True):
         self.name = None
         self.parent = None
         self.state = None
         self.nodes = [base,cur]
         self.children = dict()
 
-        self.compare(base, cur)
+        self.compare(base, cur, usedigests)
              
+#a removed directory matches an added one without the same digest if more
+#than this fraction of their items are the same
+PARTIAL_MOVE_FRACTION = 0.5
+#item signatures that are in more added directories than this (e.g., empty
+#files) are too common to say anything about where a directory went
+MAX_POSTINGS = 64
+
+def comp_path(comp):
+    '''Relative path of the item a ComparisonNode is for'''
+    node = comp.nodes[0] if comp.nodes[0] is not None else comp.nodes[1]
+    return node.relpath()
+
+def item_signature(node):
+    '''
+    Signature of an item in a directory, for partial moves: the digest of
+    a subdirectory, the hash of a file, or a file's name and size if it
+    doesn't have a hash
+    '''
+    if node.isdir:
+        if hasattr(node, 'content_digest'):
+            return ('D', node.content_digest())
+        return ('D', node.name)
+    elif node.hashval is not None:
+        return ('F', node.hashval)
+    else:
+        return ('S', node.name, node.size)
+
+class CandidateIndex(object):
+    '''
+    Added items by key, in path order.  Items are taken from the front of
+    each queue, preferring one with the same name, so duplicates are paired
+    the same way every time.
+    '''
+
+    def __init__(self):
+        self.bykey = defaultdict(deque)
+        self.byname = defaultdict(deque)
+
+    def add(self, key, comp):
+        self.bykey[key].append(comp)
+        self.byname[(key, comp.name)].append(comp)
+
+    def pick(self, key, name, available):
+        for queue in (self.byname.get((key, name)), self.bykey.get(key)):
+            while queue and not available(queue[0]):
+                queue.popleft()
+            if queue:
+                return queue.popleft()
+        return None
+
+class MoveDetector(object):
+    '''
+    Finds moved and renamed items in a comparison.  The added items are
+    indexed by their contents and the removed ones are looked up in the
+    index, so the work goes with the number of changes, not the size of
+    the trees.  In order:
+      1. directories with the same digest (see filetree.contents_match)
+      2. directories where most of the items are the same, which become
+         MovedNodes with the comparison of the two directories below them
+      3. files with the same hash
+    Outer directories go first, so a moved tree is one move.  When several
+    items match, they're paired by name and then in path order.
+    '''
+
+    def __init__(self, comparison):
+        self.comparison = comparison
+        self.matched = set()
+
+    def run(self):
+        self.match_dirs()
+        self.match_partial_dirs()
+        self.match_files()
+
+    def changed(self, isdir):
+        '''Removed and added ComparisonNodes, outermost first, in path order'''
+        removed = []
+        added = []
+        for (_, comp) in self.comparison.iternodes():
+            if comp.isdir != isdir:
+                continue
+            if comp.state == 'removed':
+                removed.append(comp)
+            elif comp.state == 'added':
+                added.append(comp)
+        key = lambda comp: (comp.depth(), comp_path(comp))
+        return (sorted(removed, key=key), sorted(added, key=key))
+
+    def available(self, comp):
+        '''False if the item or a directory above it has already been matched'''
+        while comp is not None:
+            if comp in self.matched:
+                return False
+            comp = comp.parent
+        return True
+
+    def move(self, basecomp, curcomp, children=None):
+        self.matched.add(basecomp)
+        self.matched.add(curcomp)
+        moved = MovedNode((basecomp.nodes[0], curcomp.nodes[1]), basecomp.parent, curcomp.parent)
+        if children is not None:
+            moved.children = children
+            for comp in children.itervalues():
+                comp.parent = moved
+        basecomp.parent.children[basecomp.name] = moved
+        del(curcomp.parent.children[curcomp.name])
+        return moved
+
+    def dir_key(self, node):
+        #empty directories all have the same digest, so they're left alone
+        if not node.children or not hasattr(node, 'content_digest'):
+            return None
+        return (node.get_hash_scheme(), node.content_digest())
+
+    def match_dirs(self):
+        (removed, added) = self.changed(True)
+        index = CandidateIndex()
+        for comp in added:
+            key = self.dir_key(comp.nodes[1])
+            if key is not None:
+                index.add(key, comp)
+        
+        for comp in removed:
+            if not self.available(comp):
+                continue
+            key = self.dir_key(comp.nodes[0])
+            if key is None:
+                continue
+            match = index.pick(key, comp.name, self.available)
+            if match is not None:
+                self.move(comp, match)
+
+    def match_partial_dirs(self):
+        (removed, added) = self.changed(True)
+        postings = defaultdict(list)
+        for comp in added:
+            for node in comp.nodes[1].children.itervalues():
+                postings[item_signature(node)].append(comp)
+        
+        for comp in removed:
+            base = comp.nodes[0]
+            if not self.available(comp) or not base.children:
+                continue
+            votes = defaultdict(int)
+            for node in base.children.itervalues():
+                posting = postings.get(item_signature(node), ())
+                if len(posting) <= MAX_POSTINGS:
+                    for match in posting:
+                        votes[match] += 1
+            
+            best = None
+            for (match, nvotes) in votes.iteritems():
+                if not self.available(match):
+                    continue
+                score = float(nvotes) / max(len(base.children), len(match.nodes[1].children))
+                rank = (-score, match.name != comp.name, comp_path(match))
+                if score > PARTIAL_MOVE_FRACTION and (best is None or rank < best[0]):
+                    best = (rank, match)
+            
+            if best is not None:
+                match = best[1]
+                below = ComparisonNode(comp.name)
+                below.compare(base, match.nodes[1])
+                self.move(comp, match, below.children)
+
+    def match_files(self):
+        #files without a full hash (e.g., resolved by their size in staged hashing)
+        #can't have been moved
+        (removed, added) = self.changed(False)
+        index = CandidateIndex()
+        for comp in added:
+            node = comp.nodes[1]
+            if node.hashval is not None:
+                index.add((node.get_hash_scheme(), node.hashval), comp)
+        
+        for comp in removed:
+            node = comp.nodes[0]
+            if node.hashval is None:
+                continue
+            match = index.pick((node.get_hash_scheme(), node.hashval), comp.name, self.available)
+            if match is not None:
+                self.move(comp, match)
+
 class MovedNode(Node):
+    root = None
     state = 'moved'
     newname = None
     newparent = None
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Backup coverage between catalogs.  Only the digests and sizes of the hashed
+files are loaded from each catalog, and they're matched with sorted array
+operations, so catalogs with tens of millions of files can be compared
+without building any trees.  Run as
+    python coverage.py <source.h5> <backup.h5> [<backup.h5> ...]
+"""
+
+import sys
+import argparse
+import logging
+import numpy as np
+import h5py
+
+from hashing import HashStage, DEFAULT_ALGORITHM, get_digest_size, digest_keys, digest_voids, \
+    sort_digests, digest_to_array
+from catalog import FileType, ColumnCatalog, HAS_HASH
+
+#only this many paths are listed for each kind of content by default
+LIST_LIMIT = 20
+
+class DigestTable(object):
+    '''
+    Digests and sizes of the hashed files in one catalog, sorted by digest.
+    rows are the catalog rows the items came from (or the index into paths
+    for the groups layout), which are only turned into paths when needed.
+    order sorts the digests, if it's already known.  blocksize is the
+    catalog's HashBlockSize, for catalogs whose digests are the merkle roots
+    of block manifests, which can't be compared with plain digests.
+    '''
+
+    def __init__(self, filename, algorithm, digests, sizes, rows, paths=None, order=None, blocksize=None):
+        self.filename = filename
+        self.algorithm = algorithm
+        self.blocksize = blocksize
+        self.paths = paths
+
+        if order is None:
+            order = sort_digests(digests)
+        self.keys = digest_keys(digests)[order]
+        self.digests = digest_voids(digests)[order]
+        self.sizes = np.asarray(sizes, dtype='int64')[order]
+        self.rows = np.asarray(rows, dtype='int64')[order]
+
+        #first of each run of identical digests
+        self.first = np.ones(len(self), dtype=bool)
+        self.first[1:] = self.digests[1:] != self.digests[:-1]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def describe_hash(self):
+        if self.blocksize:
+            return '{0} of {1} byte blocks'.format(self.algorithm, self.blocksize)
+        return self.algorithm
+
+    def find(self, other):
+        '''
+        Index in this table of an item with the same digest as each item in
+        other, or -1
+        '''
+        if len(self) == 0:
+            return -np.ones(len(other), dtype='int64')
+        idx = np.searchsorted(self.keys, other.keys)
+        idx[idx == len(self)] = len(self) - 1
+        samekey = self.keys[idx] == other.keys
+        found = samekey & (self.digests[idx] == other.digests)
+
+        #same first 8 bytes but a different digest: check the rest of the run
+        for i in np.flatnonzero(samekey & ~found):
+            j = idx[i]
+            while j < len(self) and self.keys[j] == other.keys[i]:
+                if self.digests[j] == other.digests[i]:
+                    idx[i] = j
+                    found[i] = True
+                    break
+                j += 1
+
+        idx[~found] = -1
+        return idx
+
+    def find_digest(self, hashval):
+        '''Indices of the items whose digest is hashval'''
+        hashval = digest_to_array(hashval).reshape((1, -1))
+        key = digest_keys(hashval)[0]
+        start = np.searchsorted(self.keys, key, side='left')
+        stop = np.searchsorted(self.keys, key, side='right')
+        match = self.digests[start:stop] == digest_voids(hashval)[0]
+        return start + np.flatnonzero(match)
+
+    def contains(self, other):
+        '''True for each item in other whose content is in this table'''
+        return self.find(other) >= 0
+
+    def unique_bytes(self, mask=None):
+        '''Bytes of distinct content, optionally only for the items in mask'''
+        first = self.first if mask is None else self.first & mask
+        return int(self.sizes[first].sum())
+
+    def get_paths(self, items):
+        '''Relative paths for the items (indices into this table)'''
+        rows = self.rows[items]
+        if self.paths is not None:
+            return [self.paths[r] for r in rows]
+
+        with h5py.File(self.filename, 'r') as h5file:
+            gp = ColumnCatalog.get_group(h5file)
+            names = gp['Name'][:]
+            parents = gp['Parent'][:]
+
+        paths = []
+        for row in rows:
+            parts = []
+            while row > 0:
+                parts.append(names[row])
+                row = parents[row]
+            paths.append('/'.join(reversed(parts)))
+        return paths
+
+    @staticmethod
+    def from_columns(filename, gp):
+        '''Just the columns that are needed, for the live, fully hashed files'''
+        if 'DigestIndex' in gp:
+            #already sorted by digest
+            rows = gp['DigestIndex'][:]
+            order = np.arange(len(rows))
+        else:
+            ftype = gp['Type'][:]
+            flags = gp['Flags'][:]
+            stage = gp['HashStage'][:]
+            parents = gp['Parent'][:]
+            ishashed = ((ftype == FileType.File) & ((flags & HAS_HASH) != 0) &
+                        ((stage == -1) | (stage == HashStage.Full)) & (parents >= 0))
+            rows = np.flatnonzero(ishashed)
+            order = None
+
+        digests = gp['Hash'][:][rows]
+        sizes = gp['Size'][:][rows]
+        return DigestTable(filename, gp.attrs['HashAlgorithm'], digests, sizes, rows, order=order,
+                           blocksize=gp.attrs.get('HashBlockSize', None))
+
+    @staticmethod
+    def from_groups(filename, rootgp):
+        digests = []
+        sizes = []
+        paths = []
+
+        def visit(name, obj):
+            if not isinstance(obj, h5py.Group) or obj.attrs.get('Type') != FileType.get_name(FileType.File):
+                return
+            stage = obj.attrs.get('HashStage')
+            if 'Hash' not in obj or (stage is not None and HashStage.get_num(stage) != HashStage.Full):
+                return
+            digests.append(obj['Hash'][:, -1])
+            sizes.append(obj.attrs.get('Size', 0))
+            paths.append(name)
+
+        rootgp.visititems(visit)
+        algorithm = rootgp.attrs.get('HashAlgorithm', DEFAULT_ALGORITHM)
+        if digests:
+            digests = np.vstack(digests).astype('uint8')
+        else:
+            digests = np.zeros((0, get_digest_size(algorithm)), dtype='uint8')
+        return DigestTable(filename, algorithm, digests, sizes,
+                           np.arange(len(paths)), paths=paths,
+                           blocksize=rootgp.attrs.get('HashBlockSize', None))
+
+    @staticmethod
+    def from_hdf5(filename):
+        with h5py.File(filename, 'r') as h5file:
+            if ColumnCatalog.exists(h5file):
+                table = DigestTable.from_columns(filename, ColumnCatalog.get_group(h5file))
+            elif 'ROOT' in h5file:
+                table = DigestTable.from_groups(filename, h5file['ROOT'])
+            else:
+                raise ValueError('No catalog in {0}'.format(filename))
+        logging.debug('Loaded %d digests from %s', len(table), filename)
+        return table
+
+class Coverage(object):
+    '''
+    How well the content in a source catalog is covered by the backup
+    catalogs.  copies is the number of backups that have each source
+    item's content.  missing, duplicated and orphaned are index arrays: the
+    source items that aren't in any backup, the source items whose content
+    appears more than once in the source, and for each backup, the items
+    whose content isn't in the source.  The catalogs all have to use the
+    same hash algorithm and block size, or else the same content has
+    different digests, so a ValueError is raised.
+    '''
+
+    def __init__(self, source, backups):
+        for backup in backups:
+            if (backup.algorithm, backup.blocksize) != (source.algorithm, source.blocksize):
+                raise ValueError("Can't compare {0} ({1}) with {2} ({3}): the digests are made "
+                                 "differently".format(source.filename, source.describe_hash(),
+                                                      backup.filename, backup.describe_hash()))
+        self.source = source
+        self.backups = backups
+
+        self.covered = [backup.contains(source) for backup in backups]
+        self.copies = np.zeros(len(source), dtype='int32')
+        for covered in self.covered:
+            self.copies += covered
+        self.missing = np.flatnonzero(self.copies == 0)
+
+        #identical digests are next to each other, so an item is duplicated
+        #if it isn't the first of its run, or the next one isn't
+        first = source.first
+        dup = ~first
+        dup[:-1] |= ~first[1:]
+        self.duplicated = np.flatnonzero(dup)
+
+        self.orphaned = [np.flatnonzero(~source.contains(backup)) for backup in backups]
+
+    def summary(self):
+        source = self.source
+        lines = ['{0}: {1} files, {2} bytes of distinct content'.format(
+                     source.filename, len(source), source.unique_bytes())]
+        missing = self.copies == 0
+        lines.append('  missing from all backups: {0} files, {1} bytes'.format(
+            len(self.missing), source.unique_bytes(missing)))
+        lines.append('  duplicated within source: {0} files, {1} extra bytes'.format(
+            len(self.duplicated), int(source.sizes[~source.first].sum())))
+        total = source.unique_bytes()
+        for (backup, covered, orphaned) in zip(self.backups, self.covered, self.orphaned):
+            frac = float(source.unique_bytes(covered)) / total if total > 0 else 1.0
+            lines.append('  {0}: covers {1:.1%}, {2} files not in source'.format(
+                backup.filename, frac, len(orphaned)))
+        return lines
+
+def get_coverage(source, backups):
+    '''Coverage from catalog files'''
+    source = DigestTable.from_hdf5(source)
+    backups = [DigestTable.from_hdf5(fn) for fn in backups]
+    return Coverage(source, backups)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find content in a catalog that has no copy in the backups')
+    parser.add_argument('source', help='catalog of the files to back up')
+    parser.add_argument('backups', nargs='+', help='catalogs of the backups')
+    parser.add_argument('--list', choices=['missing', 'duplicated', 'orphaned'], action='append',
+                        default=[], help='list the paths of this kind of content')
+    parser.add_argument('--limit', type=int, default=LIST_LIMIT,
+                        help='list at most this many paths of each kind (0 for all)')
+    args = parser.parse_args(argv)
+
+    try:
+        cov = get_coverage(args.source, args.backups)
+    except ValueError as err:
+        print err
+        return 1
+    for line in cov.summary():
+        print line
+
+    limit = args.limit if args.limit > 0 else None
+    if 'missing' in args.list:
+        print 'Missing:'
+        for path in cov.source.get_paths(cov.missing[:limit]):
+            print '  ' + path
+    if 'duplicated' in args.list:
+        print 'Duplicated:'
+        for path in cov.source.get_paths(cov.duplicated[:limit]):
+            print '  ' + path
+    if 'orphaned' in args.list:
+        for (backup, orphaned) in zip(cov.backups, cov.orphaned):
+            print 'Only in {0}:'.format(backup.filename)
+            for path in backup.get_paths(orphaned[:limit]):
+                print '  ' + path
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
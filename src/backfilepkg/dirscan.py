@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Directory scanning core shared by FileDataWriter and DirTree.
+Built on scandir, so the file type comes from d_type when the file system
+provides it, and each file costs at most one lstat.
+"""
+
+import os
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        #fall back to listdir + lstat, which is still one stat per entry
+        scandir = None
+
+class ScanEntry(object):
+    '''
+    One item in a directory.  The lstat is only done when size, mtime or stat()
+    is first needed, so directories found through d_type cost no extra calls.
+    '''
+
+    def __init__(self, path, name, direntry=None, st=None):
+        self.path = path
+        self.name = name
+        self.direntry = direntry
+        self.st = st
+
+        if direntry is not None:
+            self.islink = direntry.is_symlink()
+            if self.islink:
+                #follows the link, like os.path.isdir
+                self.isdir = direntry.is_dir()
+            else:
+                self.isdir = direntry.is_dir(follow_symlinks=False)
+        else:
+            if self.st is None:
+                self.st = os.lstat(path)
+            self.islink = stat.S_ISLNK(self.st.st_mode)
+            if self.islink:
+                self.isdir = os.path.isdir(path)
+            else:
+                self.isdir = stat.S_ISDIR(self.st.st_mode)
+
+    def __str__(self):
+        return self.path
+
+    def stat(self):
+        '''lstat result for the entry'''
+        if self.st is None:
+            self.st = self.direntry.stat(follow_symlinks=False)
+        return self.st
+
+    @property
+    def size(self):
+        return self.stat().st_size
+
+    @property
+    def mtime(self):
+        return self.stat().st_mtime
+
+    @property
+    def mtime_ns(self):
+        return stat_mtime_ns(self.stat())
+
+    @property
+    def ctime(self):
+        return self.stat().st_ctime
+
+    @property
+    def dev(self):
+        return self.stat().st_dev
+
+    @property
+    def inode(self):
+        '''Inode number, or 0 where the file system doesn't have them'''
+        return self.stat().st_ino
+
+    @property
+    def nlink(self):
+        return self.stat().st_nlink
+
+def stat_mtime_ns(st):
+    '''
+    Modification time in integer nanoseconds.  Python 2 only has the float,
+    which isn't precise to the nanosecond.
+    '''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1e9))
+    return mtime_ns
+
+def stat_entry(path):
+    '''
+    Builds a ScanEntry for a single path, with one lstat
+    '''
+    (_, name) = os.path.split(path)
+    return ScanEntry(path, name)
+
+def scan_dir(path, exclude=()):
+    '''
+    Yields a ScanEntry for each item in the directory path, skipping names
+    in exclude
+    '''
+    if scandir is not None:
+        for direntry in scandir(path):
+            if direntry.name in exclude:
+                continue
+            yield ScanEntry(direntry.path, direntry.name, direntry=direntry)
+    else:
+        for name in os.listdir(path):
+            if name in exclude:
+                continue
+            yield ScanEntry(os.path.join(path, name), name)
+
+def walk(top, exclude=(), skip=()):
+    '''
+    Walks the tree below top, similar to os.walk, but yields lists of
+    ScanEntry objects instead of names.  Like os.walk, links to directories
+    are listed with the directories but not followed.  Removing entries from
+    dirs prevents the walk from descending into them, and so does having
+    their paths in skip.
+    '''
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+
+        dirs = []
+        files = []
+        try:
+            for entry in scan_dir(dirpath, exclude):
+                if entry.isdir:
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+        except OSError:
+            #same as os.walk: directories we can't list are skipped
+            continue
+
+        yield (dirpath, dirs, files)
+
+        for entry in reversed(dirs):
+            if not entry.islink and entry.path not in skip:
+                stack.append(entry.path)
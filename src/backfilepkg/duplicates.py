@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Finds duplicate files in a catalog, using the digest index that the
+columnar catalogs keep (catalogs in the older groups layout are sorted when
+they're loaded).  Run as
+    python duplicates.py <catalog.h5> [--minsize N] [--limit N]
+"""
+
+import sys
+import argparse
+from collections import namedtuple
+import numpy as np
+
+from coverage import DigestTable
+
+#wasted is the bytes that would be freed by keeping only one copy
+DuplicateGroup = namedtuple('DuplicateGroup', 'digest size wasted paths')
+
+def duplicate_groups(table, minsize=0):
+    '''
+    DuplicateGroups for a DigestTable, with the most wasted bytes first
+    '''
+    starts = np.flatnonzero(table.first)
+    counts = np.diff(np.append(starts, len(table)))
+    sizes = table.sizes[starts]
+    isdup = (counts > 1) & (sizes >= minsize)
+    starts = starts[isdup]
+    counts = counts[isdup]
+    wasted = sizes[isdup] * (counts - 1)
+
+    groups = []
+    for i in np.argsort(-wasted, kind='mergesort'):
+        items = np.arange(starts[i], starts[i] + counts[i])
+        groups.append(DuplicateGroup(table.digests[starts[i]].tostring(), int(table.sizes[starts[i]]),
+                                     int(wasted[i]), sorted(table.get_paths(items))))
+    return groups
+
+def find_duplicates(filename, minsize=0, limit=None):
+    '''
+    Groups of identical files in a catalog, with the most wasted bytes
+    first.  Only the first limit groups are returned, if it's given.
+    '''
+    table = DigestTable.from_hdf5(filename)
+    groups = duplicate_groups(table, minsize)
+    if limit is not None:
+        groups = groups[:limit]
+    return groups
+
+def find_copies(filename, hashval):
+    '''Paths of all of the files in a catalog whose digest is hashval'''
+    table = DigestTable.from_hdf5(filename)
+    return table.get_paths(table.find_digest(hashval))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='List duplicate files in a catalog')
+    parser.add_argument('catalog', help='catalog file')
+    parser.add_argument('--minsize', type=int, default=1, help='ignore files smaller than this')
+    parser.add_argument('--limit', type=int, default=0, help='list at most this many groups (0 for all)')
+    args = parser.parse_args(argv)
+
+    groups = find_duplicates(args.catalog, args.minsize, args.limit if args.limit > 0 else None)
+    total = 0
+    for group in groups:
+        print '{0} x {1} bytes, {2} wasted ({3})'.format(len(group.paths), group.size, group.wasted,
+                                                         group.digest.encode('hex')[:16])
+        for path in group.paths:
+            print '  ' + path
+        total += group.wasted
+    print '{0} groups, {1} bytes wasted'.format(len(groups), total)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,56 +6,69 @@ Created on Thu May  8 09:57:49 2014
 """
 
 import os, time, shutil
+import mmap
 import sys
+import signal
+import argparse
 import h5py
 import multiprocessing as mp
 import numpy as np
-import hashlib
 import logging
 import mimetypes
+from collections import defaultdict
 #import magic       # problems on windows
 
-from thumbnail import get_thumbnail
+from thumbnail import get_thumbnail, reads_buffer
 from filetree import RootTree
 from progress import ProgressCLI
+from dirscan import walk, stat_entry
+from hashing import HashStage, StagedFile, staged_hash, HashEngine, DEFAULT_ALGORITHM, \
+    get_hash_function, digests_equal, get_pool_size, read_file
+from pipeline import Pipeline
+from supervisor import Supervisor, TaskError
+from catalog import FileType, ColumnCatalog
 from test import build_test_directory, modify_dir
 
 import filedataglobal
 
 TIME_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
-HASH_FUNCTION = hashlib.sha256
-BLOCK_SIZE = 128 * HASH_FUNCTION().block_size
 POOL_SIZE = 4
 PARALLEL = True
+#images and text files up to this size are read once, and the same data is
+#used for the hash and the thumbnail
+SINGLE_READ_SIZE = 64 * 1024 * 1024
+#seconds between checkpoints of the columnar catalog during a scan
+CHECKPOINT_INTERVAL = 300
+#group with the state of a scan that hasn't finished
+SCAN_STATE_GROUP = 'SCANSTATE'
+#a hash can take this many seconds, plus the time to read the file at
+#TASK_MIN_RATE bytes/sec, before the file is quarantined
+TASK_TIMEOUT = 120.0
+TASK_MIN_RATE = 1024 * 1024
+#seconds a thumbnail worker gets for one file
+THUMB_TIMEOUT = 60.0
+#the parts of the scan that each stage does, for the quarantine
+STAGE_PARTS = {'hash': ('hash', 'hashthumb'),
+               'thumb': ('thumb', 'hashthumb'),
+               'hashthumb': ('hash', 'thumb', 'hashthumb')}
 
 def init_pool(status):
     filedataglobal.status = status
 
-class FileType:
-    File, Dir, Link = range(3)
-    
-    @staticmethod
-    def get_name(num):
-        name = [nm1 for (nm1,num1) in FileType.__dict__.iteritems() if num1 == num]
-        if len(name) == 1:
-            return name[0]
-        else:
-            raise TypeError
-            
-    @staticmethod
-    def get_num(name):
-        return FileType.__dict__[name]
-        
+def get_task_timeout(nbytes):
+    return TASK_TIMEOUT + float(nbytes) / TASK_MIN_RATE
+
 class FileData(object):
     '''
     Data on a file
     '''
     
-    name = None
-    fullpath = None
-    root = None
+    __slots__ = ('fullpath', 'name', 'size', 'modified', 'hashval', 'sample', 'hashstage',
+                 'secondhash', 'leaves', 'thumbnail', 'type', 'mimetp', 'isthumbnail',
+                 'dev', 'inode', 'ctime')
     
-    def __init__(self, fullpath, ftype=None, size=None, modified=None, hashval=None, thumbnail=None, mimetype=None):
+    def __init__(self, fullpath, ftype=None, size=None, modified=None, hashval=None, thumbnail=None, mimetype=None,
+                 sample=None, hashstage=None, secondhash=None, leaves=None):
         self.fullpath = fullpath
         
         (_,name) = os.path.split(fullpath)
@@ -63,10 +76,19 @@ class FileData(object):
         self.size = size
         self.modified = modified
         self.hashval = hashval
+        self.sample = sample
+        self.hashstage = hashstage
+        self.secondhash = secondhash
+        self.leaves = leaves
         self.thumbnail = thumbnail
         self.type = ftype
         self.mimetp = mimetype
         self.isthumbnail = False
+        #identity of the file on disk, so renames and hard links can reuse
+        #the hash.  inode is 0 if the file system doesn't have them.
+        self.dev = None
+        self.inode = None
+        self.ctime = None
         
     def __str__(self):
         if self.type == FileType.Dir:
@@ -89,7 +111,7 @@ class FileData(object):
             return other.name == self.name
         else:
             if self.hashval is not None and other.hashval is not None:
-                return all(self.hashval == other.hashval)
+                return digests_equal(self.hashval, other.hashval)
             else:
                 return (other.name == self.name) and (self.size == other.size) and (self.modified == other.modified)            
     
@@ -97,14 +119,23 @@ class FileData(object):
         return not self.__eq__(other)
             
     def from_path(self):
-        if os.path.isdir(self.fullpath):
+        self.from_entry(stat_entry(self.fullpath))
+
+    def from_entry(self, entry):
+        '''
+        Fill in the data from a dirscan.ScanEntry, without any more stat calls
+        '''
+        if entry.isdir:
             self.type = FileType.Dir
-        elif os.path.islink(self.fullpath):
+        elif entry.islink:
             self.type = FileType.Link
         else:
             self.type = FileType.File
-            self.size = os.path.getsize(self.fullpath)
-            self.modified = time.localtime(os.path.getmtime(self.fullpath))
+            self.size = entry.size
+            self.modified = time.localtime(entry.mtime)
+            self.dev = entry.dev
+            self.inode = entry.inode
+            self.ctime = entry.ctime
             (self.mimetp,enc) = mimetypes.guess_type(self.fullpath)
             
 
@@ -117,14 +148,24 @@ class FileData(object):
                 self.modified = time.struct_time(h5gp.attrs['Modified'])
             if 'MimeType' in h5gp.attrs:
                 self.mimetp = h5gp.attrs['MimeType']
+            if 'Inode' in h5gp.attrs:
+                self.dev = int(h5gp.attrs['Device'])
+                self.inode = int(h5gp.attrs['Inode'])
+                self.ctime = float(h5gp.attrs['CTime'])
                 
             #self.islink = h5gp.attrs["IsLink"]
             ## TODO: process links better here
             
-            if "Hash" in h5gp:
-                self.hashval = np.zeros(HASH_FUNCTION().digest_size, dtype='uint8')
+            if 'HashStage' in h5gp.attrs:
+                self.hashstage = HashStage.get_num(h5gp.attrs['HashStage'])
+            if 'SampleHash' in h5gp.attrs:
+                self.sample = h5gp.attrs['SampleHash']
+
+            if "Hash" in h5gp and self.hashstage in (None, HashStage.Full):
                 self.hashval = h5gp["Hash"][:,-1]
             else:
+                #if staged hashing stopped before the full hash, the Hash dataset
+                #is just the history of older versions
                 self.hashval = None
 
             if 'Thumbnail' in h5gp:
@@ -155,49 +196,153 @@ class FileDataStatus(object):
     def incbytes(self, inc):
         self.curbytes.value = self.curbytes.value + inc
 
-def get_file_hash(filename):
-    logging.debug('Hashing %s',filename)
-    
-    h = HASH_FUNCTION()
-    with open(filename, 'rb') as fid:
-        def readblock():
-            return fid.read(BLOCK_SIZE)
-        
-        for b in iter(readblock,''):
-            h.update(b)
-            if filedataglobal.status:
-                filedataglobal.status.incbytes(BLOCK_SIZE)    
-                
-    return filename, np.frombuffer(h.digest(), dtype=np.uint8, count=h.digest_size)
+def get_file_hash(filename, engine=None):
+    '''
+    Hash a single file in the current thread.  Returns the filename and the
+    digest.  Pass a HashEngine to reuse its read buffer from file to file.
+    '''
+    if engine is None:
+        engine = HashEngine(nthreads=1, status=filedataglobal.status)
+    return engine.hash_file(filename)
 
 def get_file_thumbnail(filename):
+    '''
+    Makes the thumbnail for a file and encodes it, so only the encoded data
+    has to be sent back from a worker process
+    '''
     logging.debug('Thumbnail for %s',filename)
     
     t = get_thumbnail(path=filename)
     if t is not None:
         try:
             t.from_file()
+            t.encode()
         except:
             t = None
-    if filedataglobal.status:
-        filedataglobal.status.incbytes(1)
     
     return filename, t
+
+def get_buffer_thumbnail(filename, data):
+    '''Like get_file_thumbnail, from the contents of the file'''
+    t = get_thumbnail(path=filename)
+    if t is not None:
+        try:
+            t.from_buffer(data)
+            t.encode()
+        except:
+            t = None
+    
+    return filename, t
+
+def get_mapped_thumbnail(filename):
+    '''
+    Like get_buffer_thumbnail, from a read-only memory map of the file.  In a
+    worker, the map shares the pages the scan just read, so the data isn't
+    copied and sent through the worker's pipe.
+    '''
+    with open(filename, 'rb') as fid:
+        try:
+            mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            #empty files can't be mapped
+            mm = None
+    if mm is None:
+        return get_buffer_thumbnail(filename, '')
+    try:
+        return get_buffer_thumbnail(filename, mm)
+    finally:
+        mm.close()
+
+def get_file_hash_thumbnail(filename, engine, supervisor=None):
+    '''
+    Reads the file once, and hashes it and makes its thumbnail from the same
+    data.  With a Supervisor, the thumbnail is made in one of its workers,
+    which maps the file instead (see get_mapped_thumbnail).
+    Returns the filename, the digest, the thumbnail and the TaskError if
+    the worker failed.
+    '''
+    logging.debug('Hash and thumbnail for %s',filename)
+
+    data = read_file(filename)
+    (_, h) = engine.hash_file(filename, data=data)
+
+    err = None
+    if supervisor is not None:
+        #not kept while the worker runs
+        del data
+        try:
+            (_, t) = supervisor.apply(get_mapped_thumbnail, (filename,), timeout=THUMB_TIMEOUT)
+        except TaskError as e:
+            t = None
+            err = e
+    else:
+        (_, t) = get_buffer_thumbnail(filename, data)
     
+    return filename, h, t, err
+    
+class ScanStopped(Exception):
+    '''The scan was asked to stop, and wrote a checkpoint'''
+    pass
+
 class FileDataWriter(mp.Process):
     '''
     Writes file data to a log file
     '''
 
-    def __init__(self, outfile, rootpath=None, status=None):
+    def __init__(self, outfile, rootpath=None, status=None, hashmode='full',
+                 algorithm=None, secondary=None, hashblocksize=None, layout=None):
+        '''
+        hashmode is 'full' to hash every new or changed file, or 'staged' to
+        only hash as much as needed to tell files apart, which is enough for
+        finding duplicates and moved files.
+        
+        algorithm is the hash algorithm (see hashing.HASH_ALGORITHMS), which is
+        chosen when the catalog is created and stored in its HashAlgorithm
+        attribute.  secondary is an optional second algorithm that is computed
+        in the same pass and stored as SecondHash.
+        
+        If hashblocksize is set when the catalog is created, each file also
+        gets a BlockHash dataset with the digest of each block, and its Hash
+        is the digest of the block digests (see hashing.merkle_root).  Files
+        that have only grown since the last scan are then only hashed from
+        the end of their old data.  The block size is kept in the catalog's
+        HashBlockSize attribute, since those digests aren't the plain
+        digests of the files (they don't match sha256sum), and only match
+        digests made with the same block size.  Trees loaded from the
+        catalog hash files the same way (see Node.get_hash_scheme).
+        
+        layout is 'columns' for the columnar catalog (see catalog.py) or
+        'groups' for the old layout with one HDF5 group per file.  New
+        catalogs are columnar by default; existing ones keep their layout.
+        '''
         super(FileDataWriter, self).__init__()
         self.outfile = outfile
         self.rootpath = rootpath
         self.status = status
+        assert(hashmode in ('full', 'staged'))
+        self.hashmode = hashmode
+        self.algorithm = algorithm
+        self.secondary = secondary
+        self.hashblocksize = hashblocksize
+        assert(layout in (None, 'columns', 'groups'))
+        self.layout = layout
+        self.catalog = None
+        #set by stop(), from this process or the one that started the scan
+        self.stopping = mp.Event()
+
+    def stop(self, signum=None, frame=None):
+        '''
+        Asks the scan to write a checkpoint and stop.  It's also the handler
+        for SIGINT and SIGTERM while the scan runs, so Ctrl-C or terminate()
+        can't kill it in the middle of writing the catalog.
+        '''
+        self.stopping.set()
 
     def run(self):
         logging.debug('In run')
         
+        handlers = [(signum, signal.signal(signum, self.stop)) for signum in (signal.SIGINT, signal.SIGTERM)]
+        flush = True
         try:
             if os.path.isfile(self.outfile):
                 self.filename = self.outfile
@@ -206,39 +351,119 @@ class FileDataWriter(mp.Process):
                 self.init_file(self.outfile, self.rootpath)
             
             self.scan()
+        except ScanStopped:
+            logging.info('Scan stopped; the next one starts from the checkpoint')
+            #the checkpoint already wrote the catalog
+            flush = False
         finally:
-            self.close()
+            for (signum, handler) in handlers:
+                signal.signal(signum, handler)
+            self.close(flush)
         
     def open_file(self, filename):
         self.h5file = h5py.File(filename, 'a')
         
+        if ColumnCatalog.exists(self.h5file):
+            assert(self.layout in (None, 'columns'))
+            self.open_catalog()
+            return
+        assert(self.layout in (None, 'groups'))
+        
         self.rootgp = self.h5file.require_group('ROOT')
         assert((self.rootpath is None) or (self.rootpath == self.rootgp.attrs['RootPath']))
         
         self.rootpath = self.rootgp.attrs['RootPath']
         assert(self.rootgp.attrs['Type'] == FileType.get_name(FileType.Dir))
         assert(os.path.exists(self.rootpath))
+        
+        #catalogs from before the attribute existed are sha256
+        algorithm = self.rootgp.attrs.get('HashAlgorithm', 'sha256')
+        assert((self.algorithm is None) or (self.algorithm == algorithm))
+        self.algorithm = algorithm
+        
+        if 'SecondHashAlgorithm' in self.rootgp.attrs:
+            assert((self.secondary is None) or (self.secondary == self.rootgp.attrs['SecondHashAlgorithm']))
+            self.secondary = self.rootgp.attrs['SecondHashAlgorithm']
+        elif self.secondary is not None:
+            self.rootgp.attrs['SecondHashAlgorithm'] = self.secondary
+        
+        #block manifests change what the Hash of a file means, so they can
+        #only be chosen when the catalog is created
+        hashblocksize = self.rootgp.attrs.get('HashBlockSize', None)
+        assert((self.hashblocksize is None) or (self.hashblocksize == hashblocksize))
+        self.hashblocksize = hashblocksize
+        
         self.deletedgp = self.h5file.require_group('DELETED')
         
+    def open_catalog(self):
+        self.catalog = ColumnCatalog.open(self.h5file)
+        
+        assert((self.rootpath is None) or (self.rootpath == self.catalog.rootpath))
+        self.rootpath = self.catalog.rootpath
+        assert(os.path.exists(self.rootpath))
+        
+        assert((self.algorithm is None) or (self.algorithm == self.catalog.algorithm))
+        self.algorithm = self.catalog.algorithm
+        
+        if self.catalog.secondary is not None:
+            assert((self.secondary is None) or (self.secondary == self.catalog.secondary))
+            self.secondary = self.catalog.secondary
+        elif self.secondary is not None:
+            self.catalog.set_secondary(self.secondary)
+        
+        assert((self.hashblocksize is None) or (self.hashblocksize == self.catalog.hashblocksize))
+        self.hashblocksize = self.catalog.hashblocksize
+        
     def init_file(self, filename, rootpath):
         assert(rootpath is not None)
         
         self.h5file = h5py.File(filename, 'w')
         self.rootpath = os.path.abspath(rootpath)
         
+        if self.layout != 'groups':
+            self.catalog = ColumnCatalog.create(self.h5file, self.rootpath, algorithm=self.algorithm,
+                                                secondary=self.secondary, hashblocksize=self.hashblocksize)
+            self.algorithm = self.catalog.algorithm
+            return
+        
         self.rootgp = self.h5file.create_group('ROOT')
         self.rootgp.attrs['RootPath'] = self.rootpath
         self.rootgp.attrs['Type'] = FileType.get_name(FileType.Dir)
         
+        if self.algorithm is None:
+            self.algorithm = DEFAULT_ALGORITHM
+        get_hash_function(self.algorithm)
+        self.rootgp.attrs['HashAlgorithm'] = self.algorithm
+        if self.secondary is not None:
+            get_hash_function(self.secondary)
+            self.rootgp.attrs['SecondHashAlgorithm'] = self.secondary
+        if self.hashblocksize:
+            self.rootgp.attrs['HashBlockSize'] = self.hashblocksize
+        
         self.deletedgp = self.h5file.create_group('DELETED')
         
-    def close(self):
+    def close(self, flush=True):
+        if self.catalog is not None and flush:
+            self.catalog.flush()
         self.h5file.close()
         
     def write_data(self, fd, relpath=None, parentgp=None):
+        '''
+        Writes the data that's set in fd.  Returns the HDF5 group for the
+        item, or its row in the columnar catalog.  parentgp is the group
+        (or row) of the directory that it's in, if we have it.
+        '''
         if relpath is None:
             relpath = os.path.relpath(fd.fullpath, self.rootpath)
             
+        if self.catalog is not None:
+            if parentgp is None:
+                row = self.catalog.require(relpath, fd.type)
+            else:
+                row = self.catalog.require(fd.name, fd.type, parent=parentgp)
+            self.catalog.write(row, fd)
+            return row
+            
         if parentgp is None:
             if relpath == '.':
                 gp = self.rootgp
@@ -266,8 +491,24 @@ class FileDataWriter(mp.Process):
                     gp.attrs["Modified"] = np.array(fd.modified, dtype='int32')
                 if fd.mimetp is not None:
                     gp.attrs['MimeType'] = fd.mimetp
+                if fd.inode is not None:
+                    gp.attrs['Device'] = np.uint64(fd.dev)
+                    gp.attrs['Inode'] = np.uint64(fd.inode)
+                    gp.attrs['CTime'] = fd.ctime
+                if fd.hashstage is not None:
+                    gp.attrs['HashStage'] = HashStage.get_name(fd.hashstage)
+                    if fd.sample is not None:
+                        gp.attrs['SampleHash'] = fd.sample
+                    elif 'SampleHash' in gp.attrs:
+                        del gp.attrs['SampleHash']
+                    if fd.secondhash is None and 'SecondHash' in gp.attrs:
+                        del gp.attrs['SecondHash']
                 if fd.hashval is not None:
                     self.write_hash(gp, fd)
+                if fd.leaves is not None:
+                    self.write_leaves(gp, fd)
+                if fd.secondhash is not None:
+                    gp.attrs['SecondHash'] = fd.secondhash
                 if fd.thumbnail is not None:
                     fd.thumbnail.to_hdf5(gp)
         
@@ -288,7 +529,7 @@ class FileDataWriter(mp.Process):
             lasthash = hset[:,n-1]
             
             #extend it if the last value doesn't match the current hash
-            if np.any(lasthash != fd.hashval):
+            if not digests_equal(lasthash, fd.hashval):
                 hset.resize((ds,n+1))
                 dateset.resize((9,n+1))
                 ind = n
@@ -298,8 +539,8 @@ class FileDataWriter(mp.Process):
                 isnewhash = False
         else:
             #otherwise just create the dataset
-            hset = gp.create_dataset('Hash',(HASH_FUNCTION().digest_size,1),
-                                   maxshape=(HASH_FUNCTION().digest_size,None),
+            hset = gp.create_dataset('Hash',(len(fd.hashval),1),
+                                   maxshape=(len(fd.hashval),None),
                                    dtype='uint8')
             dateset = gp.create_dataset('HashDate',(9,1),
                                    maxshape=(9,None),
@@ -312,11 +553,22 @@ class FileDataWriter(mp.Process):
             hset[:,ind] = fd.hashval
         dateset[:,ind] = np.array(time.localtime(), dtype='int16')
         
+    def write_leaves(self, gp, fd):
+        '''
+        Write the block manifest for a file, replacing the old one
+        '''
+        if 'BlockHash' in gp:
+            del gp['BlockHash']
+        
+        ds = fd.leaves.shape[1]
+        bset = gp.create_dataset('BlockHash', data=fd.leaves, maxshape=(None,ds),
+                                 chunks=(256,ds), dtype='uint8')
+        bset.attrs['BlockSize'] = self.hashblocksize
+        
     def make_deleted(self, name, parentgp, fullpath):
         gp = parentgp[name]
         
         if 'Hash' in gp:
-            hashval1 = np.zeros(HASH_FUNCTION().digest_size, dtype='uint8')
             hashval1 = gp["Hash"][:,-1]
             
             hashtxt1 = ''.join("%02X" % n for n in hashval1)
@@ -333,110 +585,638 @@ class FileDataWriter(mp.Process):
             del parentgp[name]
         else:
             del parentgp[name]
+
+    def list_items(self, gp):
+        '''Names of the items in a directory group (or row)'''
+        if self.catalog is not None:
+            return set(self.catalog.children(gp).keys())
+        return set(gp.keys())
+
+    def read_item(self, gp, name, fd):
+        '''Fills in fd from the item called name in a directory group (or row)'''
+        if self.catalog is not None:
+            self.catalog.read(self.catalog.children(gp)[name], fd)
+        else:
+            fd.from_hdf5(gp[name])
+
+    def get_leaves(self, gp, name):
+        '''Block manifest for an item in a directory group (or row), or None'''
+        if self.catalog is not None:
+            return self.catalog.get_leaves(self.catalog.children(gp)[name])
+        if 'BlockHash' in gp[name]:
+            return gp[name]['BlockHash'][:]
+        return None
+
+    def delete_item(self, gp, name, fullpath):
+        if self.catalog is not None:
+            self.catalog.delete(self.catalog.children(gp)[name])
+        else:
+            self.make_deleted(name, gp, fullpath)
             
-    def scan(self):
+    def find_known(self, ondisk):
         '''
-        Scan the whole path and compare/update the HDF5 tree
+        Row of a file in the catalog that is the same file as ondisk: the
+        same device and inode, with the same size and modification time,
+        and a full hash.  Only the columnar catalog keeps the inodes.
+        '''
+        if self.catalog is None or not ondisk.inode:
+            return None
+        mtime = time.mktime(ondisk.modified)
+        for row in self.catalog.inode_rows(ondisk.dev, ondisk.inode):
+            item = self.catalog.read(row)
+            if (item.size == ondisk.size and item.hashval is not None and
+                    item.modified is not None and time.mktime(item.modified) == mtime):
+                return row
+        return None
+
+    def is_renamed(self, row):
+        '''
+        True if a known file isn't at its old path any more, so it was
+        renamed, rather than being another hard link to the same file
+        '''
+        cols = self.catalog.columns
+        if cols['Parent'][row] < 0:
+            #deleted earlier in the scan
+            return True
+        try:
+            st = os.lstat(os.path.join(self.rootpath, self.catalog.relpath(row)))
+        except OSError:
+            return True
+        return (st.st_dev, st.st_ino) != (cols['Device'][row], cols['Inode'][row])
+
+    def reuse_hash(self, knownrow, row):
+        '''
+        Copies the hash of a known file to another row, along with its
+        thumbnail.  Returns False if it doesn't have a thumbnail.
+        '''
+        item = self.catalog.read(knownrow)
+        fd = FileData(self.catalog.relpath(row), hashval=item.hashval, hashstage=item.hashstage,
+                      sample=item.sample, secondhash=self.catalog.get_secondhash(knownrow),
+                      leaves=self.catalog.get_leaves(knownrow))
+        self.catalog.write(row, fd)
+        parts = self.catalog.get_thumbnail_parts(knownrow)
+        if parts is None:
+            return False
+        self.catalog.set_thumbnail_parts(row, parts, self.catalog.get_thumbnail_info(knownrow))
+        return True
+
+    def is_linked(self, entry, ondisk):
+        '''
+        True if another hard link to the same file is already waiting for
+        its hash in this scan, so this one gets the same hash when it's done
+        '''
+        if not ondisk.inode or entry.nlink < 2:
+            return False
+        key = (ondisk.dev, ondisk.inode)
+        first = self.pending.get(key)
+        if first is None:
+            self.pending[key] = ondisk.fullpath
+            self.linkresults[ondisk.fullpath] = []
+            return False
+        self.linked[first].append(ondisk.fullpath)
+        #results that came back before we found this link
+        for fd in self.linkresults.get(first, ()):
+            self.write_link(fd, ondisk.fullpath)
+        if len(self.linked[first]) + 1 >= entry.nlink:
+            #that was the last link, so the rest of the results only go
+            #to the links we have
+            self.linkresults.pop(first, None)
+        return True
+
+    def write_link(self, fd, path):
+        self.write_data(FileData(path, hashval=fd.hashval, hashstage=fd.hashstage, sample=fd.sample,
+                                 secondhash=fd.secondhash, leaves=fd.leaves, thumbnail=fd.thumbnail))
+
+    def write_links(self, fd):
+        '''Writes the same hash and thumbnail for the other hard links to a file'''
+        results = self.linkresults.get(fd.fullpath)
+        if results is not None:
+            #for links we haven't found yet
+            results.append(fd)
+        for path in self.linked.get(fd.fullpath, ()):
+            self.write_link(fd, path)
+
+    def hash_files(self, filenames, appended=None):
+        '''
+        Hash a list of files, in parallel if we can.  Returns a dict of filename -> hash.
+        appended is a dict of filename -> (old block manifest, old size) for files
+        that might only have been appended to.
+        '''
+        if PARALLEL:
+            nthreads = None
+        else:
+            nthreads = 1
+        engine = HashEngine(nthreads=nthreads, status=self.status,
+                            algorithm=self.algorithm, secondary=self.secondary,
+                            manifest=self.hashblocksize, appended=appended)
+        if PARALLEL:
+            hash_map = engine.hash_files(filenames)
+        else:
+            hash_map = dict([get_file_hash(fn, engine) for fn in filenames])
+        logging.debug('Hashing workers:\n%s', engine.report())
+        self.secondhash_map = engine.secondary
+        self.leaves_map = engine.leaves
+        return hash_map
+
+    def is_appended(self, ondisk, infile):
+        '''
+        True if the file has grown and we have a hash for the old version, so
+        it might only have been appended to, if it has a block manifest
+        '''
+        return (self.hashblocksize and infile.type == FileType.File and
+                infile.hashval is not None and infile.size is not None and
+                ondisk.size > infile.size)
+
+    def scan_staged(self, stagedfiles):
+        '''
+        Run staged hashing over all of the files on disk and record the results.
+        Only files that share a size and a sample hash with another file get
+        a full hash.
         '''
-        assert(self.rootpath is not None)
-        assert(os.path.exists(self.rootpath))
-        
-        logging.debug("in scan")
-        
         if self.status:
-            self.status.setstatus(state='Initial scan')
-            
-        #walk through the directory tree
+            self.status.setstatus(state='Staged hashing',total=1,cur=0)
+
+        def hashfiles(sfs):
+            if self.status:
+                self.status.setstatus(state='Computing hashes',total=sum([sf.size for sf in sfs]),cur=0)
+            return self.hash_files([sf.path for sf in sfs])
+
+        self.secondhash_map = {}
+        self.leaves_map = {}
+        changed = staged_hash(stagedfiles, hashfiles, get_hash_function(self.algorithm))
+
+        if self.status:
+            self.status.setstatus(state='Writing hashes')
+
+        for sf in changed:
+            fd = FileData(sf.path, hashstage=sf.stage, sample=sf.sample,
+                          secondhash=self.secondhash_map.get(sf.path),
+                          leaves=self.leaves_map.get(sf.path))
+            if sf.stage == HashStage.Full:
+                fd.hashval = sf.full
+            self.write_data(fd)
+            self.write_links(fd)
+
+    def submit(self, pipeline, stage, filename, size):
+        '''Queues a file for a stage of the scan pipeline, remembering that it's pending'''
+        self.inflight.setdefault(filename, {})[stage.name] = size
+        pipeline.submit(stage, filename, size)
+
+    def is_inflight(self, filename, stagenames):
+        return any(name in stagenames for name in self.inflight.get(filename, ()))
+
+    def quarantine(self, filename, stage, err):
+        '''
+        Records a file that a stage hung or crashed on, so later scans skip
+        it.  Only the columnar catalog keeps a quarantine.  It's listed and
+        cleared with catalog.py.
+        '''
+        reason = '{0}: {1}'.format(type(err).__name__, err)
+        logging.warning('Quarantining %s for %s (%s)', filename, stage, reason)
+        if self.catalog is not None:
+            self.catalog.add_quarantine(os.path.relpath(filename, self.rootpath), stage, reason)
+
+    def is_quarantined(self, filename, stage):
+        if self.catalog is None or not self.catalog.quarantine:
+            return False
+        return self.catalog.is_quarantined(os.path.relpath(filename, self.rootpath), STAGE_PARTS[stage])
+
+    def write_result(self, stage, filename, res, err):
+        '''
+        Writes a result that comes back from the hash or thumbnail stage
+        of the scan pipeline
+        '''
+        stages = self.inflight.get(filename)
+        if stages is not None:
+            stages.pop(stage, None)
+            if not stages:
+                del self.inflight[filename]
+        if err is not None:
+            #only hangs and crashes.  An ordinary error, like a permission
+            #or a file that's gone, is tried again by the next scan
+            if isinstance(err, TaskError):
+                self.quarantine(filename, stage, err)
+            return
+        if stage == 'hash':
+            (_, h) = res
+            fd = FileData(filename, hashval=h, hashstage=HashStage.Full,
+                          secondhash=self.engine.secondary.pop(filename, None),
+                          leaves=self.engine.leaves.pop(filename, None))
+            self.engine.appended.pop(filename, None)
+        elif stage == 'hashthumb':
+            (_, h, t, thumberr) = res
+            if thumberr is not None:
+                self.quarantine(filename, 'thumb', thumberr)
+            fd = FileData(filename, hashval=h, hashstage=HashStage.Full, thumbnail=t,
+                          secondhash=self.engine.secondary.pop(filename, None),
+                          leaves=self.engine.leaves.pop(filename, None))
+        else:
+            (_, t) = res
+            fd = FileData(filename, thumbnail=t)
+        self.write_data(fd)
+        self.write_links(fd)
+
+    def scan_dir(self, maindir, subdirs, files):
+        '''
+        Updates the HDF5 group for one directory.  Returns lists of the files
+        that need a hash (with the number of bytes to hash), need a staged
+        hash, and need a thumbnail.
+        '''
         needshash = []
-        hashsize = 0
+        stagedfiles = []
         needsthumb = []
-        thumbsize = 0
-        for maindir,subdirs,files in os.walk(self.rootpath):
-            fd = FileData(maindir, ftype=FileType.Dir)
-            
-            gp = self.write_data(fd)
-            deleted = set(gp.keys())
 
-            for subdir in subdirs:
-                subfd = FileData(os.path.join(maindir,subdir), ftype=FileType.Dir)
-                self.write_data(subfd, parentgp=gp)
-                deleted.discard(subdir)
-                
-            for filename in files:
-                ondisk = FileData(os.path.join(maindir, filename))
-                ondisk.from_path()
+        fd = FileData(maindir, ftype=FileType.Dir)
+        
+        gp = self.write_data(fd)
+        items = self.list_items(gp)
+        deleted = set(items)
+
+        for subdir in subdirs:
+            subfd = FileData(subdir.path, ftype=FileType.Dir)
+            self.write_data(subfd, parentgp=gp)
+            deleted.discard(subdir.name)
             
-                if filename in gp:
-                    infile = FileData(os.path.join(maindir, filename))
-                    infile.from_hdf5(gp[filename])
-                    
-                    if ondisk != infile:
-                        logging.debug('%s != %s',str(ondisk),str(infile))
-                        self.write_data(ondisk,parentgp=gp)
-                        if ondisk.type == FileType.File:
-                            needshash.append(ondisk.fullpath)
-                            hashsize += ondisk.size
-                            needsthumb.append(ondisk.fullpath)
-                            thumbsize += ondisk.size
-                    elif ondisk.type == FileType.File:
-                        #it's the same in the file as on disk, but we didn't
-                        #get a chance to calculate a hash or a thumbnail
-                        if infile.hashval is None:
-                            needshash.append(ondisk.fullpath)
-                            hashsize += ondisk.size
-                        if not infile.isthumbnail:
-                            needsthumb.append(ondisk.fullpath)
-                            thumbsize += ondisk.size
+        for entry in files:
+            filename = entry.name
+            ondisk = FileData(entry.path)
+            ondisk.from_entry(entry)
+        
+            if filename in items:
+                infile = FileData(entry.path)
+                self.read_item(gp, filename, infile)
+                
+                if ondisk != infile:
+                    logging.debug('%s != %s',str(ondisk),str(infile))
+                    if self.is_appended(ondisk, infile):
+                        oldleaves = self.get_leaves(gp, filename)
+                    else:
+                        oldleaves = None
+                    #before the row is updated, so it doesn't find itself
+                    known = self.find_known(ondisk) if ondisk.type == FileType.File else None
+                    row = self.write_data(ondisk,parentgp=gp)
+                    if known is not None:
+                        #a hard link to a file that we already have, or one
+                        #that was renamed over this one
+                        if not self.reuse_hash(known, row):
+                            needsthumb.append((ondisk.fullpath, ondisk.size))
+                    elif ondisk.type == FileType.File and not self.is_linked(entry, ondisk):
+                        if self.hashmode == 'staged':
+                            stagedfiles.append(StagedFile(ondisk.fullpath, ondisk.size))
+                        elif oldleaves is not None:
+                            #only the new blocks need to be hashed
+                            self.engine.appended[ondisk.fullpath] = (oldleaves, infile.size)
+                            needshash.append((ondisk.fullpath, ondisk.size - infile.size))
+                        else:
+                            needshash.append((ondisk.fullpath, ondisk.size))
+                        needsthumb.append((ondisk.fullpath, ondisk.size))
+                elif ondisk.type == FileType.File:
+                    if (infile.dev, infile.inode, infile.ctime) != (ondisk.dev, ondisk.inode, ondisk.ctime):
+                        ident = FileData(entry.path)
+                        (ident.dev, ident.inode, ident.ctime) = (ondisk.dev, ondisk.inode, ondisk.ctime)
+                        self.write_data(ident, parentgp=gp)
+
+                    #it's the same in the file as on disk, but we didn't
+                    #get a chance to calculate a hash or a thumbnail
+                    if self.hashmode == 'staged':
+                        stagedfiles.append(StagedFile(ondisk.fullpath, ondisk.size,
+                                                      sample=infile.sample, full=infile.hashval,
+                                                      stage=infile.hashstage))
+                    elif infile.hashval is None:
+                        needshash.append((ondisk.fullpath, ondisk.size))
+                    if not infile.isthumbnail:
+                        needsthumb.append((ondisk.fullpath, ondisk.size))
+            else:
+                known = self.find_known(ondisk) if ondisk.type == FileType.File else None
+                if known is not None and self.is_renamed(known):
+                    #keeps its hash, history and thumbnail
+                    oldpath = self.catalog.relpath(known)
+                    if self.catalog.columns['Parent'][known] == gp:
+                        #renamed in this directory, so the old name isn't deleted
+                        deleted.discard(self.catalog.names[known])
+                    self.catalog.move(known, gp, filename)
+                    self.write_data(ondisk, parentgp=gp)
+                    self.moved.append((oldpath, self.catalog.relpath(known)))
+                    logging.debug('%s was moved to %s', oldpath, ondisk.fullpath)
+                elif known is not None:
+                    #another hard link to a file that we already have
+                    row = self.write_data(ondisk, parentgp=gp)
+                    if not self.reuse_hash(known, row):
+                        needsthumb.append((ondisk.fullpath, ondisk.size))
                 else:
                     self.write_data(ondisk, parentgp=gp)
-                    if ondisk.type == FileType.File:
-                        needshash.append(ondisk.fullpath)
-                        hashsize += ondisk.size
-                        needsthumb.append(ondisk.fullpath)
-                        thumbsize += ondisk.size
-                deleted.discard(filename)
+                    if ondisk.type == FileType.File and not self.is_linked(entry, ondisk):
+                        if self.hashmode == 'staged':
+                            stagedfiles.append(StagedFile(ondisk.fullpath, ondisk.size))
+                        else:
+                            needshash.append((ondisk.fullpath, ondisk.size))
+                        needsthumb.append((ondisk.fullpath, ondisk.size))
+            deleted.discard(filename)
 
-            for name in deleted:
-                self.make_deleted(name, gp, os.path.join(maindir, name))
-        
-        if self.status:
-            self.status.setstatus(state='Computing hashes',total=hashsize,cur=0)
+        for name in deleted:
+            self.delete_item(gp, name, os.path.join(maindir, name))
 
-        logging.debug('Done with scan: %d files / %d bytes to hash',
-                      len(needshash),hashsize)
-                      
-        if PARALLEL:
-            hash_pool = mp.Pool(POOL_SIZE, initializer=init_pool,initargs=(self.status,))
-            hash_map = dict(hash_pool.imap_unordered(get_file_hash, needshash, 10))            
-            hash_pool.close()
-        else:
-            hash_map = dict([get_file_hash(fn) for fn in needshash])
+        return needshash, stagedfiles, needsthumb
+
+    def finish_dir(self, maindir, subdirs):
+        '''
+        Keeps track of the directories that have been walked, along with
+        everything below them.  Only the top one of each finished part of
+        the tree is kept in donedirs.
+        '''
+        below = [entry.path for entry in subdirs if not entry.islink]
+        self.subdirs[maindir] = below
+        self.remaining[maindir] = len([path for path in below if path not in self.donedirs])
+
+        path = maindir
+        while self.remaining.get(path) == 0:
+            del self.remaining[path]
+            self.donedirs.difference_update(self.subdirs.pop(path))
+            self.donedirs.add(path)
+            path = os.path.dirname(path)
+            if path not in self.remaining:
+                break
+            self.remaining[path] -= 1
+
+    def load_scan_state(self):
+        '''
+        Directories that were finished, and files that were still waiting
+        for a hash or thumbnail, when an earlier scan stopped.  Returns a
+        list of (filename, stage name, size) for the files.
+        '''
+        self.donedirs = set()
+        if self.catalog is None or SCAN_STATE_GROUP not in self.h5file:
+            return []
+        gp = self.h5file[SCAN_STATE_GROUP]
+        #staged hashing needs all of the files at the end, so it has to
+        #walk everything again
+        if self.hashmode != 'staged':
+            self.donedirs = set(os.path.normpath(os.path.join(self.rootpath, relpath))
+                                for relpath in gp['DoneDirs'][:])
+        pending = zip(gp['PendingPath'][:], gp['PendingStage'][:], gp['PendingSize'][:])
+        logging.debug('Resuming scan with %d finished directories and %d pending files',
+                      len(self.donedirs), len(pending))
+        return pending
+
+    def checkpoint(self):
+        '''
+        Writes the catalog, along with the directories that are done and
+        the files that are still pending, so that the scan can start from
+        here if it's interrupted
+        '''
+        self.catalog.flush()
+        if SCAN_STATE_GROUP in self.h5file:
+            del self.h5file[SCAN_STATE_GROUP]
+        gp = self.h5file.create_group(SCAN_STATE_GROUP)
+        gp.attrs['Checkpoint'] = time.time()
+
+        strtype = h5py.special_dtype(vlen=str)
+        donedirs = [os.path.relpath(path, self.rootpath) for path in self.donedirs]
+        gp.create_dataset('DoneDirs', data=np.array(donedirs, dtype=object), dtype=strtype)
+        pending = [(filename, name, size) for (filename, stages) in self.inflight.iteritems()
+                   for (name, size) in stages.iteritems()]
+        #hard links that were waiting for another link's results
+        pending += [(link, name, size) for (filename, name, size) in list(pending)
+                    for link in self.linked.get(filename, ())]
+        gp.create_dataset('PendingPath', data=np.array([p[0] for p in pending], dtype=object), dtype=strtype)
+        gp.create_dataset('PendingStage', data=np.array([p[1] for p in pending], dtype=object), dtype=strtype)
+        gp.create_dataset('PendingSize', data=np.array([p[2] for p in pending], dtype='int64'))
+        self.h5file.flush()
+        self.lastcheckpoint = time.time()
+        logging.debug('Checkpoint: %d finished directories, %d pending files', len(donedirs), len(pending))
+
+    def poll(self):
+        '''
+        Called by the pipeline while it writes results and waits for the
+        stages.  Writes a checkpoint if it's time, and stops the scan if
+        stop() was called.
+        '''
+        if self.stopping.is_set():
+            raise ScanStopped()
+        if self.catalog is not None and time.time() - self.lastcheckpoint > CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def scan(self):
+        '''
+        Scan the whole path and compare/update the HDF5 tree.  The walk,
+        hashing and thumbnails run as a pipeline (see pipeline.py), so files
+        are hashed while the walk is still going, and this thread writes
+        the results as they come in.
+
+        The columnar catalog is written at checkpoints during the scan,
+        with the directories that are done and the files that are still
+        pending.  If the scan stops before it finishes, the next one skips
+        the parts of the tree that were done and starts with the pending
+        files.
+
+        Thumbnails are made in supervised worker processes (see
+        supervisor.py), and hashes have a deadline too.  A file that takes
+        too long or crashes a worker is quarantined in the catalog, and
+        isn't tried again until it changes.
+        '''
+        assert(self.rootpath is not None)
+        assert(os.path.exists(self.rootpath))
+        
+        logging.debug("in scan")
         
         if self.status:
-            self.status.setstatus(state='Writing hashes')
-            
-        for (filename, h) in hash_map.iteritems():
-            fd = FileData(filename, hashval=h)
-            self.write_data(fd)
+            self.status.setstatus(state='Scanning',total=1,cur=0)
 
-        if self.status:
-            self.status.setstatus(state='Generating thumbnails',total=len(needsthumb),cur=0)
-    
+        #start the thumbnail processes before any threads
         if PARALLEL:
-            thumb_pool = mp.Pool(POOL_SIZE, initializer=init_pool,initargs=(self.status,))
-            thumb_map = dict(thumb_pool.imap_unordered(get_file_thumbnail, needsthumb, 10))            
-            thumb_pool.close()
+            supervisor = Supervisor(POOL_SIZE, initializer=init_pool, initargs=(self.status,))
+            def thumbnail(filename):
+                return supervisor.apply(get_file_thumbnail, (filename,), timeout=THUMB_TIMEOUT)
+            nhash = get_pool_size([os.path.join(self.rootpath, '')])
         else:
-            thumb_map = dict([get_file_thumbnail(fn) for fn in needsthumb])
-            
-        if self.status:
-            self.status.setstatus(state='Writing thumbnails')
-            
-        for (filename, t) in thumb_map.iteritems():
-            fd = FileData(filename, thumbnail=t)
-            self.write_data(fd)
+            supervisor = None
+            thumbnail = get_file_thumbnail
+            nhash = 1
+
+        self.engine = HashEngine(nthreads=nhash, status=self.status,
+                                 algorithm=self.algorithm, secondary=self.secondary,
+                                 manifest=self.hashblocksize)
+
+        #hard links that get the hash of the first link to the same file:
+        #(dev, inode) -> first path, first path -> other paths, and first
+        #path -> the results written for it so far, which are only kept
+        #until all of its links have been found
+        self.pending = {}
+        self.linked = defaultdict(list)
+        self.linkresults = {}
+        #(old, new) relative paths of the files that were renamed
+        self.moved = []
+
+        #files waiting for a stage: filename -> {stage name: size}, and the
+        #directories that are still being walked (see finish_dir)
+        self.inflight = {}
+        self.remaining = {}
+        self.subdirs = {}
+        self.lastcheckpoint = time.time()
+        resumed = self.load_scan_state()
+
+        pipeline = Pipeline(self.write_result, threaded=PARALLEL, poll=self.poll)
+        try:
+            hashstage = pipeline.add_stage('hash', self.engine.hash_file, nworkers=nhash,
+                                           timeout=get_task_timeout)
+            hashthumbstage = pipeline.add_stage('hashthumb',
+                                                lambda fn: get_file_hash_thumbnail(fn, self.engine, supervisor),
+                                                nworkers=nhash, timeout=get_task_timeout)
+            thumbstage = pipeline.add_stage('thumb', thumbnail, nworkers=POOL_SIZE)
+            stages = dict((stage.name, stage) for stage in (hashstage, hashthumbstage, thumbstage))
+            for (filename, name, size) in resumed:
+                if os.path.isfile(filename) and not self.is_quarantined(filename, name):
+                    self.submit(pipeline, stages[name], filename, size)
+
+            if self.rootpath in self.donedirs:
+                #only the pending files were left
+                source = pipeline.add_source('walk', iter([]))
+            else:
+                source = pipeline.add_source('walk', walk(self.rootpath, skip=self.donedirs))
+
+            stagedfiles = []
+            hashsize = 0
+            nfiles = 0
+            for (maindir, subdirs, files) in pipeline.iterate(source):
+                (needshash, staged, needsthumb) = self.scan_dir(maindir, subdirs, files)
+                stagedfiles.extend(staged)
+                nfiles += len(files)
+
+                #images and text that need both are read once for both,
+                #unless only the end of the file needs to be hashed
+                needshash = [(fn, size) for (fn, size) in needshash if not self.is_quarantined(fn, 'hash')]
+                needsthumb = [(fn, size) for (fn, size) in needsthumb if not self.is_quarantined(fn, 'thumb')]
+                thumbset = set(fn for (fn, _) in needsthumb)
+                single = set(fn for (fn, size) in needshash
+                             if fn in thumbset and size <= SINGLE_READ_SIZE and
+                             fn not in self.engine.appended and reads_buffer(fn))
+
+                for (filename, size) in needshash:
+                    if self.is_inflight(filename, ('hash', 'hashthumb')):
+                        #resumed from an earlier scan
+                        continue
+                    hashsize += size
+                    if self.status:
+                        self.status.setstatus(total=hashsize)
+                    if filename in single:
+                        self.submit(pipeline, hashthumbstage, filename, size)
+                    else:
+                        self.submit(pipeline, hashstage, filename, size)
+                for (filename, size) in needsthumb:
+                    if filename not in single and not self.is_inflight(filename, ('thumb', 'hashthumb')):
+                        self.submit(pipeline, thumbstage, filename, size)
+
+                if self.status:
+                    self.status.setstatus(state='Scanning: {0} files'.format(nfiles))
+
+                self.finish_dir(maindir, subdirs)
+
+            if self.status:
+                self.status.setstatus(state='Finishing hashes and thumbnails')
+            pipeline.finish()
+        except (KeyboardInterrupt, ScanStopped):
+            if self.catalog is not None:
+                self.checkpoint()
+            raise
+        finally:
+            if supervisor is not None:
+                supervisor.close()
+
+        self.pipeline_report = pipeline.report()
+        logging.debug('Scan pipeline:\n%s', self.pipeline_report)
+        if supervisor is not None:
+            logging.debug('Thumbnail workers: %s', supervisor.report())
+        logging.debug('Hashing workers:\n%s', self.engine.report())
+        logging.debug('%d files were moved', len(self.moved))
+
+        if self.hashmode == 'staged':
+            self.scan_staged(stagedfiles)
+        if SCAN_STATE_GROUP in self.h5file:
+            del self.h5file[SCAN_STATE_GROUP]
         
-def main():
+def get_thumbnail_parts(h5gp):
+    '''
+    Encoded thumbnail from a file group in the old layout, in the form that
+    the thumbnail classes' to_parts returns, without decoding it
+    '''
+    tset = h5gp['Thumbnail']
+    data = tset[:]
+    vlen = h5py.check_dtype(vlen=tset.dtype)
+    if vlen is not None and vlen is not str:
+        #video: a jpeg for each frame
+        return [d.tostring() for d in data]
+    elif data.dtype.kind in ('S', 'O'):
+        #text
+        return [str(d) for d in data]
+    else:
+        #image: one jpeg
+        return [data.tostring()]
+
+def get_thumbnail_info(h5gp):
+    '''
+    Attributes of the thumbnail in a file group in the old layout, in the
+    form that the thumbnail classes' to_info returns
+    '''
+    attrs = h5gp['Thumbnail'].attrs
+    return dict((name, attrs[name]) for name in ('Size', 'NFrames', 'FramesPerSec') if name in attrs)
+
+def copy_file_group(catalog, row, h5gp):
+    '''
+    Copies the data for a file from a group in the old layout to a row in
+    a columnar catalog
+    '''
+    fd = FileData(h5gp.name)
+    fd.from_hdf5(h5gp)
+    #the hashes come from the whole history
+    fd.hashval = None
+    catalog.write(row, fd)
+
+    if 'Hash' in h5gp:
+        catalog.add_history(row, h5gp['Hash'][:].T, h5gp['HashDate'][:].T)
+    if 'SecondHash' in h5gp.attrs:
+        fd = FileData(h5gp.name, secondhash=h5gp.attrs['SecondHash'])
+        catalog.write(row, fd)
+    if 'BlockHash' in h5gp:
+        catalog.write(row, FileData(h5gp.name, leaves=h5gp['BlockHash'][:]))
+    if 'Thumbnail' in h5gp:
+        catalog.set_thumbnail_parts(row, get_thumbnail_parts(h5gp), get_thumbnail_info(h5gp))
+
+def convert_catalog(infilename, outfilename):
+    '''
+    Copies a catalog in the old layout (one HDF5 group per file) to a new
+    file in the columnar layout
+    '''
+    with h5py.File(infilename, 'r') as infile:
+        rootgp = infile['ROOT']
+        rootpath = rootgp.attrs['RootPath']
+        outfile = h5py.File(outfilename, 'w')
+        try:
+            catalog = ColumnCatalog.create(outfile, rootpath,
+                                           algorithm=rootgp.attrs.get('HashAlgorithm', 'sha256'),
+                                           secondary=rootgp.attrs.get('SecondHashAlgorithm', None),
+                                           hashblocksize=rootgp.attrs.get('HashBlockSize', None))
+
+            def copy_dir(gp, row):
+                for (name, subgp) in gp.iteritems():
+                    ftype = FileType.get_num(subgp.attrs.get('Type', 'Dir'))
+                    subrow = catalog.require(name, ftype, parent=row)
+                    if ftype == FileType.Dir:
+                        copy_dir(subgp, subrow)
+                    elif ftype == FileType.File:
+                        copy_file_group(catalog, subrow, subgp)
+            copy_dir(rootgp, 0)
+
+            for hashgp in infile['DELETED'].itervalues():
+                for subgp in hashgp.itervalues():
+                    relpath = os.path.relpath(subgp.attrs['OriginalPath'], rootpath)
+                    row = catalog.add_deleted(relpath)
+                    copy_file_group(catalog, row, subgp)
+
+            catalog.flush()
+        finally:
+            outfile.close()
+
+def main(argv=None):
     logging.basicConfig(level=logging.DEBUG)
     
     #testdir = '/Users/etytel01/Documents/Scanner/backfile/test/testdir1'
@@ -446,6 +1226,21 @@ def main():
     else:
         testdir = '/Users/etytel01/Documents/Scanner/backfile/test/testthumbs'
         outfile = '/Users/etytel01/Documents/Scanner/backfile/test/newtest.h5'
+
+    parser = argparse.ArgumentParser(description='Scan a directory into a catalog')
+    parser.add_argument('path', nargs='?', default=testdir, help='directory to scan')
+    parser.add_argument('outfile', nargs='?', default=outfile, help='catalog file')
+    parser.add_argument('--algorithm', default=None,
+                        help='hash algorithm for a new catalog (default {0}; blake2b and blake2s '
+                             'need Python 3.6 or the pyblake2 package)'.format(DEFAULT_ALGORITHM))
+    parser.add_argument('--secondary', default=None, help='second hash algorithm')
+    parser.add_argument('--hashmode', choices=['full', 'staged'], default='full')
+    args = parser.parse_args(argv)
+    #fail before the scan starts if the algorithms aren't available
+    for algorithm in (args.algorithm, args.secondary):
+        if algorithm is not None:
+            get_hash_function(algorithm)
+    (testdir, outfile) = (args.path, args.outfile)
     #if os.path.exists(testdir):
     #    shutil.rmtree(testdir)
     #if os.path.exists(outfile):
@@ -461,7 +1256,8 @@ def main():
         status = None
     filedataglobal.status = status
     
-    scanner = FileDataWriter(outfile, testdir, status=status)
+    scanner = FileDataWriter(outfile, testdir, status=status, hashmode=args.hashmode,
+                             algorithm=args.algorithm, secondary=args.secondary)
     
     if PARALLEL:
         scanner.start()
@@ -472,7 +1268,9 @@ def main():
                 print '{0}: {1}/{2}'.format(state, curbytes, totalbytes)
                 time.sleep(0.5)
         except KeyboardInterrupt:
-            scanner.terminate()
+            #the scan gets Ctrl-C too, but not if it came from somewhere else
+            print 'Stopping after a checkpoint'
+            scanner.stop()
         scanner.join()
     else:
         scanner.run()
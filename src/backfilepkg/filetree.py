@@ -6,37 +6,123 @@ Created on Nov 27, 2012
 
 import sys
 import os, time
-import hashlib
+import binascii
+from collections import defaultdict, namedtuple
 import h5py
 import numpy as np
 
 from progress import ProgressCLI
 from thumbnail import get_thumbnail
+from dirscan import scan_dir, stat_mtime_ns
+from hashing import HASH_FUNCTION, HashStage, StagedFile, staged_hash, HashEngine, hash_into, \
+    DEFAULT_ALGORITHM, get_hash_function, digests_equal, digest_to_bytes, digest_to_array, \
+    dir_item, file_item, dir_digest, hash_blocks, merkle_hash
+from catalog import FileType, ColumnCatalog
 
 TIME_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
-HASH_FUNCTION = hashlib.sha256
-BLOCK_SIZE = 128 * HASH_FUNCTION().block_size
-
-def get_file_hash(filename, progress=None):
-    h = HASH_FUNCTION()
-    with open(filename, 'rb') as fid:
-        def readblock():
-            return fid.read(BLOCK_SIZE)
-        
-        for b in iter(readblock,''):
-            h.update(b)
-            if progress:
-                progress.update(len(b), info=filename)
+NS_PER_SEC = 10**9
+
+class EmptyChildren(dict):
+    '''
+    Read-only empty dict, shared as the children of every empty directory.
+    Use DirTree.add_child to add to a directory.
+    '''
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        raise TypeError('EMPTY_CHILDREN is shared; use add_child')
+
+    def setdefault(self, key, value=None):
+        raise TypeError('EMPTY_CHILDREN is shared; use add_child')
+
+    def update(self, *args, **kw):
+        raise TypeError('EMPTY_CHILDREN is shared; use add_child')
+
+EMPTY_CHILDREN = EmptyChildren()
+
+#cached summary of everything below a directory.  order and minorder are
+#the longest and shortest paths down to a leaf (see Node.order), newest is
+#the latest mtime, and digest is the directory's Merkle digest (see
+#hashing.dir_digest), which uses the size and mtime of files without a hash
+Aggregates = namedtuple('Aggregates', 'order minorder nfiles nbytes newest digest')
+
+def get_file_hash(filename, progress=None, algorithm=None, blocksize=None):
+    '''
+    Hash object for a file.  With a blocksize, its digest is the merkle_root
+    of the blocks, like in a catalog with that HashBlockSize.
+    '''
+    hashfcn = get_hash_function(algorithm)
+    if progress:
+        def callback(n):
+            progress.update(n, info=filename)
+    else:
+        callback = None
+    if blocksize:
+        return merkle_hash(hash_blocks(filename, blocksize, hashfcn, callback=callback), hashfcn)
+
+    h = hashfcn()
+    hash_into([h], filename, callback=callback)
                 
     return h
 
-def update_hashes(nodes):
+def update_hashes(nodes, staged=False):
+    '''
+    Hash the file nodes.  If staged is True, only hash as much as we need
+    to tell the nodes apart from each other, which is enough for finding
+    moved files and duplicates.  Nodes with a unique size or sample hash
+    are left without a full hash, and hashstage records why.
+    '''
+    if staged:
+        update_hashes_staged(nodes)
+        return
+        
     totalsize = sum([node.size for node in nodes])
+    #nodes from different trees may use different hash algorithms, or block sizes
+    byscheme = defaultdict(lambda: defaultdict(list))
+    for node in nodes:
+        byscheme[node.get_hash_scheme()][node.abspath()].append(node)
     
     with ProgressCLI(unit='sec', total=totalsize) as prog:
-        for node in nodes:
-            h = get_file_hash(node.abspath(), prog)
-            node.hashval = np.frombuffer(h.digest(), dtype=np.uint8, count=h.digest_size)
+        for ((algorithm, blocksize), bypath) in byscheme.iteritems():
+            engine = HashEngine(algorithm=algorithm, manifest=blocksize)
+            for (filename, hashval) in engine.imap(bypath.keys()):
+                for node in bypath[filename]:
+                    node.hashval = hashval
+                    node.hashstage = HashStage.Full
+                    prog.update(node.size, info=filename)
+
+def update_hashes_staged(nodes):
+    byalgorithm = defaultdict(list)
+    for node in nodes:
+        byalgorithm[node.get_hash_algorithm()].append(node)
+    for (algorithm, nodes1) in byalgorithm.iteritems():
+        update_hashes_staged_algorithm(nodes1, algorithm)
+        
+def update_hashes_staged_algorithm(nodes, algorithm):
+    stagedfiles = []
+    for node in nodes:
+        if node.islink:
+            continue
+        path = node.abspath()
+        if not os.path.exists(path):
+            #e.g., a removed file from a stored tree; can only be matched
+            #by a hash we already have
+            path = None
+        sf = StagedFile(path, node.size, sample=digest_to_array(node.samplehash),
+                        full=node.hashval, stage=node.hashstage)
+        sf.node = node
+        stagedfiles.append(sf)
+
+    def hashfiles(sfs):
+        fullnodes = [sf.node for sf in sfs]
+        update_hashes(fullnodes)
+        return dict([(sf.path, sf.node.hashval) for sf in sfs])
+
+    for sf in staged_hash(stagedfiles, hashfiles, get_hash_function(algorithm)):
+        sf.node.samplehash = sf.sample
+        sf.node.hashstage = sf.stage
+        if sf.full is not None:
+            sf.node.hashval = sf.full
             
 def update_thumbnails(nodes, progress=None):
     totalsize = sum([node.size for node in nodes])
@@ -53,15 +139,94 @@ def update_thumbnails(nodes, progress=None):
             progress.update(node.size, info=nm)
             
 
+def intern_path(path):
+    '''Interns a path, so that the index and the nodes share one copy'''
+    if isinstance(path, str):
+        return intern(path)
+    return path
+
+def cached_relpath(node):
+    '''
+    Relative path of a tree node, cached on the node.  Only the nodes up to
+    the nearest cached ancestor are computed.
+    '''
+    if node._relpath is not None:
+        return node._relpath
+    chain = []
+    top = node
+    while top._relpath is None and top.parent is not None:
+        chain.append(top)
+        top = top.parent
+    path = top._relpath if top._relpath is not None else ''
+    for n in reversed(chain):
+        path = intern_path(path + '/' + n.name if path else n.name)
+        n._relpath = path
+    return node._relpath
+
+def clear_relpaths(node):
+    '''Clears the cached paths for node and everything below it'''
+    for (_, n) in node.iternodes():
+        n._relpath = None
+
+def index_paths(paths, node):
+    '''Adds node and everything below it to a path index'''
+    for (_, n) in node.iternodes():
+        paths[n.relpath()] = n
+
+def unindex_paths(paths, node):
+    for (_, n) in node.iternodes():
+        key = n.relpath()
+        if paths.get(key) is n:
+            del paths[key]
+
+def contents_match(dir1, dir2):
+    '''
+    True if two directories have the same Merkle digest, which means that
+    everything below them is the same.  False doesn't mean they're different,
+    since a file with a hash and one without don't match.
+    '''
+    if not (hasattr(dir1, 'content_digest') and hasattr(dir2, 'content_digest')):
+        return False
+    if dir1.get_hash_scheme() != dir2.get_hash_scheme():
+        return False
+    return dir1.content_digest() == dir2.content_digest()
+
+def files_equal(node1, node2):
+    '''
+    Same contents, by hash if both files have one, or else by size and
+    modification time
+    '''
+    if node1.hashval is not None and node2.hashval is not None and \
+            node1.get_hash_scheme() == node2.get_hash_scheme():
+        return digests_equal(node1.hashval, node2.hashval)
+    elif node1.mtime is None or node2.mtime is None:
+        return (node1.size == node2.size) and (node1.mtime == node2.mtime)
+    else:
+        #the trees in HDF5 files only keep whole seconds
+        return (node1.size == node2.size) and \
+            (node1.mtime // NS_PER_SEC == node2.mtime // NS_PER_SEC)
+
+def copy_node(node, parent):
+    '''
+    A copy of node (from any kind of tree) and everything below it, for the
+    directory parent, which it isn't added to
+    '''
+    if node.isfile:
+        copy = FileNode(node.name, parent, islink=node.islink)
+        copy.update(node)
+        return copy
+    copy = DirTree(node.name, parent)
+    for child in node.children.itervalues():
+        copy.add_child(copy_node(child, copy))
+    return copy
+
 class Node(object):
     '''
     Hierarchy of files and directories, with some simple data
     '''
 
-    name = None
-    parent = None
-    root = None
-    children = dict()
+    #trees can have millions of nodes, so they don't get a __dict__
+    __slots__ = ('name', 'parent', 'root')
     
     @property    
     def isdir(self):
@@ -103,8 +268,6 @@ class Node(object):
         self.name = name
         self.parent = parent
         self.children = dict()
-        self.isdir = True
-        self.isfile = False
         if parent is not None:
             self.root = parent.root
                     
@@ -156,6 +319,22 @@ class Node(object):
         
     def getroot(self):
         return self.root
+    
+    def get_hash_algorithm(self):
+        '''Name of the hash algorithm that the tree uses'''
+        if self.root is not None:
+            return self.root.hashalgorithm
+        return DEFAULT_ALGORITHM
+
+    def get_hash_scheme(self):
+        '''
+        The hash algorithm and the block size for trees from catalogs with
+        block manifests (None if not).  Digests can only be compared if
+        they have the same scheme.
+        '''
+        if self.root is not None:
+            return (self.root.hashalgorithm, self.root.hashblocksize)
+        return (DEFAULT_ALGORITHM, None)
             
     def isorder(self, isord):
         '''
@@ -166,6 +345,9 @@ class Node(object):
             return isord == 0
         elif len(self.children) == 0:
             return isord == 1
+        elif isord < 1:
+            #directories are at least order 1, so don't descend any further
+            return False
         else:
             for node in self.children.values():
                 if not node.isorder(isord-1):
@@ -251,11 +433,15 @@ class Node(object):
             
 
 class FileNode(Node):
-    size = 0
-    modified = None
-    hashval = None
-    islink = False
-    thumbnail = None
+    '''
+    A file.  Digests are kept as strings and the modification time as integer
+    nanoseconds (mtime), to keep big trees small.  hashval, samplehash and
+    modified can still be set from uint8 arrays and struct_times.
+    '''
+    
+    __slots__ = ('size', 'mtime', '_hashval', '_samplehash', 'hashstage', 'islink',
+                 'linktarget', 'thumbnail', '_relpath')
+    children = None
     
     def __init__(self, name, parent, size=0, modified=None, hashval=None, islink=False):
         self.name = name
@@ -265,17 +451,56 @@ class FileNode(Node):
         self.islink = islink
         self.linktarget = None
         self.hashval = hashval
+        self.samplehash = None
+        self.hashstage = None
         self.thumbnail = None
+        self._relpath = None
         
-        self.children = None
         self.root = parent.root
     
+    def relpath(self):
+        return cached_relpath(self)
+    
+    def abspath(self):
+        return self.root.name + '/' + cached_relpath(self)
+    
+    @property
+    def hashval(self):
+        return self._hashval
+    
+    @hashval.setter
+    def hashval(self, value):
+        self._hashval = digest_to_bytes(value)
+        #from_file, from_entry and update all set the hash, so this is
+        #where the directories above find out that the file changed
+        if self.parent is not None:
+            self.parent.invalidate()
+    
+    @property
+    def samplehash(self):
+        return self._samplehash
+    
+    @samplehash.setter
+    def samplehash(self, value):
+        self._samplehash = digest_to_bytes(value)
+    
+    @property
+    def modified(self):
+        '''Modification time as a time.struct_time, like time.localtime'''
+        if self.mtime is None:
+            return None
+        return time.localtime(self.mtime // NS_PER_SEC)
+    
+    @modified.setter
+    def modified(self, value):
+        if value is None:
+            self.mtime = None
+        else:
+            self.mtime = int(time.mktime(value)) * NS_PER_SEC
+    
     def __eq__(self, other):
-        if isinstance(other, FileNode):
-            if self.hashval is not None and other.hashval is not None:
-                return all(self.hashval == other.hashval)
-            else:
-                return (self.size == other.size) and (self.modified == other.modified)
+        if isinstance(other, Node) and other.isfile:
+            return files_equal(self, other)
         else:
             return False
     
@@ -283,37 +508,57 @@ class FileNode(Node):
         return not self.__eq__(other)
                 
     def __str__(self):
-        if self.hashval:
-            hd = ''.join("%02X" % n for n in self.hashval)
-        else:
-            hd = 'None'
-        return '{0}: hash = {1}'.format(self.abspath(), hd)
+        return '{0}: hash = {1}'.format(self.abspath(), self.hexdigest())
 
     def hexdigest(self):
         if self.hashval is not None:
-            return ''.join("%02X" % n for n in self.hashval)
+            return binascii.hexlify(self.hashval).upper()
         else:
             return 'None'
             
     def from_file(self, fullpath=None, dohash=False):
         if not fullpath:
             fullpath = self.abspath()
-        self.size = os.path.getsize(fullpath)
-        self.modified = time.localtime(os.path.getmtime(fullpath))
+        st = os.stat(fullpath)
+        self.size = st.st_size
+        self.mtime = stat_mtime_ns(st)
+        self.samplehash = None
         if dohash:
-            h = get_file_hash(fullpath)
-            self.hashval = np.frombuffer(h.digest(), dtype=np.uint8, count=h.digest_size)
+            (algorithm, blocksize) = self.get_hash_scheme()
+            h = get_file_hash(fullpath, algorithm=algorithm, blocksize=blocksize)
+            self.hashval = h.digest()
+            self.hashstage = HashStage.Full
         else:
             self.hashval = None
+            self.hashstage = None
+
+    def from_entry(self, entry, dohash=False):
+        '''
+        Like from_file, but uses the stat data already in a dirscan.ScanEntry
+        '''
+        self.size = entry.size
+        self.mtime = entry.mtime_ns
+        self.samplehash = None
+        if dohash:
+            (algorithm, blocksize) = self.get_hash_scheme()
+            h = get_file_hash(entry.path, algorithm=algorithm, blocksize=blocksize)
+            self.hashval = h.digest()
+            self.hashstage = HashStage.Full
+        else:
+            self.hashval = None
+            self.hashstage = None
 
     def update(self, other):
         assert(other.name == self.name)
         self.size = other.size
-        self.modified = other.modified
+        self.mtime = other.mtime
         self.islink = other.islink
         self.linktarget = other.linktarget
         self.hashval = other.hashval
+        self.samplehash = other.samplehash
+        self.hashstage = other.hashstage
         self.thumbnail = other.thumbnail
+
                     
     def to_hdf5(self, h5gp): 
         '''Save the file info to an HDF5 group'''            
@@ -331,6 +576,13 @@ class FileNode(Node):
         else:
             gp1.attrs["IsLink"] = False
         
+        if self.hashstage is not None:
+            gp1.attrs['HashStage'] = HashStage.get_name(self.hashstage)
+        if self.samplehash is not None:
+            gp1.attrs['SampleHash'] = digest_to_array(self.samplehash)
+        elif 'SampleHash' in gp1.attrs:
+            del gp1.attrs['SampleHash']
+            
         if self.hashval is not None:
             if 'Hash' in gp1:
                 hset = gp1['Hash']
@@ -341,22 +593,22 @@ class FileNode(Node):
                 
                 lasthash = hset[:,n-1]
                 
-                if np.any(lasthash != self.hashval):
+                if not digests_equal(lasthash, self.hashval):
                     hset.resize((ds,n+1))
                     dateset.resize((9,n+1))
                     ind = n
                 else:
                     ind = n-1
             else:
-                hset = gp1.create_dataset('Hash',(HASH_FUNCTION().digest_size,1),
-                                       maxshape=(HASH_FUNCTION().digest_size,None),
+                hset = gp1.create_dataset('Hash',(len(self.hashval),1),
+                                       maxshape=(len(self.hashval),None),
                                        dtype='uint8')
                 dateset = gp1.create_dataset('HashDate',(9,1),
                                        maxshape=(9,None),
                                        dtype='int16')
                 ind = 0
                 
-            hset[:,ind] = self.hashval
+            hset[:,ind] = digest_to_array(self.hashval)
             dateset[:,ind] = np.array(time.localtime(), dtype='int16')
             
         if self.thumbnail is not None:
@@ -369,8 +621,12 @@ class FileNode(Node):
         self.islink = h5gp.attrs["IsLink"]
         ## TODO: process links better here
         
-        if "Hash" in h5gp:
-            self.hashval = np.zeros(HASH_FUNCTION().digest_size, dtype='uint8')
+        if 'HashStage' in h5gp.attrs:
+            self.hashstage = HashStage.get_num(h5gp.attrs['HashStage'])
+        if 'SampleHash' in h5gp.attrs:
+            self.samplehash = h5gp.attrs['SampleHash']
+            
+        if "Hash" in h5gp and self.hashstage in (None, HashStage.Full):
             self.hashval = h5gp["Hash"][:,-1]
         else:
             self.hashval = None
@@ -378,16 +634,183 @@ class FileNode(Node):
         self.thumbnail = get_thumbnail(h5obj=h5gp)
         
 class DirTree(Node):
+    __slots__ = ('children', 'id', '_relpath', '_aggregates')
+    
     def __init__(self, name=None, parent=None):
         self.name = name
         self.parent = parent
         self.id = None
+        self._relpath = None
+        self._aggregates = None
         if parent is not None:
             self.root = parent.root
-        self.children = dict()
+        self.children = EMPTY_CHILDREN
+    
+    def relpath(self):
+        return cached_relpath(self)
+    
+    def abspath(self):
+        if self.parent is None or getattr(self, 'root', None) is None:
+            return super(DirTree, self).abspath()
+        return self.root.name + '/' + cached_relpath(self)
+    
+    def indexed_paths(self):
+        '''
+        The root's path index, if the root has one and this directory is in it
+        '''
+        paths = getattr(getattr(self, 'root', None), 'paths', None)
+        if paths is not None and paths.get(self.relpath()) is self:
+            return paths
+        return None
+    
+    def add_child(self, node):
+        '''Adds (or replaces) a node in this directory'''
+        paths = self.indexed_paths()
+        if paths is not None and node.name in self.children:
+            unindex_paths(paths, self.children[node.name])
+        if self.children is EMPTY_CHILDREN:
+            self.children = dict()
+        
+        node.parent = self
+        if node._relpath is not None:
+            #it was somewhere else, or called something else
+            parentpath = self.relpath()
+            if node._relpath != (parentpath + '/' + node.name if parentpath else node.name):
+                clear_relpaths(node)
+        self.children[node.name] = node
+        if paths is not None:
+            index_paths(paths, node)
+        self.invalidate()
+    
+    def remove_child(self, name):
+        paths = self.indexed_paths()
+        if paths is not None:
+            unindex_paths(paths, self.children[name])
+        del self.children[name]
+        if not self.children:
+            self.children = EMPTY_CHILDREN
+        self.invalidate()
+    
+    def invalidate(self):
+        '''
+        Drops the cached aggregates here and in the directories above.  A
+        directory's aggregates are only cached if everything below it is,
+        so we can stop at the first one that's already invalid.
+        '''
+        node = self
+        while node is not None and node._aggregates is not None:
+            node._aggregates = None
+            node = node.parent
+    
+    def aggregates(self):
+        '''
+        Aggregates for this directory, recomputed from the children's if
+        anything below has changed since the last time
+        '''
+        if self._aggregates is not None:
+            return self._aggregates
+        
+        order = minorder = None
+        nfiles = nbytes = 0
+        newest = None
+        items = []
+        for (name, node) in self.children.iteritems():
+            if node.isdir:
+                sub = node.aggregates()
+                (suborder, subminorder) = (sub.order, sub.minorder)
+                nfiles += sub.nfiles
+                nbytes += sub.nbytes
+                mtime = sub.newest
+                items.append(dir_item(name, 'D', sub.digest))
+            else:
+                suborder = subminorder = 0
+                nfiles += 1
+                nbytes += node.size
+                mtime = node.mtime
+                items.append(file_item(name, node.hashval, node.size,
+                                       None if mtime is None else mtime // NS_PER_SEC,
+                                       islink=node.islink))
+            
+            order = suborder if order is None else max(order, suborder)
+            minorder = subminorder if minorder is None else min(minorder, subminorder)
+            if mtime is not None and (newest is None or mtime > newest):
+                newest = mtime
+        
+        if order is None:
+            #empty directory
+            order = minorder = 0
+        digest = dir_digest(items, get_hash_function(self.get_hash_algorithm()))
+        self._aggregates = Aggregates(order + 1, minorder + 1, nfiles, nbytes, newest, digest)
+        return self._aggregates
+    
+    def file_count(self):
+        return self.aggregates().nfiles
+    
+    def total_size(self):
+        return self.aggregates().nbytes
+    
+    def newest_mtime(self):
+        return self.aggregates().newest
+    
+    def content_digest(self):
+        return self.aggregates().digest
+    
+    def order(self):
+        return self.aggregates().order
+    
+    def isorder(self, isord):
+        agg = self.aggregates()
+        return agg.order == isord and agg.minorder == isord
+    
+    def add_copy(self, node):
+        '''Adds (or replaces) a copy of node, which can be from any kind of tree'''
+        self.add_child(copy_node(node, self))
+
+    def move_child(self, name, newparent, newname=None):
+        '''Moves and/or renames an item in this directory'''
+        node = self.children[name]
+        self.remove_child(name)
+        if newname is not None:
+            node.name = newname
+        newparent.add_child(node)
+    
+    def __getitem__(self, relpath):
+        '''
+        Looks up a node using the root's path index, if it has one
+        '''
+        root = getattr(self, 'root', None)
+        if not isinstance(root, RootTree):
+            return super(DirTree, self).__getitem__(relpath)
+        if (len(relpath) > 0) and relpath[0] == '/':
+            #actually an abspath
+            (_, common, relpath) = relpath.partition(self.abspath() + '/')
+            if not common:
+                raise KeyError
+        if len(relpath) == 0:
+            if self.parent is None:
+                return self
+            raise KeyError
+        
+        base = self.relpath()
+        node = root.get_paths().get(base + '/' + relpath if base else relpath)
+        if node is None:
+            if relpath == self.name:
+                return self
+            raise KeyError
+        return node
+    
+    def __contains__(self, relpath):
+        try:
+            self[relpath]
+        except KeyError:
+            return False
+        return True
                     
     def __eq__(self, other):
-        #check that all of our children are present and
+        if contents_match(self, other):
+            return True
+        #the digests can differ when one side has hashes and the other doesn't,
+        #so check that all of our children are present and
         #equal to those in other
         for (name, node) in self.children.iteritems():
             if name not in other.children:
@@ -404,16 +827,7 @@ class DirTree(Node):
         return True
 
     def __ne__(self, other):
-        for (name, node) in self.children:
-            if name not in other.children:
-                return True
-            else:
-                if node == other.children[name]:
-                    continue
-                else:
-                    return True
-        else:
-            return False
+        return not self.__eq__(other)
 
     def update(self, other):
         assert(self.name == other.name)
@@ -426,23 +840,20 @@ class DirTree(Node):
         '''
         Builds a file tree based on an existing path
         '''
-        for item in os.listdir(path):
-            if item in exclude:
-                continue
-            
-            pathname = os.path.join(path,item)
-            if os.path.isdir(pathname):
+        for entry in scan_dir(path, exclude):
+            item = entry.name
+            if entry.isdir:
                 subdir = DirTree(name=item, parent=self)
-                subdir.from_path(pathname, dohash)
-                self.children[item] = subdir
-            elif os.path.islink(pathname):
+                subdir.from_path(entry.path, dohash, exclude)
+                self.add_child(subdir)
+            elif entry.islink:
                 sub = FileNode(name=item, parent=self, islink=True)
-                sub.linktarget = os.path.realpath(pathname)
-                self.children[item] = sub
+                sub.linktarget = os.path.realpath(entry.path)
+                self.add_child(sub)
             else:
                 sub = FileNode(name=item, parent=self)
-                sub.from_file(pathname, dohash)
-                self.children[item] = sub
+                sub.from_entry(entry, dohash)
+                self.add_child(sub)
 
     def update_from_path(self, path, exclude=['.annex']):
         '''
@@ -455,36 +866,35 @@ class DirTree(Node):
         #start with all items
         deleted = set(self.children.keys())
         
-        for name in os.listdir(path):
-            if name in exclude:
-                continue 
+        for entry in scan_dir(path, exclude):
+            name = entry.name
             
             #remove names that we find
             deleted.discard(name)
                 
-            pathname = os.path.join(path, name)
-            if os.path.isdir(pathname):
+            pathname = entry.path
+            if entry.isdir:
                 if (name in self.children) and self.children[name].isdir:
                     needshash += self.children[name].update_from_path(pathname, exclude)
                 else:
                     subdir = DirTree(name=name, parent=self)
-                    subdir.from_path(pathname, False)                    
-                    self.children[name] = subdir
+                    subdir.from_path(pathname, False, exclude)
+                    self.add_child(subdir)
                     needshash += subdir.get_needs_hash()
-            elif os.path.islink(pathname):
+            elif entry.islink:
                 sub = FileNode(name=name, parent=self, islink=True)
                 sub.linktarget = os.path.realpath(pathname)
-                self.children[name] = sub
+                self.add_child(sub)
             else:
                 ondisk = FileNode(name=name, parent=self)
-                ondisk.from_file(pathname, dohash=False)
+                ondisk.from_entry(entry, dohash=False)
                 
                 if (name not in self.children) or (ondisk != self.children[name]):
-                    self.children[name] = ondisk
+                    self.add_child(ondisk)
                     needshash.append(ondisk)
 
         for name in deleted:
-            del self.children[name]
+            self.remove_child(name)
             
         return needshash
                         
@@ -501,17 +911,48 @@ class DirTree(Node):
             else:
                 sub = DirTree(name=item, parent=self)
                 sub.from_hdf5(subgp)
-            self.children[item] = sub
+            self.add_child(sub)
 
 
                 
 class RootTree(DirTree):
-    def __init__(self, name=None, ident=None):
+    '''
+    Top of a file tree.  paths is an index of relative path -> node for the
+    whole tree, which is built the first time a path is looked up, and then
+    kept up to date by add_child, remove_child and move_child.
+    '''
+    __slots__ = ('hashalgorithm', 'hashblocksize', 'deletedgp', 'paths')
+    
+    def __init__(self, name=None, ident=None, algorithm=None, blocksize=None):
         self.name = name
         self.parent = None
         self.root = self
         self.id = ident
-        self.children = dict()
+        self._relpath = ''
+        self._aggregates = None
+        self.paths = None
+        self.children = EMPTY_CHILDREN
+        if algorithm is None:
+            algorithm = DEFAULT_ALGORITHM
+        get_hash_function(algorithm)
+        self.hashalgorithm = algorithm
+        self.hashblocksize = blocksize
+
+    def duplicate(self, parent=None):
+        node = RootTree(self.name, self.id, self.hashalgorithm, self.hashblocksize)
+        for child in self.children.itervalues():
+            node.add_copy(child)
+        return node
+
+    def get_paths(self):
+        '''The path index, which is built if we don't have it yet'''
+        if self.paths is None:
+            self.paths = dict()
+            index_paths(self.paths, self)
+        return self.paths
+
+    def abspath(self):
+        return self.name if self.name else ''
 
     def make_id(self):
         '''
@@ -544,6 +985,13 @@ class RootTree(DirTree):
         else:
             gp1.attrs['RootPath'] = self.name
         
+        if 'HashAlgorithm' in gp1.attrs:
+            assert(gp1.attrs['HashAlgorithm'] == self.hashalgorithm)
+        else:
+            gp1.attrs['HashAlgorithm'] = self.hashalgorithm
+        if self.hashblocksize:
+            gp1.attrs['HashBlockSize'] = self.hashblocksize
+        
         if self.children:
             for node in self.children.values():
                 node.to_hdf5(dirgp)
@@ -551,9 +999,14 @@ class RootTree(DirTree):
 
     def from_hdf5(self, h5gp):
         '''
-        Builds the file tree from an hdf5 group
+        Builds the file tree from an hdf5 group, or from a columnar catalog
+        (see catalog.py) if the file has one
         '''
         
+        if ColumnCatalog.exists(h5gp):
+            self.from_catalog(ColumnCatalog.open(h5gp))
+            return
+        
         #make sure we're asking for a root group
         assert(self.id is not None)
                 
@@ -561,10 +1014,54 @@ class RootTree(DirTree):
         
         assert('RootPath' in rootgp.attrs)
         self.name = rootgp.attrs['RootPath']
+        #trees from before the attribute existed are sha256
+        self.hashalgorithm = rootgp.attrs.get('HashAlgorithm', 'sha256')
+        self.hashblocksize = rootgp.attrs.get('HashBlockSize', None)
         
         dirgp = rootgp['Tree']
         super(RootTree, self).from_hdf5(dirgp)
 
+    def from_catalog(self, catalog):
+        '''
+        Builds the file tree from a ColumnCatalog
+        '''
+        self.name = catalog.rootpath
+        self.hashalgorithm = catalog.algorithm
+        self.hashblocksize = catalog.hashblocksize
+        self.children = EMPTY_CHILDREN
+        self.paths = None
+        
+        #parents always come before their children
+        nodes = {0: self}
+        filerows = []
+        filenodes = []
+        for row in xrange(1, catalog.nrows):
+            parentrow = catalog.columns['Parent'][row]
+            if parentrow < 0 or parentrow not in nodes:
+                #deleted
+                continue
+            parent = nodes[parentrow]
+            name = catalog.names[row]
+            item = catalog.read(row)
+            if item.type == FileType.Dir:
+                sub = DirTree(name=name, parent=parent)
+                nodes[row] = sub
+            elif item.type == FileType.Link:
+                sub = FileNode(name=name, parent=parent, islink=True)
+            else:
+                sub = FileNode(name=name, parent=parent, size=item.size,
+                               modified=item.modified, hashval=item.hashval)
+                sub.hashstage = item.hashstage
+                sub.samplehash = item.sample
+                if item.isthumbnail:
+                    filerows.append(row)
+                    filenodes.append(sub)
+            parent.add_child(sub)
+
+        #read all of the thumbnails together
+        for (sub, thumb) in zip(filenodes, catalog.get_thumbnails_rows(filerows)):
+            sub.thumbnail = thumb
+
     def from_path(self, path, dohash=False, exclude=['.annex']):
         '''
         Builds a file tree based on an existing path
@@ -594,12 +1091,12 @@ class RootTree(DirTree):
             if isdir:
                 subdir = DirTree(name=upname, parent=parent)
                 subdir.from_path(fullpath, dohash)
-                parent.children[upname] = subdir
+                parent.add_child(subdir)
                 needshash = [node for node in subdir.iternodes()]
             else:
                 sub = FileNode(name=upname, parent=parent)
                 sub.from_file(fullpath, dohash)
-                parent.children[upname] = sub
+                parent.add_child(sub)
                 needshash = [sub]
         else:
             if not isdir:
@@ -623,12 +1120,11 @@ class RootTree(DirTree):
         else:
             parent = self
             
-        del parent.children[upname]        
+        parent.remove_child(upname)
 
     def deleted_to_hdf5(self, deleted):
         for (name,h5ref) in deleted:
             if 'Hash' in h5ref:
-                hashval1 = np.zeros(HASH_FUNCTION().digest_size, dtype='uint8')
                 hashval1 = h5ref["Hash"][:,-1]
                 
                 hashtxt1 = ''.join("%02X" % n for n in hashval1)
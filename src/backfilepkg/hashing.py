@@ -0,0 +1,714 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Hashing code shared by filedata and filetree.
+"""
+
+import os, io, time
+import stat
+import mmap
+import struct
+import logging
+import threading
+import random
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from collections import defaultdict
+import hashlib
+import numpy as np
+
+HASH_FUNCTION = hashlib.sha256
+BLOCK_SIZE = 128 * HASH_FUNCTION().block_size
+
+#hash algorithms a catalog can use, by the name stored in its HashAlgorithm
+#attribute.  Catalogs without the attribute are sha256
+HASH_ALGORITHMS = {'sha256': hashlib.sha256,
+                   'sha512': hashlib.sha512,
+                   'sha1': hashlib.sha1,
+                   'md5': hashlib.md5}
+#BLAKE2 is faster than sha256, but on Python 2 it needs the optional pyblake2
+#package (see README.md)
+if hasattr(hashlib, 'blake2b'):
+    HASH_ALGORITHMS['blake2b'] = hashlib.blake2b
+    HASH_ALGORITHMS['blake2s'] = hashlib.blake2s
+else:
+    try:
+        import pyblake2
+        HASH_ALGORITHMS['blake2b'] = pyblake2.blake2b
+        HASH_ALGORITHMS['blake2s'] = pyblake2.blake2s
+    except ImportError:
+        pass
+DEFAULT_ALGORITHM = 'sha256'
+
+def get_hash_function(algorithm=None):
+    '''
+    Hash constructor for the algorithm name (None for the default)
+    '''
+    if algorithm is None:
+        algorithm = DEFAULT_ALGORITHM
+    if algorithm in ('blake2b', 'blake2s') and algorithm not in HASH_ALGORITHMS:
+        raise ValueError('{0} needs Python 3.6 or the pyblake2 package'.format(algorithm))
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError('Unknown or unavailable hash algorithm: {0}'.format(algorithm))
+    return HASH_ALGORITHMS[algorithm]
+
+def get_digest_size(algorithm=None):
+    return get_hash_function(algorithm)().digest_size
+
+def digest_to_bytes(digest):
+    '''
+    Digest as a string, which is compact and can be a dict key.
+    Takes a uint8 array or a string.
+    '''
+    if digest is None:
+        return None
+    if isinstance(digest, np.ndarray):
+        return digest.tostring()
+    return bytes(digest)
+
+def digest_to_array(digest):
+    '''Digest as a uint8 array, from a string or an array'''
+    if digest is None:
+        return None
+    if isinstance(digest, np.ndarray):
+        return digest
+    return np.frombuffer(digest, dtype=np.uint8)
+
+def digests_equal(hash1, hash2):
+    '''
+    True if the two digests are the same.  They can be uint8 arrays or
+    strings.  Digests of different sizes came from different algorithms,
+    so they're never equal.
+    '''
+    return digest_to_bytes(hash1) == digest_to_bytes(hash2)
+
+def digest_keys(digests):
+    '''
+    Sort keys for an (n, digestsize) array of digests: the first 8 bytes,
+    as a big endian integer, so the keys sort in the same order as the
+    digests
+    '''
+    prefix = np.ascontiguousarray(digests[:, :8])
+    return prefix.view('>u8').ravel().astype('u8')
+
+def digest_voids(digests):
+    '''One void item for each digest, so they can be compared whole'''
+    digests = np.ascontiguousarray(digests, dtype='uint8')
+    return digests.view('V{0}'.format(digests.shape[1])).ravel()
+
+def sort_digests(digests):
+    '''
+    Order that sorts an (n, digestsize) array of digests, so identical
+    digests are next to each other.  Sorting the integer keys is much
+    faster than sorting the digests, and only the rare runs of equal keys
+    with different digests are sorted on the whole digest.
+    '''
+    keys = digest_keys(digests)
+    order = np.argsort(keys)
+    keys = keys[order]
+    voids = digest_voids(digests)[order]
+    differ = (keys[1:] == keys[:-1]) & (voids[1:] != voids[:-1])
+    for key in np.unique(keys[1:][differ]):
+        start = np.searchsorted(keys, key, side='left')
+        stop = np.searchsorted(keys, key, side='right')
+        order[start:stop] = order[start:stop][np.argsort(voids[start:stop])]
+    return order
+
+#number of bytes hashed from the head and the tail of a file for the sample hash
+SAMPLE_SIZE = 64 * 1024
+
+#read size for the hashing threads.  hashlib releases the GIL during each
+#update, so bigger reads mean less time holding it
+READ_SIZE = 1024 * 1024
+#hashing threads per storage device.  More than a couple of readers per
+#spinning disk just adds seeks
+THREADS_PER_DEVICE = 2
+#bytes a hashing thread reads before it updates the shared status
+STATUS_STRIDE = 16 * 1024 * 1024
+
+#regular files at least this big are hashed straight out of a memory map,
+#without copying them into a read buffer
+USE_MMAP = True
+MMAP_THRESHOLD = 4 * 1024 * 1024
+#bytes passed to each hash update (and each progress callback) from a memory map
+MMAP_STRIDE = 16 * 1024 * 1024
+
+#default block size for block hash manifests
+MANIFEST_BLOCK_SIZE = 1024 * 1024
+#number of existing blocks that are read again to check that a file was only
+#appended to
+VERIFY_BLOCKS = 4
+
+class HashStage:
+    '''
+    Which stage of staged hashing resolved a file:
+      Size - its size is unique, so it wasn't read at all
+      Sample - its head+tail sample is unique among files of the same size
+      Full - it was hashed completely
+    '''
+    Size, Sample, Full = range(3)
+
+    @staticmethod
+    def get_name(num):
+        name = [nm1 for (nm1,num1) in HashStage.__dict__.iteritems() if num1 == num]
+        if len(name) == 1:
+            return name[0]
+        else:
+            raise TypeError
+
+    @staticmethod
+    def get_num(name):
+        return HashStage.__dict__[name]
+
+def get_sample_hash(filename, size, hashfcn=HASH_FUNCTION):
+    '''
+    Hash of the file size plus the first and last SAMPLE_SIZE bytes.
+    Files smaller than 2*SAMPLE_SIZE are hashed completely.
+    '''
+    h = hashfcn()
+    h.update(struct.pack('<Q', size))
+    with open(filename, 'rb') as fid:
+        if size <= 2*SAMPLE_SIZE:
+            h.update(fid.read())
+        else:
+            h.update(fid.read(SAMPLE_SIZE))
+            fid.seek(-SAMPLE_SIZE, 2)
+            h.update(fid.read(SAMPLE_SIZE))
+
+    return np.frombuffer(h.digest(), dtype=np.uint8, count=h.digest_size)
+
+class StagedFile(object):
+    '''
+    A file going through staged hashing.  sample and full are the digests
+    we already know (or None), and stage is the stage that resolved it.
+    If path is None, the file can't be read, so it can only be compared
+    through a full hash that's already known.
+    '''
+
+    def __init__(self, path, size, sample=None, full=None, stage=None):
+        self.path = path
+        self.size = size
+        self.sample = sample
+        self.full = full
+        self.stage = stage
+        self.changed = False
+
+    def set(self, stage, sample=None, full=None):
+        if sample is not None:
+            self.sample = sample
+            self.changed = True
+        if full is not None:
+            self.full = full
+            self.changed = True
+        if stage != self.stage:
+            self.stage = stage
+            self.changed = True
+
+def staged_hash(files, hashfiles, hashfcn=HASH_FUNCTION):
+    '''
+    Resolves a list of StagedFile objects with as little reading as possible.
+    Files are grouped by size, and sizes that occur once are not read. Files
+    that share a size get a sample hash, and only the ones whose samples
+    collide are hashed fully.
+
+    hashfiles is called with a list of StagedFile objects that need full
+    hashes, and should return a dict of path -> digest.  That way the caller
+    can hash them in parallel.  hashfcn is used for the sample hashes.
+
+    Returns the files whose stage or digests changed.
+    '''
+    bysize = defaultdict(list)
+    for sf in files:
+        bysize[sf.size].append(sf)
+
+    needsfull = []
+    nsample = 0
+    for (size, bucket) in bysize.iteritems():
+        if len(bucket) == 1:
+            sf = bucket[0]
+            if sf.full is None:
+                sf.set(HashStage.Size)
+            continue
+
+        bysample = defaultdict(list)
+        unsampled = False
+        for sf in bucket:
+            if sf.sample is None and sf.path is not None:
+                sf.set(sf.stage, sample=get_sample_hash(sf.path, sf.size, hashfcn))
+                nsample += 1
+            if sf.sample is None:
+                unsampled = True
+            else:
+                bysample[sf.sample.tostring()].append(sf)
+
+        if unsampled:
+            #some files can only be compared by their full hash, so everyone
+            #in this size bucket needs one
+            groups = [bucket]
+        else:
+            groups = bysample.values()
+
+        for group in groups:
+            if len(group) == 1 and not unsampled:
+                if group[0].full is None:
+                    group[0].set(HashStage.Sample)
+            else:
+                for sf in group:
+                    if sf.full is None and sf.path is not None:
+                        needsfull.append(sf)
+                    elif sf.full is not None:
+                        sf.set(HashStage.Full)
+
+    logging.debug('Staged hashing: %d files, %d sample hashes, %d full hashes',
+                  len(files), nsample, len(needsfull))
+
+    if needsfull:
+        digests = hashfiles(needsfull)
+        for sf in needsfull:
+            sf.set(HashStage.Full, full=digests[sf.path])
+
+    return [sf for sf in files if sf.changed]
+
+class MemoryFile(object):
+    '''
+    Read-only file over data that is already in memory, so that the hashing
+    functions can run on a file that was read for something else
+    '''
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.view = None
+
+    def readinto(self, buf):
+        n = max(0, min(len(buf), len(self.view) - self.pos))
+        buf[:n] = self.view[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.view)
+        self.pos = offset
+
+def open_data(filename, data=None):
+    '''
+    Opens filename for reading, or data if the contents were already read
+    '''
+    if data is not None:
+        return MemoryFile(data)
+    return io.open(filename, 'rb')
+
+def read_file(filename):
+    '''
+    Reads the whole file into a new bytearray with a single open
+    '''
+    with io.open(filename, 'rb') as fid:
+        size = os.fstat(fid.fileno()).st_size
+        data = bytearray(size)
+        view = memoryview(data)
+        n = 0
+        while n < size:
+            n1 = fid.readinto(view[n:])
+            if not n1:
+                break
+            n += n1
+        if n < size:
+            #file got shorter while we were reading it
+            del data[n:]
+    return data
+
+def hash_into(hashes, filename, buf=None, callback=None, usemmap=None, data=None):
+    '''
+    Reads filename into the buffer buf (a bytearray, which is reused from file
+    to file), updating each of the hash objects in hashes.  callback is called
+    with the number of bytes after each read.
+
+    If usemmap is True (default is USE_MMAP), regular files bigger than
+    MMAP_THRESHOLD are hashed from a memory map instead.  If data is given,
+    it's the contents of the file, and the file isn't opened.
+    '''
+    if usemmap is None:
+        usemmap = USE_MMAP
+    with open_data(filename, data) as fid:
+        if usemmap and data is None:
+            st = os.fstat(fid.fileno())
+            if stat.S_ISREG(st.st_mode) and st.st_size >= MMAP_THRESHOLD:
+                if hash_mmap(hashes, fid, st.st_size, callback):
+                    return hashes
+
+        if buf is None:
+            buf = bytearray(BLOCK_SIZE)
+        view = memoryview(buf)
+        while True:
+            n = fid.readinto(buf)
+            if not n:
+                break
+            for h in hashes:
+                h.update(view[:n])
+            if callback:
+                callback(n)
+    return hashes
+
+def hash_mmap(hashes, fid, size, callback=None):
+    '''
+    Hashes an open file through a read-only memory map, MMAP_STRIDE bytes
+    at a time.  Returns False if the file can't be mapped, so the caller
+    can fall back to reading it.
+    '''
+    try:
+        mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return False
+
+    try:
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            view = memoryview(mm)
+        except TypeError:
+            #Python 2 mmaps only have the old buffer interface
+            view = None
+
+        size = min(size, len(mm))
+        for offset in xrange(0, size, MMAP_STRIDE):
+            n = min(MMAP_STRIDE, size - offset)
+            if view is not None:
+                block = view[offset:offset+n]
+            else:
+                block = buffer(mm, offset, n)
+            for h in hashes:
+                h.update(block)
+            del block
+            if callback:
+                callback(n)
+
+        if view is not None:
+            view.release()
+    finally:
+        mm.close()
+    return True
+
+def hash_blocks(filename, blocksize, hashfcn, start=0, buf=None, callback=None, hashes=(),
+                data=None):
+    '''
+    Hashes each blocksize block of the file (or of data, if the file was
+    already read), starting at block number start.  Returns a list of the
+    block digests (as strings).  The hash objects in hashes are also updated
+    with all of the data.
+    '''
+    if buf is None or len(buf) < blocksize:
+        buf = bytearray(blocksize)
+    view = memoryview(buf)[:blocksize]
+
+    leaves = []
+    with open_data(filename, data) as fid:
+        fid.seek(start*blocksize)
+        while True:
+            n = fid.readinto(view)
+            if not n:
+                break
+            leaves.append(hashfcn(view[:n]).digest())
+            for h in hashes:
+                h.update(view[:n])
+            if callback:
+                callback(n)
+    return leaves
+
+def verify_blocks(filename, blocksize, leaves, hashfcn, nverify=VERIFY_BLOCKS, buf=None, data=None):
+    '''
+    Checks that the start of the file still matches the block digests in
+    leaves by rehashing the last block plus a random sample of the others.
+    '''
+    nleaves = len(leaves)
+    if nleaves == 0:
+        return True
+
+    check = set([nleaves-1])
+    if nleaves > 1:
+        check.update(random.sample(xrange(nleaves-1), min(nverify-1, nleaves-1)))
+
+    if buf is None or len(buf) < blocksize:
+        buf = bytearray(blocksize)
+    view = memoryview(buf)[:blocksize]
+    with open_data(filename, data) as fid:
+        for i in sorted(check):
+            fid.seek(i*blocksize)
+            n = fid.readinto(view)
+            if n != blocksize or hashfcn(view[:n]).digest() != leaves[i]:
+                return False
+    return True
+
+def merkle_hash(leaves, hashfcn):
+    '''Hash object of all of the block digests in order'''
+    h = hashfcn()
+    for leaf in leaves:
+        h.update(leaf)
+    return h
+
+def merkle_root(leaves, hashfcn):
+    '''
+    Digest of a block manifest: the hash of all of the block digests in
+    order.  It's what a catalog with a HashBlockSize has as the digest of a
+    file, so it can only be compared with digests made the same way, with
+    the same block size.
+    '''
+    h = merkle_hash(leaves, hashfcn)
+    return np.frombuffer(h.digest(), dtype=np.uint8, count=h.digest_size)
+
+def dir_item(name, kind, value=''):
+    '''
+    One item for dir_digest.  kind is 'D' for a directory, with its digest
+    as the value, 'F' for a file with its full hash, 'S' for a file without
+    one, with its size and mtime in whole seconds, or 'L' for a link.
+    '''
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (name, kind, digest_to_bytes(value))
+
+def file_item(name, hashval, size, mtime_sec, islink=False):
+    '''dir_digest item for a file'''
+    if islink:
+        return dir_item(name, 'L')
+    elif hashval is not None:
+        return dir_item(name, 'F', hashval)
+    else:
+        if mtime_sec is None:
+            mtime_sec = -1
+        return dir_item(name, 'S', '{0}:{1}'.format(size, mtime_sec))
+
+def dir_digest(items, hashfcn=HASH_FUNCTION):
+    '''
+    Merkle digest of a directory from dir_item tuples for everything in it.
+    Two directories with the same digest have the same names, the same
+    kinds of items and the same contents all the way down.
+    '''
+    h = hashfcn()
+    for (name, kind, value) in sorted(items):
+        h.update(struct.pack('<I', len(name)) + name + kind + struct.pack('<I', len(value)) + value)
+    return h.digest()
+
+def count_devices(filenames):
+    '''
+    Number of different devices that the files are on
+    '''
+    devices = set()
+    dirs = set()
+    for filename in filenames:
+        dirname = os.path.dirname(filename)
+        if dirname in dirs:
+            continue
+        dirs.add(dirname)
+        try:
+            devices.add(os.stat(dirname).st_dev)
+        except OSError:
+            pass
+    return len(devices)
+
+def get_pool_size(filenames):
+    '''
+    Number of hashing threads: THREADS_PER_DEVICE for each device the files
+    are on, but not more than the number of CPUs
+    '''
+    ndevices = max(1, count_devices(filenames))
+    return max(1, min(mp.cpu_count(), THREADS_PER_DEVICE*ndevices))
+
+class HashEngine(object):
+    '''
+    Hashes files with a pool of threads.  hashlib releases the GIL while
+    it hashes each block, so the threads hash in parallel, and the digests
+    don't have to be pickled back from other processes.  Each thread reads
+    into its own buffer, which it reuses for every file.
+
+    status is a FileDataStatus, which is updated every STATUS_STRIDE bytes
+    instead of after every block.
+
+    algorithm is the name of the hash algorithm.  If secondary is also
+    given, a second hash is computed in the same pass over the data, and
+    stored in the secondary dict (filename -> digest).
+    
+    If manifest is a block size, each file gets a block manifest: the digest
+    of each block is stored in the leaves dict (filename -> array of digests),
+    and the digest of the file is the merkle_root of the blocks.  Files in
+    the appended dict (filename -> (old leaves, old size)) are only hashed
+    from the end of their last complete block, as long as a sample of their
+    old blocks still matches.  The secondary hash is skipped for them.
+    '''
+
+    def __init__(self, nthreads=None, status=None, blocksize=READ_SIZE, usemmap=None,
+                 algorithm=None, secondary=None, manifest=None, appended=None):
+        self.nthreads = nthreads
+        self.status = status
+        self.blocksize = blocksize
+        self.usemmap = usemmap
+        self.hashfcn = get_hash_function(algorithm)
+        if secondary is not None:
+            self.secondaryfcn = get_hash_function(secondary)
+        else:
+            self.secondaryfcn = None
+        self.secondary = {}
+        self.manifest = manifest
+        if appended is None:
+            appended = {}
+        self.appended = appended
+        self.leaves = {}
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        #per-worker counters: thread name -> [files, bytes, seconds]
+        self.counters = {}
+
+    def get_worker(self):
+        '''
+        Buffer and counters for the current thread
+        '''
+        worker = getattr(self.local, 'worker', None)
+        if worker is None:
+            worker = HashWorker(self, threading.current_thread().name)
+            self.local.worker = worker
+            with self.lock:
+                self.counters[worker.name] = worker.counts
+        return worker
+
+    def hash_file(self, filename, data=None):
+        '''
+        Hashes a single file in the current thread.
+        Returns the filename and the digest as a uint8 array.
+        If data is given, it's the contents of the file, which were already
+        read (see read_file).
+        '''
+        return self.get_worker().hash_file(filename, data)
+
+    def incbytes(self, nbytes):
+        if self.status:
+            with self.lock:
+                self.status.incbytes(nbytes)
+
+    def imap(self, filenames):
+        '''
+        Hashes the files in parallel, yielding (filename, digest) as each
+        one finishes
+        '''
+        filenames = list(filenames)
+        if not filenames:
+            return
+
+        nthreads = self.nthreads
+        if nthreads is None:
+            nthreads = get_pool_size(filenames)
+        logging.debug('Hashing %d files with %d threads', len(filenames), nthreads)
+
+        pool = ThreadPool(nthreads)
+        try:
+            for res in pool.imap_unordered(self.hash_file, filenames):
+                yield res
+        finally:
+            pool.close()
+            pool.join()
+
+    def hash_files(self, filenames):
+        '''
+        Hashes the files in parallel.  Returns a dict of filename -> digest
+        '''
+        return dict(self.imap(filenames))
+
+    def report(self):
+        '''
+        One line per worker with the files, bytes and throughput
+        '''
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for (name, (nfiles, nbytes, secs)) in counters:
+            rate = nbytes / secs / 1e6 if secs > 0 else 0.0
+            lines.append('{0}: {1} files, {2} bytes, {3:.1f} MB/sec'.format(name, nfiles, nbytes, rate))
+        return '\n'.join(lines)
+
+class HashWorker(object):
+    '''
+    Per-thread state for HashEngine
+    '''
+
+    def __init__(self, engine, name):
+        self.engine = engine
+        self.name = name
+        self.buf = bytearray(max(engine.blocksize, engine.manifest or 0))
+        #files, bytes, seconds
+        self.counts = [0, 0, 0.0]
+        self.pending = 0
+
+    def count(self, n):
+        self.counts[1] += n
+        self.pending += n
+        if self.pending >= STATUS_STRIDE:
+            self.engine.incbytes(self.pending)
+            self.pending = 0
+
+    def hash_file(self, filename, data=None):
+        logging.debug('Hashing %s', filename)
+        t0 = time.time()
+
+        if self.engine.manifest:
+            hashval = self.hash_manifest(filename, data)
+        else:
+            hashval = self.hash_flat(filename, data)
+
+        if self.pending:
+            self.engine.incbytes(self.pending)
+            self.pending = 0
+        self.counts[0] += 1
+        self.counts[2] += time.time() - t0
+
+        return filename, hashval
+
+    def hash_flat(self, filename, data=None):
+        h = self.engine.hashfcn()
+        if self.engine.secondaryfcn is not None:
+            h2 = self.engine.secondaryfcn()
+            hash_into([h, h2], filename, self.buf, self.count, self.engine.usemmap, data)
+            self.engine.secondary[filename] = np.frombuffer(h2.digest(), dtype=np.uint8,
+                                                            count=h2.digest_size)
+        else:
+            hash_into([h], filename, self.buf, self.count, self.engine.usemmap, data)
+
+        return np.frombuffer(h.digest(), dtype=np.uint8, count=h.digest_size)
+
+    def hash_manifest(self, filename, data=None):
+        engine = self.engine
+        blocksize = engine.manifest
+        hashfcn = engine.hashfcn
+
+        leaves = []
+        appended = engine.appended.get(filename)
+        if appended is not None:
+            (oldleaves, oldsize) = appended
+            #the last block may have been partial, so it has to be hashed again
+            nkeep = min(oldsize // blocksize, len(oldleaves))
+            oldleaves = [leaf.tostring() for leaf in oldleaves[:nkeep]]
+            if verify_blocks(filename, blocksize, oldleaves, hashfcn, buf=self.buf, data=data):
+                leaves = oldleaves
+                logging.debug('%s was appended to: reusing %d blocks', filename, nkeep)
+            else:
+                logging.debug('%s changed before the end: hashing all of it', filename)
+
+        if engine.secondaryfcn is not None and not leaves:
+            hashes = [engine.secondaryfcn()]
+        else:
+            hashes = []
+        leaves += hash_blocks(filename, blocksize, hashfcn, start=len(leaves),
+                              buf=self.buf, callback=self.count, hashes=hashes, data=data)
+        for h2 in hashes:
+            engine.secondary[filename] = np.frombuffer(h2.digest(), dtype=np.uint8,
+                                                       count=h2.digest_size)
+
+        digest_size = hashfcn().digest_size
+        engine.leaves[filename] = np.frombuffer(''.join(leaves), dtype=np.uint8).reshape((-1, digest_size))
+        return merkle_root(leaves, hashfcn)
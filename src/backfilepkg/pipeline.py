@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Streaming pipeline for scans.  A source (the directory walk) and worker
+stages (hashing, thumbnails) run in their own threads and are connected by
+bounded queues, so memory stays flat.  All of the results come back to one
+queue that is drained by a single writer thread, which is the only thread
+that touches the HDF5 file.  A stage can have a deadline for each item,
+and an item that takes longer is failed with a TaskTimeout.  Its thread
+can't be stopped, so it's left behind and replaced with a new one.
+"""
+
+import time
+import logging
+import threading
+import Queue
+
+from supervisor import TaskTimeout
+
+#maximum number of items waiting in front of each stage
+QUEUE_SIZE = 256
+#how long the writer waits on a full or empty queue before it goes back
+#to writing results
+POLL_INTERVAL = 0.05
+
+class StageStats(object):
+    '''
+    Throughput counters for a stage
+    '''
+
+    def __init__(self, name, nworkers):
+        self.name = name
+        self.nworkers = nworkers
+        self.lock = threading.Lock()
+        self.items = 0
+        self.nbytes = 0
+        #time spent working, waiting for input, and waiting because the next
+        #queue was full
+        self.busy = 0.0
+        self.idle = 0.0
+        self.blocked = 0.0
+
+    def add(self, items=0, nbytes=0, busy=0.0, idle=0.0, blocked=0.0):
+        with self.lock:
+            self.items += items
+            self.nbytes += nbytes
+            self.busy += busy
+            self.idle += idle
+            self.blocked += blocked
+
+    def utilization(self, elapsed):
+        '''Fraction of the time that the workers were busy'''
+        if elapsed <= 0:
+            return 0.0
+        return self.busy / (max(self.nworkers, 1) * elapsed)
+
+    def report(self, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        return '{0:>8}: {1} items ({2:.1f}/sec), {3:.1f} MB ({4:.1f} MB/sec), {5:.0f}% busy, ' \
+               '{6:.1f} sec idle, {7:.1f} sec blocked'.format(self.name, self.items, self.items / elapsed,
+                                                            self.nbytes / 1e6, self.nbytes / 1e6 / elapsed,
+                                                            100*self.utilization(elapsed), self.idle, self.blocked)
+
+class Source(object):
+    '''
+    Runs a generator in its own thread, putting the items on a bounded queue.
+    With threaded=False, the generator is just run in the caller's thread.
+    '''
+
+    def __init__(self, name, generator, threaded=True, maxsize=QUEUE_SIZE):
+        self.name = name
+        self.iterator = iter(generator)
+        self.threaded = threaded
+        self.queue = Queue.Queue(maxsize)
+        self.stats = StageStats(name, 1)
+        self.done = False
+        self.error = None
+
+    def start(self):
+        if self.threaded:
+            self.thread = threading.Thread(target=self.run, name=self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                t0 = time.time()
+                try:
+                    item = next(self.iterator)
+                except StopIteration:
+                    break
+                t1 = time.time()
+                self.queue.put(item)
+                self.stats.add(items=1, busy=t1-t0, blocked=time.time()-t1)
+        except Exception as err:
+            logging.exception('Error in %s', self.name)
+            self.error = err
+        finally:
+            self.queue.put(None)
+
+    def get(self, timeout):
+        '''
+        Next item, or raises Queue.Empty.  Returns None when the source is done.
+        '''
+        if self.threaded:
+            item = self.queue.get(timeout=timeout)
+        else:
+            t0 = time.time()
+            try:
+                item = next(self.iterator)
+            except StopIteration:
+                item = None
+            self.stats.add(items=int(item is not None), busy=time.time()-t0)
+        if item is None:
+            self.done = True
+        return item
+
+class Stage(object):
+    '''
+    Worker threads that run fcn on each item from a bounded input queue
+    and put (stage, item, result, error) on the pipeline's result queue.
+    With nworkers=0, fcn runs in the caller's thread when the item is
+    submitted.  timeout(nbytes) is the number of seconds an item can take,
+    or None for no limit (see check_deadlines).
+    '''
+
+    def __init__(self, name, fcn, results, nworkers=1, maxsize=QUEUE_SIZE, timeout=None):
+        self.name = name
+        self.fcn = fcn
+        self.results = results
+        self.nworkers = nworkers
+        self.timeout = timeout
+        self.queue = Queue.Queue(maxsize)
+        self.threads = []
+        self.nstarted = 0
+        self.stats = StageStats(name, nworkers)
+        #thread -> (item, deadline) for the items being worked on
+        self.lock = threading.Lock()
+        self.active = {}
+        self.abandoned = 0
+
+    def start(self):
+        for i in xrange(self.nworkers):
+            self.add_thread()
+
+    def add_thread(self):
+        t = threading.Thread(target=self.work, name='{0}-{1}'.format(self.name, self.nstarted))
+        t.daemon = True
+        t.start()
+        self.nstarted += 1
+        self.threads.append(t)
+
+    def process(self, item, nbytes):
+        '''
+        Runs fcn on an item and queues the result.  Returns False if the
+        item took too long and this thread was replaced.
+        '''
+        t0 = time.time()
+        thread = threading.current_thread()
+        if self.timeout is not None and self.nworkers > 0:
+            with self.lock:
+                self.active[thread] = (item, t0 + self.timeout(nbytes))
+        try:
+            res = self.fcn(item)
+            err = None
+        except Exception as e:
+            logging.warning('%s failed for %s: %s', self.name, item, e)
+            res = None
+            err = e
+        if self.timeout is not None and self.nworkers > 0:
+            with self.lock:
+                if self.active.pop(thread, None) is None:
+                    logging.debug('%s finished %s after it was abandoned', self.name, item)
+                    return False
+        self.stats.add(items=1, nbytes=nbytes, busy=time.time()-t0)
+        self.results.put((self.name, item, res, err))
+        return True
+
+    def work(self):
+        while True:
+            t0 = time.time()
+            task = self.queue.get()
+            self.stats.add(idle=time.time()-t0)
+            if task is None:
+                break
+            (item, nbytes) = task
+            if not self.process(item, nbytes):
+                break
+
+    def check_deadlines(self):
+        '''
+        Fails the items that are past their deadlines with a TaskTimeout,
+        and starts a new thread in place of each one that was working on
+        them.  The old thread's result is dropped if it ever finishes.
+        '''
+        now = time.time()
+        with self.lock:
+            expired = [(thread, item) for (thread, (item, deadline)) in self.active.iteritems()
+                       if now > deadline]
+            for (thread, item) in expired:
+                del self.active[thread]
+        for (thread, item) in expired:
+            logging.warning('%s timed out for %s', self.name, item)
+            self.abandoned += 1
+            self.threads.remove(thread)
+            self.add_thread()
+            self.results.put((self.name, item, None, TaskTimeout('{0} took too long'.format(self.name))))
+
+    def put(self, item, nbytes=0, timeout=None):
+        '''
+        Queues an item.  Returns False if the queue stayed full for timeout seconds.
+        '''
+        if self.nworkers == 0:
+            self.process(item, nbytes)
+            return True
+        try:
+            self.queue.put((item, nbytes), timeout=timeout)
+        except Queue.Full:
+            return False
+        return True
+
+    def close(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+class Pipeline(object):
+    '''
+    Connects a source and stages to a single writer.  handler is called in
+    the writer's thread as handler(stagename, item, result, error) for each
+    result.  poll, if it's given, is called in the writer's thread every
+    time it checks for results, including while it waits for the stages to
+    finish, so it can do other work there (like a checkpoint), or raise an
+    exception to stop.
+    '''
+
+    def __init__(self, handler, threaded=True, poll=None):
+        self.handler = handler
+        self.threaded = threaded
+        self.poll = poll
+        self.results = Queue.Queue()
+        self.stages = []
+        self.sources = []
+        self.pending = 0
+        self.writer = StageStats('write', 1)
+        self.t0 = time.time()
+
+    def add_source(self, name, generator, maxsize=QUEUE_SIZE):
+        source = Source(name, generator, threaded=self.threaded, maxsize=maxsize)
+        self.sources.append(source)
+        source.start()
+        return source
+
+    def add_stage(self, name, fcn, nworkers=1, maxsize=QUEUE_SIZE, timeout=None):
+        if not self.threaded:
+            nworkers = 0
+        stage = Stage(name, fcn, self.results, nworkers=nworkers, maxsize=maxsize, timeout=timeout)
+        self.stages.append(stage)
+        stage.start()
+        return stage
+
+    def iterate(self, source):
+        '''
+        Yields the items from a source, writing any results that come in
+        while we wait for it
+        '''
+        while True:
+            self.drain()
+            t0 = time.time()
+            try:
+                item = source.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                self.writer.add(idle=time.time()-t0)
+                continue
+            self.writer.add(idle=time.time()-t0)
+            if item is None:
+                break
+            yield item
+        if source.error is not None:
+            raise source.error
+
+    def submit(self, stage, item, nbytes=0):
+        '''
+        Queues an item for a stage.  While the stage's queue is full, we
+        write results instead of waiting, so results can't pile up.
+        '''
+        self.pending += 1
+        while True:
+            t0 = time.time()
+            ok = stage.put(item, nbytes, timeout=POLL_INTERVAL)
+            self.writer.add(blocked=time.time()-t0)
+            if ok:
+                break
+            self.drain()
+        if stage.nworkers == 0:
+            self.drain()
+
+    def drain(self, block=False):
+        '''
+        Writes all of the results that are ready.  If block is True, waits
+        up to POLL_INTERVAL for one.
+        '''
+        if self.poll is not None:
+            self.poll()
+        for stage in self.stages:
+            stage.check_deadlines()
+        while self.pending > 0:
+            t0 = time.time()
+            try:
+                if block:
+                    (name, item, res, err) = self.results.get(timeout=POLL_INTERVAL)
+                    block = False
+                else:
+                    (name, item, res, err) = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            t1 = time.time()
+            self.pending -= 1
+            self.handler(name, item, res, err)
+            self.writer.add(items=1, busy=time.time()-t1, idle=t1-t0)
+
+    def finish(self):
+        '''
+        Waits for all of the stages and writes the rest of the results
+        '''
+        while self.pending > 0:
+            self.drain(block=True)
+        for stage in self.stages:
+            stage.close()
+
+    def report(self):
+        '''
+        Throughput of each stage.  The one that is busy the largest fraction
+        of the time is the bottleneck.
+        '''
+        elapsed = time.time() - self.t0
+        stats = [s.stats for s in self.sources] + [s.stats for s in self.stages] + [self.writer]
+        lines = [st.report(elapsed) for st in stats]
+        for stage in self.stages:
+            if stage.abandoned:
+                lines.append('{0}: {1} items timed out'.format(stage.name, stage.abandoned))
+        if stats:
+            bottleneck = max(stats, key=lambda st: st.utilization(elapsed))
+            lines.append('Bottleneck: {0} ({1:.0f}% busy)'.format(bottleneck.name,
+                                                                100*bottleneck.utilization(elapsed)))
+        return '\n'.join(lines)
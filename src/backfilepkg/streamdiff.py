@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Streaming diff between a directory on disk and a stored scan.  The disk and
+the catalog are both walked depth first with each directory in sorted
+order, which lists every path in the same order on both sides, so they can
+be merged like two sorted lists.  Only one directory listing per level is
+held in memory, instead of two RootTrees and a ComparisonTree.  For a
+columnar catalog, a few small columns are read for every row, and the
+names and hashes are read a directory at a time (see column_entries).
+"""
+
+import sys, os, time
+from collections import namedtuple, defaultdict
+import numpy as np
+import h5py
+
+from dirscan import scan_dir
+from hashing import HashStage, get_hash_function, hash_into, hash_blocks, merkle_hash, digests_equal, \
+    digest_to_bytes, DEFAULT_ALGORITHM
+from catalog import FileType, ColumnCatalog, HAS_HASH
+from filetree import TIME_FORMAT, NS_PER_SEC
+
+#state is 'added', 'removed', 'modified', 'typechange' or 'clean', and detail
+#is the same as in ComparisonNode.get_status
+DiffRecord = namedtuple('DiffRecord', 'state relpath detail')
+
+class Entry(object):
+    '''
+    One item on either side.  mtime is in whole seconds, which is all that
+    the catalogs keep, and hashval is only set for a full hash.
+    '''
+    __slots__ = ('type', 'size', 'mtime', 'hashval')
+
+    def __init__(self, ftype, size=None, mtime=None, hashval=None):
+        self.type = ftype
+        self.size = size
+        self.mtime = mtime
+        self.hashval = digest_to_bytes(hashval)
+
+def encode_name(name):
+    #the two sides have to sort the same way
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+def struct_to_seconds(modified):
+    if modified is None:
+        return None
+    return int(time.mktime(modified))
+
+def sorted_walk(top, listdir):
+    '''
+    Yields (key, entry) depth first, with each directory in sorted order, so
+    the keys (tuples of path components) come out sorted.  listdir(handle)
+    returns a sorted list of (name, entry, handle), where handle is None
+    for items that aren't directories.
+    '''
+    stack = [((), iter(listdir(top)))]
+    while stack:
+        (prefix, items) = stack[-1]
+        for (name, entry, handle) in items:
+            key = prefix + (name,)
+            yield (key, entry)
+            if handle is not None:
+                stack.append((key, iter(listdir(handle))))
+            break
+        else:
+            stack.pop()
+
+def disk_entries(rootpath, exclude=('.annex',)):
+    def listdir(path):
+        items = []
+        for entry in scan_dir(path, exclude):
+            if entry.islink:
+                items.append((entry.name, Entry(FileType.Link), None))
+            elif entry.isdir:
+                items.append((entry.name, Entry(FileType.Dir), entry.path))
+            else:
+                items.append((entry.name, Entry(FileType.File, entry.size, entry.mtime_ns // NS_PER_SEC),
+                              None))
+        items.sort(key=lambda item: item[0])
+        return items
+    return sorted_walk(rootpath, listdir)
+
+def column_entries(gp):
+    '''
+    Entries for the columnar catalog in gp.  Only the columns that the diff
+    uses are read, without loading the catalog: Parent, Type, Size,
+    Modified, Flags and HashStage for every row, and the names and hashes
+    of one directory at a time.  A stable sort of the rows by Parent puts
+    the items in each directory next to each other, in row order, which is
+    the order that h5py reads a list of rows in.
+    '''
+    parents = gp['Parent'][:]
+    order = np.argsort(parents, kind='mergesort')
+    parents = parents[order]
+    types = gp['Type'][:]
+    sizes = gp['Size'][:]
+    modified = gp['Modified'][:]
+    flags = gp['Flags'][:]
+    stages = gp['HashStage'][:]
+    names = gp['Name']
+    hashes = gp['Hash']
+
+    def listdir(row):
+        rows = order[np.searchsorted(parents, row, 'left'):np.searchsorted(parents, row, 'right')]
+        if not len(rows):
+            return []
+        rows = rows.tolist()
+        items = []
+        for (child, name, hashval) in zip(rows, names[rows], hashes[rows]):
+            ftype = int(types[child])
+            if ftype == FileType.File:
+                mtime = None if np.isnan(modified[child]) else struct_to_seconds(time.localtime(modified[child]))
+                #like ColumnCatalog.read, only a full hash
+                if not flags[child] & HAS_HASH or stages[child] not in (-1, HashStage.Full):
+                    hashval = None
+                entry = Entry(ftype, int(sizes[child]), mtime, hashval)
+            else:
+                entry = Entry(ftype)
+            items.append((encode_name(name), entry, child if ftype == FileType.Dir else None))
+        items.sort(key=lambda item: item[0])
+        return items
+    return sorted_walk(0, listdir)
+
+def group_entries(rootgp):
+    #only imported here, since filedata needs the multiprocessing machinery
+    from filedata import FileData
+
+    def listdir(gp):
+        items = []
+        for name in gp:
+            fd = FileData(name)
+            fd.from_hdf5(gp[name])
+            entry = Entry(fd.type, fd.size, struct_to_seconds(fd.modified), fd.hashval)
+            items.append((encode_name(name), entry, gp[name] if fd.type == FileType.Dir else None))
+        items.sort(key=lambda item: item[0])
+        return items
+    return sorted_walk(rootgp, listdir)
+
+def catalog_entries(h5file):
+    '''
+    Sorted entries for a catalog written by FileDataWriter, in either
+    layout.  Returns (entries, rootpath, algorithm, blocksize), where
+    blocksize is the catalog's HashBlockSize, or None.
+    '''
+    if ColumnCatalog.exists(h5file):
+        gp = ColumnCatalog.get_group(h5file)
+        return (column_entries(gp), gp.attrs['RootPath'], gp.attrs['HashAlgorithm'],
+                gp.attrs.get('HashBlockSize', None))
+    elif 'ROOT' in h5file:
+        rootgp = h5file['ROOT']
+        return (group_entries(rootgp), rootgp.attrs['RootPath'],
+                rootgp.attrs.get('HashAlgorithm', 'sha256'), rootgp.attrs.get('HashBlockSize', None))
+    else:
+        raise ValueError('No catalog in {0}'.format(h5file.filename))
+
+def get_type_detail(stored, ondisk):
+    names = {FileType.Dir: 'directory', FileType.File: 'file', FileType.Link: 'link'}
+    return 'from {0} to {1}'.format(names[stored.type], names[ondisk.type])
+
+def compare_entries(relpath, fullpath, stored, ondisk, hashfcn, hashambiguous=True, blocksize=None):
+    '''
+    DiffRecord for an item that's on both sides, or None for directories.
+    A file with the same size and a different mtime is hashed to see if it
+    changed, if hashambiguous is True and the catalog has a hash for it.
+    With a blocksize, it's hashed like the catalog's block manifests, into
+    the merkle root of the blocks.
+    '''
+    if stored.type != ondisk.type:
+        return DiffRecord('typechange', relpath, get_type_detail(stored, ondisk))
+    elif stored.type == FileType.Dir:
+        return None
+    elif stored.type == FileType.Link:
+        return DiffRecord('clean', relpath, '')
+
+    if stored.size != ondisk.size:
+        return DiffRecord('modified', relpath, 'sizes not equal ({0} != {1})'.format(stored.size, ondisk.size))
+    elif stored.mtime == ondisk.mtime:
+        return DiffRecord('clean', relpath, '')
+    elif hashambiguous and stored.hashval is not None:
+        if blocksize:
+            h = merkle_hash(hash_blocks(fullpath, blocksize, hashfcn), hashfcn)
+        else:
+            h = hashfcn()
+            hash_into([h], fullpath)
+        ondisk.hashval = h.digest()
+        if digests_equal(stored.hashval, ondisk.hashval):
+            return DiffRecord('clean', relpath, '')
+        return DiffRecord('modified', relpath, 'hashes not equal ({0} != {1})'.format(
+            stored.hashval.encode('hex').upper(), ondisk.hashval.encode('hex').upper()))
+    else:
+        times = [time.strftime(TIME_FORMAT, time.localtime(t)) if t is not None else 'None'
+                 for t in (stored.mtime, ondisk.mtime)]
+        return DiffRecord('modified', relpath, 'modified at different times ({0} != {1})'.format(*times))
+
+def stream_diff(h5file, rootpath=None, exclude=('.annex',), hashambiguous=True, clean=False):
+    '''
+    Yields a DiffRecord for each difference between the catalog in h5file
+    and the directory rootpath (by default, the one the catalog was made
+    from), as they're found.  Everything below an added or removed
+    directory is listed too, like ComparisonTree.  Clean files are only
+    listed if clean is True.
+    '''
+    (stored, catalogpath, algorithm, blocksize) = catalog_entries(h5file)
+    if rootpath is None:
+        rootpath = catalogpath
+    hashfcn = get_hash_function(algorithm or DEFAULT_ALGORITHM)
+    ondisk = disk_entries(rootpath, exclude)
+
+    a = next(stored, None)
+    b = next(ondisk, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield DiffRecord('removed', '/'.join(a[0]), '')
+            a = next(stored, None)
+        elif a is None or b[0] < a[0]:
+            yield DiffRecord('added', '/'.join(b[0]), '')
+            b = next(ondisk, None)
+        else:
+            relpath = '/'.join(a[0])
+            rec = compare_entries(relpath, os.path.join(rootpath, relpath), a[1], b[1],
+                                  hashfcn, hashambiguous, blocksize)
+            if rec is not None and (clean or rec.state != 'clean'):
+                yield rec
+            a = next(stored, None)
+            b = next(ondisk, None)
+
+def diff_status(h5file, rootpath=None, **kw):
+    '''
+    The whole diff, in the same form as ComparisonNode.get_status
+    '''
+    status = defaultdict(list)
+    for rec in stream_diff(h5file, rootpath, **kw):
+        status[rec.state].append((rec.relpath, rec.detail))
+    return status
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        print 'Usage: streamdiff.py <catalog.h5> [path]'
+        return 1
+
+    with h5py.File(argv[0], 'r') as h5file:
+        rootpath = argv[1] if len(argv) > 1 else None
+        for rec in stream_diff(h5file, rootpath):
+            if rec.detail:
+                print '{0:>10}: {1} ({2})'.format(rec.state, rec.relpath, rec.detail)
+            else:
+                print '{0:>10}: {1}'.format(rec.state, rec.relpath)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
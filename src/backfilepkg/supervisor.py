@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+
+Supervised pool of worker processes for tasks that can hang or crash, like
+decoding a corrupt video.  Each worker has its own pipe, so the supervisor
+always knows which task a worker is running.  A worker that takes longer
+than the task's deadline is killed, and one that dies (from a segfault in
+OpenCV, for example) is noticed when its pipe closes.  Either way, the task
+fails with a TaskError and the worker is replaced, so the rest of the tasks
+keep going.  A worker is also replaced after a task that leaves a thread
+running in it, like a video read that ran out of time.
+
+The workers are forked by a spawner process, which is started with the
+Supervisor, before the caller starts any threads.  Python 2 doesn't reset
+locks in a forked child, so a worker forked from a process with threads
+could start with a lock (logging's, say) held by a thread that isn't
+there, and hang on its first task.  The spawner only has one thread, so
+it's always safe to fork from.
+"""
+
+import os, sys, time
+import signal
+import logging
+import threading
+import Queue
+import multiprocessing as mp
+from multiprocessing.reduction import send_handle, recv_handle
+import _multiprocessing
+
+#seconds to wait for a worker to exit before it's killed
+STOP_TIMEOUT = 1.0
+
+class TaskError(Exception):
+    '''A task that didn't finish, because of its worker, not because of an error in the task'''
+    pass
+
+class TaskTimeout(TaskError):
+    pass
+
+class WorkerCrashed(TaskError):
+    pass
+
+def describe(fcn, args):
+    '''Short description of a task, for the log: just its first argument, which is usually the file'''
+    if args:
+        return '{0}({1!r}, ...)'.format(fcn.__name__, args[0])
+    return '{0}()'.format(fcn.__name__)
+
+def worker_main(conn, initializer, initargs):
+    '''
+    Runs tasks from the pipe until it's closed.  Errors in a task are sent
+    back instead of the result, and each result says whether the task left
+    a thread running, so that the worker should be replaced.
+    '''
+    #the supervisor decides when a worker stops, even if it was forked from
+    #a process with its own handlers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if initializer is not None:
+        initializer(*initargs)
+    nthreads = threading.active_count()
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, IOError):
+            break
+        if task is None:
+            break
+        (fcn, args) = task
+        try:
+            res = ('ok', fcn(*args))
+        except Exception as err:
+            res = ('error', err)
+        stale = threading.active_count() > nthreads
+        try:
+            conn.send(res + (stale,))
+        except Exception as err:
+            #the result or the error can't be pickled
+            conn.send(('error', TaskError(repr(err)), stale))
+
+def start_worker(conn, others, initializer, initargs):
+    #only the supervisor's end of the pipe should be open, so that the
+    #worker sees it close
+    for other in others:
+        other.close()
+    worker_main(conn, initializer, initargs)
+
+def stop_process(process, kill=False):
+    '''
+    Waits for a process that was asked to stop, and kills it if it doesn't.
+    With kill=True, it doesn't get to finish.  Returns its exit code.
+    '''
+    if not kill:
+        process.join(STOP_TIMEOUT)
+    if process.is_alive():
+        process.terminate()
+        process.join(STOP_TIMEOUT)
+    if process.is_alive():
+        #stuck in the kernel, or ignoring SIGTERM
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        process.join(STOP_TIMEOUT)
+    return process.exitcode
+
+def spawner_main(conn, initializer, initargs):
+    '''
+    Forks workers and stops them, on requests from the pipe, until it's
+    closed.  A new worker's end of its pipe is sent back as a file
+    descriptor, followed by its pid.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    #so the workers are stopped when the supervisor's process exits
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    #the spawner is a daemon so it doesn't outlive the supervisor, but
+    #multiprocessing won't let daemons start processes otherwise
+    mp.current_process().daemon = False
+    workers = {}
+    try:
+        while True:
+            try:
+                req = conn.recv()
+            except (EOFError, IOError):
+                break
+            if req is None:
+                break
+            if req[0] == 'start':
+                (parent, child) = mp.Pipe()
+                process = mp.Process(target=start_worker,
+                                     args=(child, (parent, conn), initializer, initargs))
+                process.daemon = True
+                process.start()
+                child.close()
+                workers[process.pid] = process
+                send_handle(conn, parent.fileno(), os.getppid())
+                conn.send(process.pid)
+                parent.close()
+            elif req[0] == 'stop':
+                (_, pid, kill) = req
+                conn.send(stop_process(workers.pop(pid), kill))
+    finally:
+        for process in workers.itervalues():
+            stop_process(process, kill=True)
+
+class Spawner(object):
+    '''
+    The spawner process (see spawner_main).  Requests can come from several
+    threads, so they're taken one at a time.
+    '''
+
+    def __init__(self, initializer=None, initargs=()):
+        (self.conn, child) = mp.Pipe()
+        self.process = mp.Process(target=spawner_main, args=(child, initializer, initargs))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''Starts a worker and returns its pid and the supervisor's end of its pipe'''
+        with self.lock:
+            self.conn.send(('start',))
+            fd = recv_handle(self.conn)
+            pid = self.conn.recv()
+        return (pid, _multiprocessing.Connection(fd))
+
+    def stop(self, pid, kill=False):
+        '''Waits for a worker to stop, or kills it, and returns its exit code'''
+        with self.lock:
+            self.conn.send(('stop', pid, kill))
+            return self.conn.recv()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.send(None)
+            except (IOError, OSError):
+                pass
+        stop_process(self.process)
+        self.conn.close()
+
+class Worker(object):
+    '''
+    One worker process (a child of the spawner) and the supervisor's end of
+    its pipe
+    '''
+
+    def __init__(self, spawner):
+        self.spawner = spawner
+        (self.pid, self.conn) = spawner.start()
+        self.ntasks = 0
+
+    def stop(self, kill=False):
+        '''
+        Stops the worker and returns its exit code.  With kill=True, it
+        doesn't get to finish its task.
+        '''
+        if not kill:
+            try:
+                self.conn.send(None)
+            except (IOError, OSError):
+                pass
+        exitcode = self.spawner.stop(self.pid, kill)
+        self.conn.close()
+        return exitcode
+
+class Supervisor(object):
+    '''
+    Runs functions in worker processes, with a deadline for each task.
+    apply() can be called from several threads at once, and each call uses
+    one worker.  Workers are replaced after a timeout or a crash, and after
+    maxtasks tasks, if it's given.  Workers start from the state of the
+    process when the Supervisor was made, not when they're replaced.
+    '''
+
+    def __init__(self, nworkers, initializer=None, initargs=(), maxtasks=None):
+        self.spawner = Spawner(initializer, initargs)
+        self.maxtasks = maxtasks
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = set()
+        for i in xrange(nworkers):
+            self.add_worker()
+        self.ntasks = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.recycled = 0
+
+    def add_worker(self):
+        worker = Worker(self.spawner)
+        with self.lock:
+            self.workers.add(worker)
+        self.idle.put(worker)
+
+    def replace(self, worker, kill=True):
+        '''Stops a worker and starts a new one.  Returns the old one's exit code.'''
+        with self.lock:
+            self.workers.discard(worker)
+        exitcode = worker.stop(kill=kill)
+        self.add_worker()
+        return exitcode
+
+    def apply(self, fcn, args=(), timeout=None):
+        '''
+        Runs fcn(*args) in a worker process and returns the result.  Raises
+        the error from fcn if it fails, TaskTimeout if it takes more than
+        timeout seconds, or WorkerCrashed if the worker dies.
+        '''
+        worker = self.idle.get()
+        t0 = time.time()
+        try:
+            worker.conn.send((fcn, args))
+            #a worker that died has a closed pipe, which is ready to read
+            ready = worker.conn.poll(timeout)
+            if ready:
+                (status, res, stale) = worker.conn.recv()
+        except (EOFError, IOError, OSError):
+            #give it time to exit, so we get its exit code
+            exitcode = self.replace(worker, kill=False)
+            with self.lock:
+                self.crashes += 1
+            logging.warning('Worker crashed (exit code %s) running %s', exitcode, describe(fcn, args))
+            raise WorkerCrashed('worker exited with code {0}'.format(exitcode))
+        except:
+            #not the worker's fault, but it could be in the middle of the task
+            self.replace(worker)
+            raise
+
+        if not ready:
+            with self.lock:
+                self.timeouts += 1
+            logging.warning('Worker took more than %.1f sec running %s', time.time() - t0,
+                            describe(fcn, args))
+            self.replace(worker)
+            raise TaskTimeout('took more than {0:.0f} sec'.format(timeout))
+
+        worker.ntasks += 1
+        with self.lock:
+            self.ntasks += 1
+        if stale:
+            #the thread can't be stopped, and would use the worker's CPU
+            #and files for the rest of the scan
+            logging.debug('Replacing the worker that ran %s, which left a thread running',
+                          describe(fcn, args))
+            with self.lock:
+                self.recycled += 1
+            self.replace(worker)
+        elif self.maxtasks is not None and worker.ntasks >= self.maxtasks:
+            self.replace(worker, kill=False)
+        else:
+            self.idle.put(worker)
+
+        if status == 'error':
+            raise res
+        return res
+
+    def close(self):
+        '''Stops the workers, after they finish their tasks'''
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = set()
+        for worker in workers:
+            worker.stop()
+        self.spawner.close()
+
+    def terminate(self):
+        '''Kills the workers'''
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = set()
+        for worker in workers:
+            worker.stop(kill=True)
+        self.spawner.close()
+
+    def report(self):
+        return '{0} tasks, {1} timed out, {2} crashed, {3} left threads running'.format(
+            self.ntasks, self.timeouts, self.crashes, self.recycled)
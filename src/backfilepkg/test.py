@@ -61,8 +61,8 @@ def build_subdirectories(pathname, depth, filesperdir, minfiles, dirsperdir, fil
         with open(os.path.join(pathname, name), 'wb') as fid:
             h = fill_file(fid, sz, hashfcn=hashlib.sha256())
 
-        fnode = FileNode(name=name, parent=ftree, size=sz, modified=time.localtime(), hashval=h.hexdigest())
-        ftree.children[name] = fnode
+        fnode = FileNode(name=name, parent=ftree, size=sz, modified=time.localtime(), hashval=h.digest())
+        ftree.add_child(fnode)
         
     for i in xrange(ndirs):
         name = dirname + letters[i]
@@ -73,7 +73,7 @@ def build_subdirectories(pathname, depth, filesperdir, minfiles, dirsperdir, fil
         
         subdir = DirTree(name=name, parent=ftree)
         build_subdirectories(fullname, depth-1, filesperdir, minfiles, dirsperdir, filesizes, randomize, subdir)
-        ftree.children[name] = subdir
+        ftree.add_child(subdir)
 
 def modify_files(nodes, appendlen, dohash=False, quiet=False):
     for node in nodes:
@@ -181,7 +181,43 @@ def check_tree(ftree):
     
     if isclean:
         print "All clean"
-        
+
+def check_rename(pathname, catalogfile):
+    '''
+    Scans a directory, renames a file in it, and scans it again.  The file
+    should keep its hash under the new name, with no deleted entry for the
+    old one.
+    '''
+    #only imported here, since filedata imports this module
+    import filedata
+    from catalog import ColumnCatalog
+
+    for path in (pathname, catalogfile):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+    os.makedirs(pathname)
+    for name in ('a', 'b'):
+        with open(os.path.join(pathname, name), 'wb') as fid:
+            fill_file(fid, 10*1024)
+
+    filedata.FileDataWriter(catalogfile, pathname).run()
+    os.rename(os.path.join(pathname, 'a'), os.path.join(pathname, 'c'))
+    scanner = filedata.FileDataWriter(catalogfile, pathname)
+    scanner.run()
+
+    with h5py.File(catalogfile, 'r') as h5file:
+        catalog = ColumnCatalog.open(h5file)
+        row = catalog.lookup('c')
+        isclean = (scanner.moved == [('a', 'c')] and row is not None and
+                   catalog.read(row).hashval is not None and not catalog.deleted())
+    if isclean:
+        print "Rename kept its hash"
+    else:
+        print "Rename failed: moved {0}, deleted {1}".format(scanner.moved, catalog.deleted())
+    return isclean
+
 def main():
     testdir = '/Users/etytel01/Documents/Scanner/backfile/test/testdir1'
     if os.path.exists(testdir):
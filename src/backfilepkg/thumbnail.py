@@ -5,7 +5,9 @@ Created on Sat Nov 23 10:16:17 2013
 @author: etytel01
 """
 
-import sys, os
+import sys, os, time
+import struct
+import threading
 import h5py
 import mimetypes
 # import magic
@@ -15,6 +17,148 @@ import logging
 
 READLENGTH = 500
 THUMBSIZE = 256
+#bytes read from the start of a JPEG to find its size and EXIF thumbnail
+JPEG_HEADER_SIZE = 128 * 1024
+#JPEGs can be decoded at 1/2, 1/4 or 1/8 size, which is much faster than a
+#full decode, in versions of OpenCV that have the flags
+REDUCED_FLAGS = [(factor, getattr(cv2, 'IMREAD_REDUCED_COLOR_{0}'.format(factor), None))
+                 for factor in (8, 4, 2)]
+#seconds to spend on the thumbnail for one video, and where the frames after
+#the first one come from, as a fraction of the length
+VIDEO_TIME_BUDGET = 10.0
+VIDEO_POSITIONS = (0.5, 0.99)
+#start of frame markers, which have the image size
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+def parse_jpeg_header(head):
+    '''
+    (height, width, exif) from the markers at the start of a JPEG, where
+    exif is the contents of the EXIF segment, or None.  Returns None if it
+    isn't a JPEG or the frame header isn't in head.
+    '''
+    if head[:2] != '\xff\xd8':
+        return None
+    exif = None
+    pos = 2
+    while pos + 4 <= len(head):
+        if head[pos] != '\xff':
+            return None
+        marker = ord(head[pos+1])
+        if marker == 0xFF:
+            #fill byte
+            pos += 1
+            continue
+        (length,) = struct.unpack('>H', head[pos+2:pos+4])
+        if marker == 0xE1 and exif is None and head[pos+4:pos+10] == 'Exif\x00\x00':
+            exif = head[pos+10:pos+2+length]
+        elif marker in SOF_MARKERS:
+            if pos + 9 > len(head):
+                return None
+            (height, width) = struct.unpack('>HH', head[pos+5:pos+9])
+            return (height, width, exif)
+        elif marker == 0xDA:
+            #start of the image data
+            return None
+        pos += 2 + length
+    return None
+
+def parse_exif(exif):
+    '''
+    (orientation, thumbnail) from the contents of an EXIF segment, where
+    thumbnail is the embedded JPEG, or None
+    '''
+    if exif[:2] == 'II':
+        endian = '<'
+    elif exif[:2] == 'MM':
+        endian = '>'
+    else:
+        return (1, None)
+
+    def read_ifd(offset):
+        (n,) = struct.unpack(endian + 'H', exif[offset:offset+2])
+        tags = {}
+        for i in xrange(n):
+            entry = exif[offset+2+12*i:offset+14+12*i]
+            (tag, tagtype) = struct.unpack(endian + 'HH', entry[:4])
+            if tagtype == 3:
+                (tags[tag],) = struct.unpack(endian + 'H', entry[8:10])
+            elif tagtype == 4:
+                (tags[tag],) = struct.unpack(endian + 'I', entry[8:12])
+        (nextifd,) = struct.unpack(endian + 'I', exif[offset+2+12*n:offset+6+12*n])
+        return (tags, nextifd)
+
+    try:
+        (ifd0,) = struct.unpack(endian + 'I', exif[4:8])
+        (tags, ifd1) = read_ifd(ifd0)
+        orientation = tags.get(0x0112, 1)
+        if ifd1 == 0:
+            return (orientation, None)
+        (tags, _) = read_ifd(ifd1)
+    except struct.error:
+        return (1, None)
+
+    start = tags.get(0x0201)
+    length = tags.get(0x0202)
+    if start is None or length is None:
+        return (orientation, None)
+    thumb = exif[start:start+length]
+    if thumb[:2] != '\xff\xd8':
+        return (orientation, None)
+    return (orientation, thumb)
+
+def apply_orientation(im, orientation):
+    '''Rotates or flips an image the way the EXIF orientation says to'''
+    if orientation == 2:
+        im = im[:, ::-1]
+    elif orientation == 3:
+        im = im[::-1, ::-1]
+    elif orientation == 4:
+        im = im[::-1]
+    elif orientation == 5:
+        im = np.swapaxes(im, 0, 1)
+    elif orientation == 6:
+        im = np.rot90(im, -1)
+    elif orientation == 7:
+        im = np.swapaxes(im[::-1, ::-1], 0, 1)
+    elif orientation == 8:
+        im = np.rot90(im, 1)
+    return np.ascontiguousarray(im)
+
+def get_cap_prop(name):
+    '''VideoCapture property ids moved from cv2.cv to cv2 in OpenCV 3'''
+    if hasattr(cv2, 'CAP_PROP_' + name):
+        return getattr(cv2, 'CAP_PROP_' + name)
+    return getattr(cv2.cv, 'CV_CAP_PROP_' + name)
+
+def shrink(im):
+    '''Resizes an image so that its largest side is at most THUMBSIZE'''
+    if (im.shape[0] > THUMBSIZE) or (im.shape[1] > THUMBSIZE):
+        rat = float(THUMBSIZE) / max(im.shape[:2])
+        dim = (int(im.shape[0]*rat), int(im.shape[1]*rat))
+        return cv2.resize(im, dim, interpolation = cv2.INTER_NEAREST)
+    return im
+
+def encode_jpeg(im):
+    '''Thumbnail image as a JPEG string, or None'''
+    success, data = cv2.imencode('.jpg', im, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not success:
+        return None
+    return data.tostring()
+
+def get_depth(im):
+    if len(im.shape) == 3:
+        return im.shape[2]
+    return 1
+
+def get_reduced_flag(size):
+    '''
+    imread flag to decode a JPEG whose largest side is size at the
+    smallest scale that's still bigger than a thumbnail, or None
+    '''
+    for (factor, flag) in REDUCED_FLAGS:
+        if flag is not None and size // factor >= THUMBSIZE:
+            return flag
+    return None
 
 class Thumbnail_Image(object):
     '''
@@ -24,20 +168,107 @@ class Thumbnail_Image(object):
     def __init__(self, path=None, h5parent=None):
         self.path = path
         self.h5parent = h5parent
+        #how the last thumbnail was made
+        self.method = None
+        self.size = None
+        self.depth = None
+        self.im = None
+        #JPEG data, once it's encoded
+        self.parts = None
+
+    @property
+    def im(self):
+        '''The thumbnail, which is decoded from parts the first time it's used'''
+        if self._im is None and self.parts is not None:
+            self._im = cv2.imdecode(np.frombuffer(self.parts[0], dtype=np.uint8),1)
+        return self._im
+
+    @im.setter
+    def im(self, im):
+        self._im = im
         
     def from_file(self, path=None):
         if path:
             self.path = path
 
-        imfull = cv2.imread(self.path)
+        with open(self.path, 'rb') as fid:
+            head = fid.read(JPEG_HEADER_SIZE)
+        self.from_encoded(head, lambda flag: cv2.imread(self.path, flag))
+
+    def from_buffer(self, data, path=None):
+        '''
+        Decodes the image from the contents of the file, which were already read
+        '''
+        if path:
+            self.path = path
+
+        self.from_encoded(bytes(data[:JPEG_HEADER_SIZE]),
+                          lambda flag: cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag))
+
+    def from_encoded(self, head, decode):
+        '''
+        Makes the thumbnail from the fastest source that's big enough: the
+        thumbnail embedded in a JPEG's EXIF data, then a reduced size decode
+        of a JPEG, and then a full decode.  head is the start of the file,
+        and decode(flag) decodes the whole file.  self.method is set to
+        'exif', 'reduced' or 'full'.
+        '''
+        header = parse_jpeg_header(head)
+        if header is not None and (header[0] == 0 or header[1] == 0):
+            #the height is in a DNL marker after the image data, so the size
+            #isn't known until it's decoded
+            header = None
+        if header is not None:
+            (height, width, exif) = header
+            if exif is not None:
+                (orientation, exifthumb) = parse_exif(exif)
+            else:
+                (orientation, exifthumb) = (1, None)
+            if orientation >= 5:
+                (height, width) = (width, height)
+
+            if exifthumb is not None:
+                im = cv2.imdecode(np.frombuffer(exifthumb, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if im is not None:
+                    im = apply_orientation(im, orientation)
+                    #some cameras pad the thumbnail to a different shape
+                    sameshape = abs(float(im.shape[1])/im.shape[0] - float(width)/height) < 0.02
+                    if sameshape and max(im.shape[:2]) >= min(THUMBSIZE, max(height, width)):
+                        self.from_image(im)
+                        self.size = (height, width)
+                        self.method = 'exif'
+                        return
+
+            flag = get_reduced_flag(max(height, width))
+            if flag is not None:
+                im = decode(flag)
+                if im is not None:
+                    self.from_image(im)
+                    self.size = (height, width)
+                    self.method = 'reduced'
+                    return
+
+        imfull = decode(cv2.IMREAD_COLOR)
+        if imfull is None:
+            raise IOError, "Could not decode image"
+        self.from_image(imfull)
+        self.method = 'full'
+
+    def from_image(self, imfull):
         self.size = imfull.shape[:2]
-        if (imfull.shape[0] > THUMBSIZE) or (imfull.shape[1] > THUMBSIZE):
-            rat = float(THUMBSIZE) / max(imfull.shape[:2])
-            dim = (int(imfull.shape[0]*rat), int(imfull.shape[1]*rat))
-            
-            self.im = cv2.resize(imfull,dim, interpolation = cv2.INTER_NEAREST)
-        else:
-            self.im = imfull
+        self.im = shrink(imfull)
+        self.depth = None
+        self.parts = None
+
+    def encode(self):
+        '''
+        Encodes the thumbnail and drops the image, so that only the JPEG
+        data is sent back from a worker process
+        '''
+        if self._im is not None:
+            self.depth = get_depth(self._im)
+            self.parts = self.to_parts()
+            self.im = None
         
     def from_hdf5(self, h5parent=None):
         if h5parent:
@@ -47,14 +278,17 @@ class Thumbnail_Image(object):
             h5obj = h5parent['Thumbnail']
             data = h5obj[:]
             self.im = cv2.imdecode(data,1)
+            self.parts = None
+            self.size = h5obj.attrs.get('Size')
             
     def to_hdf5(self, h5parent=None):
         if h5parent:
             self.h5parent = h5parent
 
-        success,data = cv2.imencode('.jpg',self.im, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        parts = self.to_parts()
         
-        if success:
+        if parts is not None:
+            data = np.frombuffer(parts[0], dtype=np.uint8).reshape((-1, 1))
             if 'Thumbnail' in h5parent:
                 h5obj = h5parent['Thumbnail']
                 h5obj.resize(data.shape)
@@ -62,12 +296,40 @@ class Thumbnail_Image(object):
             else:
                 h5obj = h5parent.create_dataset('Thumbnail',data=data, 
                                                 maxshape=(None,1))
-            h5obj.attrs['Size'] = self.size
-            if len(self.im.shape) == 3:
-                h5obj.attrs['Depth'] = self.im.shape[2]
-            else:
-                h5obj.attrs['Depth'] = 1
-            h5obj.attrs['Type'] = str(self.im.dtype)
+            h5obj.attrs['Depth'] = self.depth if self.depth is not None else get_depth(self.im)
+            h5obj.attrs['Type'] = 'uint8'
+            for (name, value) in self.to_info().iteritems():
+                h5obj.attrs[name] = value
+
+    def to_parts(self):
+        '''
+        Encoded thumbnail as a list of strings, for catalogs that store
+        thumbnails in a single blob (see catalog.py).  The other attributes
+        that to_hdf5 writes are in to_info.
+        '''
+        if self.parts is not None:
+            return self.parts
+        data = encode_jpeg(self.im)
+        if data is None:
+            return None
+        return [data]
+
+    def to_info(self):
+        '''Size of the original image, as a dict with the names of the HDF5 attributes'''
+        if self.size is None:
+            return {}
+        return {'Size': tuple(self.size)}
+
+    def from_parts(self, parts, info=None):
+        '''
+        Keeps the encoded thumbnail, which isn't decoded until im is used.
+        info is what to_info returned.
+        '''
+        if info is None:
+            info = {}
+        self.im = None
+        self.parts = list(parts)
+        self.size = info.get('Size')
         
 
 class Thumbnail_Video(object):
@@ -78,45 +340,105 @@ class Thumbnail_Video(object):
     def __init__(self, path=None, h5parent=None):
         self.path = path
         self.h5parent = h5parent
+        #True if the video took too long and only some frames were read
+        self.partial = False
+        self.size = None
+        self.depth = None
+        self.nframes = None
+        self.fps = None
+        self.im = None
+        #JPEG data for each frame, once it's encoded
+        self.parts = None
+
+    @property
+    def im(self):
+        '''The frames, which are decoded from parts the first time they're used'''
+        if self._im is None and self.parts is not None:
+            self._im = [cv2.imdecode(np.frombuffer(part, dtype=np.uint8),1) for part in self.parts]
+        return self._im
+
+    @im.setter
+    def im(self, im):
+        self._im = im
         
-    def from_file(self, path=None):
+    def from_file(self, path=None, budget=VIDEO_TIME_BUDGET):
+        '''
+        Reads the first frame and the frames at VIDEO_POSITIONS.  The video
+        is read in a separate thread, and if it takes more than budget
+        seconds, the frames that were read by then are used and
+        self.partial is set.  A read can't be interrupted, so the thread is
+        left running.  In a supervisor's worker, the supervisor sees it
+        and replaces the worker (see supervisor.py).
+        '''
         if path:
             self.path = path
 
-        cap = cv2.VideoCapture(self.path)
-        
-        success, im1 = cap.read()
-        if not success:
+        result = {'frames': []}
+        reader = threading.Thread(target=self.read_frames, args=(result,))
+        reader.daemon = True
+        reader.start()
+        reader.join(budget)
+
+        frames = list(result['frames'])
+        self.partial = reader.is_alive()
+        if self.partial:
+            logging.debug("Video thumbnail ran out of time: %s (%d frames)", self.path, len(frames))
+        elif 'error' in result:
+            raise result['error']
+        if not frames:
             logging.debug("Problem reading video: %s", self.path)
             raise IOError, "Could not read video"
-            
-        cap.set(cv2.cv.CV_CAP_PROP_POS_AVI_RATIO,0.5)
-        success, im2 = cap.read()
-        if not success:
-            raise IOError, "Could not read video"
-        
-        cap.set(cv2.cv.CV_CAP_PROP_POS_AVI_RATIO,0.99)
-        success, im3 = cap.read()
-        if not success:
-            raise IOError, "Could not read video"
 
-        self.size = (int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH)), 
-                    int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT)))
-                     
-        self.nframes = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
-        self.fps = cap.get(cv2.cv.CV_CAP_PROP_FPS)
-        
-        cap.release()
-        
-        if (im1.shape[0] > THUMBSIZE) or (im1.shape[1] > THUMBSIZE):
-            rat = float(THUMBSIZE) / max(im1.shape[:2])
-            dim = (int(im1.shape[0]*rat), int(im1.shape[1]*rat))
-            
-            self.im = [cv2.resize(im1,dim, interpolation = cv2.INTER_NEAREST),
-                       cv2.resize(im2,dim, interpolation = cv2.INTER_NEAREST),
-                       cv2.resize(im3,dim, interpolation = cv2.INTER_NEAREST)]
-        else:
-            self.im = [im1, im2, im3]
+        self.size = result['size']
+        self.nframes = result['nframes']
+        self.fps = result['fps']
+        self.im = frames
+        self.depth = None
+        self.parts = None
+
+    def encode(self):
+        '''
+        Encodes the frames and drops the images, so that only the JPEG data
+        is sent back from a worker process
+        '''
+        if self._im is not None:
+            self.depth = get_depth(self._im[0])
+            self.parts = self.to_parts()
+            self.im = None
+
+    def read_frames(self, result):
+        '''
+        Reads the frames into result['frames'] as thumbnails, one at a time.
+        Frames are found by index, which the video readers find by seeking
+        to the keyframe before them, instead of by position in the file.
+        '''
+        try:
+            cap = cv2.VideoCapture(self.path)
+            try:
+                success, im = cap.read()
+                if not success:
+                    raise IOError, "Could not read video"
+
+                result['size'] = (int(cap.get(get_cap_prop('FRAME_WIDTH'))),
+                                  int(cap.get(get_cap_prop('FRAME_HEIGHT'))))
+                result['nframes'] = nframes = int(cap.get(get_cap_prop('FRAME_COUNT')))
+                result['fps'] = cap.get(get_cap_prop('FPS'))
+                #keep only the small copy of each frame
+                result['frames'].append(shrink(im))
+
+                for pos in VIDEO_POSITIONS:
+                    frame = int(pos * (nframes - 1))
+                    if frame <= 0:
+                        break
+                    cap.set(get_cap_prop('POS_FRAMES'), frame)
+                    success, im = cap.read()
+                    if not success:
+                        raise IOError, "Could not read video"
+                    result['frames'].append(shrink(im))
+            finally:
+                cap.release()
+        except Exception as err:
+            result['error'] = err
         
     def from_hdf5(self, h5parent=None):
         if h5parent:
@@ -126,38 +448,66 @@ class Thumbnail_Video(object):
             h5obj = h5parent['Thumbnail']
             data = h5obj[:]
 
-            self.im = [cv2.imdecode(data[:,i],1) for i in xrange(data.shape[1])]
-            self.size = h5obj.attrs['Size']
-            self.nframes = h5obj.attrs['NFrames']
-            self.fps = h5obj.attrs['FramesPerSec']
+            self.im = [cv2.imdecode(data1,1) for data1 in data]
+            self.parts = None
+            #thumbnails copied from some columnar catalogs don't have these
+            self.size = h5obj.attrs.get('Size')
+            self.nframes = h5obj.attrs.get('NFrames')
+            self.fps = h5obj.attrs.get('FramesPerSec')
             
             
     def to_hdf5(self, h5parent=None):
         if h5parent:
             self.h5parent = h5parent
 
-        ok, data = zip(*[cv2.imencode('.jpg',im1, [cv2.IMWRITE_JPEG_QUALITY, 95]) for im1 in self.im])
-        if all(ok):
+        parts = self.to_parts()
+        if parts is not None:
+            data = [np.frombuffer(part, dtype=np.uint8) for part in parts]
             vlendatatype = h5py.special_dtype(vlen=data[0].dtype)
             try:
                 h5obj = h5parent.require_dataset('Thumbnail',dtype=vlendatatype,
-                                                 shape=(3,))
+                                                 shape=(len(data),))
             except TypeError:
                 del h5parent['Thumbnail']
                 h5obj = h5parent.require_dataset('Thumbnail',dtype=vlendatatype,
-                                                 shape=(3,))
+                                                 shape=(len(data),))
                 
             for (i,data1) in enumerate(data):
-                h5obj[i] = data1[:,0]
+                h5obj[i] = data1
 
-            h5obj.attrs['Size'] = self.size
-            if len(self.im[0].shape) == 3:
-                h5obj.attrs['Depth'] = self.im[0].shape[2]
-            else:
-                h5obj.attrs['Depth'] = 1
-            h5obj.attrs['Type'] = str(self.im[0].dtype)
-            h5obj.attrs['NFrames'] = self.nframes
-            h5obj.attrs['FramesPerSec'] = self.fps
+            h5obj.attrs['Depth'] = self.depth if self.depth is not None else get_depth(self.im[0])
+            h5obj.attrs['Type'] = 'uint8'
+            for (name, value) in self.to_info().iteritems():
+                h5obj.attrs[name] = value
+
+    def to_parts(self):
+        if self.parts is not None:
+            return self.parts
+        data = [encode_jpeg(im1) for im1 in self.im]
+        if None in data:
+            return None
+        return data
+
+    def to_info(self):
+        '''Size, number of frames and frame rate of the video, with the names of the HDF5 attributes'''
+        info = {}
+        for (name, value) in (('Size', self.size), ('NFrames', self.nframes), ('FramesPerSec', self.fps)):
+            if value is not None:
+                info[name] = value
+        return info
+
+    def from_parts(self, parts, info=None):
+        '''
+        Keeps the encoded frames, which aren't decoded until im is used.
+        info is what to_info returned.
+        '''
+        if info is None:
+            info = {}
+        self.im = None
+        self.parts = list(parts)
+        self.size = info.get('Size')
+        self.nframes = info.get('NFrames')
+        self.fps = info.get('FramesPerSec')
             
 class Thumbnail_Text(object):
     '''
@@ -186,6 +536,24 @@ class Thumbnail_Text(object):
             else:
                 self.text = [a]
 
+    def from_buffer(self, data, path=None):
+        '''
+        Head and tail of the text from the contents of the file, which were
+        already read
+        '''
+        if path:
+            self.path = path
+
+        if len(data) > 2*READLENGTH:
+            self.text = [str(data[:READLENGTH]), str(data[-READLENGTH:])]
+        else:
+            a = str(data[:READLENGTH])
+            b = str(data[READLENGTH:])
+            if b:
+                self.text = [a,b]
+            else:
+                self.text = [a]
+
     def from_hdf5(self, h5parent=None):
         if h5parent:
             self.h5parent = h5parent
@@ -221,6 +589,19 @@ class Thumbnail_Text(object):
             h5obj = h5parent.create_dataset('Thumbnail',
                                             data=self.text,
                                             maxshape=(None,))
+
+    def encode(self):
+        #the text is sent as it is
+        pass
+
+    def to_parts(self):
+        return list(self.text)
+
+    def to_info(self):
+        return {}
+
+    def from_parts(self, parts, info=None):
+        self.text = list(parts)
             
                 
             
@@ -228,20 +609,34 @@ thumbtypes = {'image': Thumbnail_Image,
                  'text': Thumbnail_Text,
                  'video': Thumbnail_Video}
 
+def get_thumbnail_type(path):
+    '''
+    Thumbnail class for the file, based on its mime type, or None
+    '''
+    (mimetp,enc) = mimetypes.guess_type(path)
+    logging.debug("get_thumbnail: %s = %s", path, mimetp)
+    
+    if mimetp is not None:
+        (mimebase, mimedetail) = mimetp.split('/')
+        return thumbtypes.get(mimebase)
+    return None
+
+def reads_buffer(path):
+    '''
+    True if the thumbnail for the file can be made from its contents in
+    memory.  Video needs random access, so it has to open the file itself.
+    '''
+    return hasattr(get_thumbnail_type(path), 'from_buffer')
+
 def get_thumbnail(path=None, h5obj=None):
     thumb = None
     if path:
-        (mimetp,enc) = mimetypes.guess_type(path)
-        logging.debug("get_thumbnail: %s = %s", path, mimetp)
-        
-        if mimetp is not None:
-            (mimebase, mimedetail) = mimetp.split('/')
-        
-            if mimebase in thumbtypes:
-                try:
-                    thumb = thumbtypes[mimebase](path=path)
-                except IOError:
-                    thumb = None
+        thumbtype = get_thumbnail_type(path)
+        if thumbtype is not None:
+            try:
+                thumb = thumbtype(path=path)
+            except IOError:
+                thumb = None
             
     elif h5obj:
         if 'Thumbnail' in h5obj: